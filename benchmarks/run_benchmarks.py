@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+"""
+Time GalaxyCMDWorkflow.run and each of its stages against the fake Galaxy from the tests
+
+One axis is varied at a time from a baseline case: the number of datasets, their size, the number
+of tool steps in the workflow and the simulated round trip time of every request. Each case is
+repeated and the median of each timing is kept. Results are written as JSON.
+
+    python benchmarks/run_benchmarks.py --datasets 1,10,50 --latency 0,0.02 -o results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from bioblend.galaxy.objects import wrappers
+
+from gflow.GalaxyCMDWorkflow import GalaxyCMDWorkflow
+from fake_galaxy import FakeGalaxy
+
+BASELINE = {'datasets': 8, 'dataset_size': 64 * 1024, 'steps': 3, 'latency': 0.005}
+STAGES = ('import_workflow', 'import_datasets', 'create_dataset_collection', 'populate_library',
+          'set_runtime_params', 'run')
+# Only bioblend releases whose objects API can create collections can run this stage
+UNSUPPORTED_STAGES = {} if hasattr(wrappers.History, 'create_dataset_collection') else {
+    'create_dataset_collection': 'the installed bioblend cannot create dataset collections through its objects API'}
+
+
+def make_workflow(inputs, steps):
+    """
+    Build a .ga workflow with the given number of input steps and a chain of tool steps
+
+    The first tool step reads the first input and every tool step leaves 'lineNum' to be set at runtime.
+
+    Args:
+        inputs (int): The number of data_input steps, labelled 'Input 0' to 'Input <n-1>'
+        steps (int): The number of tool steps
+    Returns:
+        workflow (dict): The workflow, as it would be loaded from a .ga file
+    """
+    ga_steps = {}
+    for i in range(0, inputs):
+        ga_steps[str(i)] = {'id': i, 'type': 'data_input', 'name': 'Input dataset', 'label': None, 'tool_id': None,
+                            'tool_state': json.dumps({'name': 'Input %d' % i}), 'input_connections': {},
+                            'outputs': []}
+    for i in range(inputs, inputs + steps):
+        source = (0, 'output') if i == inputs else (i - 1, 'out_file1')
+        ga_steps[str(i)] = {'id': i, 'type': 'tool', 'name': 'Select first', 'label': None,
+                            'tool_id': 'Show beginning1', 'tool_version': '1.0.0',
+                            'tool_state': json.dumps({'input': 'null', 'lineNum': '{"__class__": "RuntimeValue"}'}),
+                            'input_connections': {'input': {'id': source[0], 'output_name': source[1]}},
+                            'outputs': [{'name': 'out_file1', 'type': 'input'}]}
+    return {'a_galaxy_workflow': 'true', 'format-version': '0.1', 'name': 'Benchmark %d x %d' % (inputs, steps),
+            'steps': ga_steps}
+
+
+def make_config(galaxy, workdir, case):
+    """
+    Write the workflow and dataset files of a case and build its config
+
+    Args:
+        galaxy (FakeGalaxy): The server the case runs against
+        workdir (str): Where the files are written
+        case (dict): The number of datasets, their size and the number of workflow steps
+    Returns:
+        config (dict): The parameters of a GalaxyCMDWorkflow, with a fresh cache directory, and a dataset
+            collection unless that stage is unsupported
+    """
+    workflow_file = os.path.join(workdir, 'workflow.ga')
+    with open(workflow_file, 'w') as ga:
+        json.dump(make_workflow(case['datasets'], case['steps']), ga)
+    datasets = {}
+    collection = {}
+    for i in range(0, case['datasets']):
+        path = os.path.join(workdir, 'dataset%d.txt' % i)
+        with open(path, 'wb') as data:
+            data.write((('%d\t' % i) * (case['dataset_size'] // 2 + 1)).encode('ascii')[:case['dataset_size']])
+        datasets[i] = {'source': 'local', 'dataset_file': path, 'input_label': 'Input %d' % i}
+        collection[i] = {'source': 'local', 'dataset_file': path}
+    config = {'galaxy_url': galaxy.url, 'galaxy_key': galaxy.api_key, 'history_name': 'Benchmark',
+              'workflow_source': 'local', 'workflow': workflow_file, 'datasets': datasets,
+              'runtime_params': {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}},
+              'library_name': 'Benchmark library', 'cache_dir': tempfile.mkdtemp(dir=workdir)}
+    if 'create_dataset_collection' not in UNSUPPORTED_STAGES:
+        config['dataset_collection'] = {'input_label': 'Input 0', 'type': 'list', 'datasets': collection}
+    return config
+
+
+def timed(timings, stage, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        timings[stage] = time.time() - start
+
+
+def run_case(case):
+    """
+    Time each stage and then a whole run with the same config for one case, against a fresh server
+
+    Args:
+        case (dict): The number of datasets, their size, the number of workflow steps and the latency
+    Returns:
+        timings (dict): Seconds per stage and the number of requests made, or the error that stopped the case
+    """
+    timings = {}
+    workdir = tempfile.mkdtemp(prefix='gflow-bench-')
+    try:
+        with FakeGalaxy(latency=case['latency']) as galaxy:
+            config = make_config(galaxy, workdir, case)
+            gflow = GalaxyCMDWorkflow(config)
+            gi = gflow.connect()
+            workflow = timed(timings, 'import_workflow', gflow.import_workflow, gi)
+            history = gi.histories.create(gflow.history_name)
+            timed(timings, 'import_datasets', gflow.import_datasets, 'datasets', gi, history)
+            if 'create_dataset_collection' not in UNSUPPORTED_STAGES:
+                timed(timings, 'create_dataset_collection', gflow.create_dataset_collection, gi, history)
+            timed(timings, 'populate_library', gflow.populate_library, gi, history)
+            timed(timings, 'set_runtime_params', gflow.set_runtime_params, workflow)
+            # A fresh cache directory, so the run uploads everything again
+            config = make_config(galaxy, workdir, case)
+            requests_before = galaxy.request_count()
+            timed(timings, 'run', GalaxyCMDWorkflow(config).run)
+            timings['run_requests'] = galaxy.request_count() - requests_before
+    except Exception as e:
+        timings['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return timings
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def sweep(axes):
+    """
+    List the cases: the baseline, then each value of each axis with the other axes at their baseline
+
+    Args:
+        axes (dict): Axis name to the values to try
+    Returns:
+        cases (list): One dict per case, without duplicates
+    """
+    cases = [dict(BASELINE)]
+    for axis in ('datasets', 'dataset_size', 'steps', 'latency'):
+        for value in axes.get(axis) or []:
+            case = dict(BASELINE)
+            case[axis] = value
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_options(argv):
+    """
+    Get the axes to sweep and where to write the results from the command line
+
+    Returns:
+        args (Namespace): The parsed options.
+    """
+    def numbers(kind):
+        return lambda text: [kind(value) for value in text.split(',') if value]
+
+    parser = argparse.ArgumentParser(prog="run_benchmarks.py")
+    parser.add_argument("--datasets", type=numbers(int), default=[1, 32],
+                        help="comma separated numbers of datasets to try")
+    parser.add_argument("--sizes", type=numbers(int), default=[1024, 1024 * 1024],
+                        help="comma separated dataset sizes to try, in bytes")
+    parser.add_argument("--steps", type=numbers(int), default=[1, 20],
+                        help="comma separated numbers of workflow tool steps to try")
+    parser.add_argument("--latency", type=numbers(float), default=[0, 0.02],
+                        help="comma separated seconds of latency per request to try")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of times each case is run, the median is reported")
+    parser.add_argument("-o", "--output", type=str,
+                        help="file to write the JSON results to, standard output if not given")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_options(argv)
+    logging.disable(logging.WARNING)
+    results = {'benchmark': 'gflow.run', 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'repeat': args.repeat, 'unsupported_stages': UNSUPPORTED_STAGES, 'cases': []}
+    for stage in sorted(UNSUPPORTED_STAGES):
+        sys.stderr.write("Not timing %s: %s\n" % (stage, UNSUPPORTED_STAGES[stage]))
+    failed = False
+    axes = {'datasets': args.datasets, 'dataset_size': args.sizes, 'steps': args.steps, 'latency': args.latency}
+    for case in sweep(axes):
+        runs = [run_case(case) for i in range(0, args.repeat)]
+        errors = [timings['error'] for timings in runs if 'error' in timings]
+        result = dict(case)
+        result['seconds'] = dict((stage, median(timings.get(stage) for timings in runs)) for stage in STAGES
+                                 if stage not in UNSUPPORTED_STAGES)
+        result['run_requests'] = median(timings.get('run_requests') for timings in runs)
+        if errors:
+            result['errors'] = errors
+            failed = True
+            sys.stderr.write("%s: %d error(s), first: %s\n" % (json.dumps(case, sort_keys=True), len(errors), errors[0]))
+        results['cases'].append(result)
+        sys.stderr.write("%s: run %s s\n" % (json.dumps(case, sort_keys=True), result['seconds']['run']))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
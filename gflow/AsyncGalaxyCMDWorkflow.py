@@ -0,0 +1,527 @@
+"""
+Asynchronous runs of GalaxyCMDWorkflow configurations, for driving many histories from one process.
+
+This module needs Python 3.5 or later and the optional aiohttp package ("pip install .[async]").
+Nothing else in gflow imports it, so the rest of the package still runs on Python 2.7.
+"""
+import asyncio
+import json
+import logging
+import os
+
+from bioblend.galaxy.client import ConnectionError
+from bioblend.galaxy.objects import wrappers
+
+from gflow.GalaxyCMDWorkflow import GalaxyCMDWorkflow
+from gflow.RunManifest import RunManifest
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+def open_session(max_connections=DEFAULT_MAX_CONNECTIONS, timeout=None):
+    """
+    Open an HTTP session whose connection pool can be shared by many AsyncGalaxyCMDWorkflow runs
+
+    Args:
+        max_connections (int): The maximum number of connections open at once
+        timeout (float): The total timeout of each request in seconds, None for no timeout
+    Returns:
+        session (aiohttp.ClientSession): The session, to be closed by the caller
+    """
+    if aiohttp is None:
+        raise ImportError("AsyncGalaxyCMDWorkflow requires the aiohttp package")
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections),
+                                 timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+def succeeded(task):
+    """
+    Whether an asyncio task has finished without raising, False if it was not started
+    """
+    return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+
+class AsyncGalaxyCMDWorkflow(object):
+    def __init__(self, gflow, session=None):
+        """
+        Run the workflow of a GalaxyCMDWorkflow through asyncio
+
+        The GalaxyCMDWorkflow holds the configuration and does everything that needs no request, such
+        as preflight() and binding runtime parameters to steps. This class makes the requests, calling
+        Galaxy's REST API directly over a pooled aiohttp session, so hundreds of runs can be in flight
+        on one event loop. Stage times and API calls are counted in gflow.metrics.
+
+        The dataset and workflow caches and chunked uploads work through blocking bioblend calls and
+        are not used: each local file is uploaded in a single request and a local workflow is imported
+        by every run.
+
+        Args:
+            gflow (GalaxyCMDWorkflow): The configuration of the run
+            session (aiohttp.ClientSession): A session to share with other runs, one is opened by run() if None
+        Attributes:
+            self.logger: For logging.
+            self.gflow (GalaxyCMDWorkflow): The configuration of the run, its checks and its metrics
+            self.session (aiohttp.ClientSession): The session requests are made with
+        """
+        self.logger = logging.getLogger('gflow.AsyncGalaxyCMDWorkflow')
+        self.gflow = gflow
+        self.session = session
+        self._imported_dataset_ids = []
+
+    @classmethod
+    def init_from_config_file(cls, configfile, session=None):
+        """
+        Make an AsyncGalaxyCMDWorkflow object from a config file, see GalaxyCMDWorkflow.init_from_config_file
+        """
+        return cls(GalaxyCMDWorkflow.init_from_config_file(configfile), session)
+
+    @classmethod
+    def init_from_params(cls, *args, **kwargs):
+        """
+        Make an AsyncGalaxyCMDWorkflow object from parameters, see GalaxyCMDWorkflow.init_from_params
+
+        A 'session' keyword argument is passed on to the constructor.
+        """
+        session = kwargs.pop('session', None)
+        return cls(GalaxyCMDWorkflow.init_from_params(*args, **kwargs), session)
+
+    def api_url(self, path):
+        return '%s/api/%s' % (self.gflow.galaxy_url.rstrip('/'), path)
+
+    async def request(self, method, path, payload=None, data=None):
+        """
+        Make one API request
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path below /api
+            payload (dict): A body to send as JSON
+            data (FormData): A multipart body to send instead of payload
+        Returns:
+            response (dict or list): The decoded JSON reply, raises ConnectionError on an unexpected status
+        """
+        self.gflow.metrics.add('api_calls')
+        async with self.session.request(method, self.api_url(path), params={'key': self.gflow.galaxy_key},
+                                        json=payload, data=data) as response:
+            if response.status != 200:
+                raise ConnectionError("Unexpected response from galaxy: %s" % response.status,
+                                      body=await response.text())
+            return await response.json(content_type=None)
+
+    async def timed(self, name, awaitable):
+        """
+        Await something as part of a stage of self.gflow.metrics
+        """
+        with self.gflow.metrics.stage(name):
+            return await awaitable
+
+    async def import_workflow(self):
+        """
+        Import a workflow into an instance of Galaxy
+
+        Returns:
+            wf (Workflow): A workflow object built from Galaxy's description, without a connection
+        """
+        if self.gflow.workflow_source == 'local':
+            workflow = self.gflow.load_workflow_file()
+            workflow_id = (await self.request('POST', 'workflows/upload', {'workflow': workflow}))['id']
+        elif self.gflow.workflow_source == 'id':
+            workflow_id = self.gflow.workflow
+        else:
+            self.logger.error("Workflow source must be either 'local' or 'id'")
+            raise ValueError("Workflow source must be either 'local' or 'id'")
+        return wrappers.Workflow(await self.request('GET', 'workflows/%s' % workflow_id))
+
+    async def import_datasets(self, data_group_type, history_id):
+        """
+        Import the datasets into a history of an instance of Galaxy
+
+        If an import fails, no further import is started and the ones already running are waited for
+        before the error is raised.
+
+        Args:
+            data_group_type (str): Either 'datasets' or 'dataset_collection'
+            history_id (str): The ID of the history that the data will be imported to
+        Returns:
+            results (List): Galaxy's description of each imported dataset, in config order
+        """
+        if data_group_type == 'datasets':
+            datasets = [self.gflow.datasets[i] for i in range(0, len(self.gflow.datasets))]
+        elif data_group_type == 'dataset_collection':
+            datasets = self.gflow.collection_entries()
+        else:
+            self.logger.error("Data group type must be 'datasets' or 'dataset_collection'")
+            raise ValueError("Data group type must be 'datasets' or 'dataset_collection'")
+        for dataset in datasets:
+            self.gflow.verify_dataset_source(dataset)
+        semaphore = asyncio.Semaphore(self.gflow.max_parallel_uploads)
+        abandoned = asyncio.Event()
+        results = [None] * len(datasets)
+
+        def record(index, output):
+            results[index] = output
+            self._imported_dataset_ids.append(output['id'])
+            self.gflow.metrics.add('datasets_imported')
+
+        async def import_one(index):
+            async with semaphore:
+                if abandoned.is_set():
+                    return
+                try:
+                    record(index, await self.import_dataset(datasets[index], history_id))
+                except Exception:
+                    abandoned.set()
+                    raise
+
+        batched = {'url': self.fetch_url_datasets, 'server_path': self.link_server_datasets}
+
+        async def import_batch(source):
+            indexes = [i for i in range(0, len(datasets)) if datasets[i]['source'] == source]
+            if indexes:
+                try:
+                    outputs = await batched[source]([datasets[i] for i in indexes], history_id)
+                except Exception:
+                    abandoned.set()
+                    raise
+                for i in range(0, len(indexes)):
+                    record(indexes[i], outputs[i])
+
+        tasks = [import_one(i) for i in range(0, len(datasets)) if datasets[i]['source'] not in batched]
+        outcomes = await asyncio.gather(*(tasks + [import_batch(source) for source in batched]),
+                                        return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        return results
+
+    async def fetch_url_datasets(self, datasets, history_id):
+        """
+        Have Galaxy fetch URLs into a history itself, many URLs per request
+
+        Args:
+            datasets (list): The dataset entries from the config file with a 'url' source
+            history_id (str): The ID of the history that the data will be fetched to
+        Returns:
+            results (list): Galaxy's description of each new history dataset, in entry order
+        """
+        results = [None] * len(datasets)
+        for file_type, dbkey, indexes in self.gflow.url_batches(datasets):
+            self.logger.info("Fetching %d dataset(s) from URLs" % len(indexes))
+            inputs = {'file_type': file_type, 'dbkey': dbkey, 'files_0|type': 'upload_dataset',
+                      'files_0|url_paste': '\n'.join(datasets[i]['url'] for i in indexes)}
+            outputs = (await self.request('POST', 'tools', {'history_id': history_id, 'tool_id': 'upload1',
+                                                            'inputs': inputs}))['outputs']
+            if len(outputs) != len(indexes):
+                self.logger.error("Galaxy created %d dataset(s) for %d URL(s)" % (len(outputs), len(indexes)))
+                raise RuntimeError("Galaxy created %d dataset(s) for %d URL(s)" % (len(outputs), len(indexes)))
+            for i in range(0, len(indexes)):
+                results[indexes[i]] = outputs[i]
+        return results
+
+    async def link_server_datasets(self, datasets, history_id):
+        """
+        Have Galaxy link files on its own file system into a history, one library request per directory
+
+        Args:
+            datasets (list): The dataset entries from the config file with a 'server_path' source
+            history_id (str): The ID of the history that the data will be imported to
+        Returns:
+            results (list): Galaxy's description of each new history dataset, in entry order
+        """
+        name = self.gflow.server_path_library or "%s server paths" % self.gflow.history_name
+        libraries = await self.request('GET', 'libraries')
+        existing = [lib for lib in libraries if lib['name'] == name and not lib.get('deleted')]
+        if existing:
+            lib = existing[0]
+        else:
+            self.logger.info("Creating library '%s' for server paths" % name)
+            lib = await self.request('POST', 'libraries', {'name': name})
+        batches = self.gflow.batch_entries(datasets, lambda dataset: (os.path.dirname(dataset['path']),
+                                                                      dataset.get('file_type', 'auto'),
+                                                                      dataset.get('dbkey', '?')))
+        library_ids = [None] * len(datasets)
+        for (directory, file_type, dbkey), indexes in batches:
+            self.logger.info("Linking %d dataset(s) from '%s'" % (len(indexes), directory))
+            res = await self.request('POST', 'libraries/%s/contents' % lib['id'], {
+                'folder_id': lib['root_folder_id'], 'file_type': file_type, 'dbkey': dbkey, 'create_type': 'file',
+                'upload_option': 'upload_paths', 'link_data_only': 'link_to_files',
+                'filesystem_paths': '\n'.join(datasets[i]['path'] for i in indexes)})
+            linked = dict((item['name'], item['id']) for item in res)
+            for i in indexes:
+                if os.path.basename(datasets[i]['path']) not in linked:
+                    self.logger.error("Galaxy did not link server path '%s'" % datasets[i]['path'])
+                    raise RuntimeError("Galaxy did not link server path '%s'" % datasets[i]['path'])
+                library_ids[i] = linked[os.path.basename(datasets[i]['path'])]
+        semaphore = asyncio.Semaphore(self.gflow.max_parallel_uploads)
+
+        async def import_linked(library_id):
+            async with semaphore:
+                return await self.request('POST', 'histories/%s/contents' % history_id,
+                                          {'source': 'library', 'content': library_id})
+
+        return await asyncio.gather(*[import_linked(library_id) for library_id in library_ids])
+
+    async def import_dataset(self, dataset, history_id):
+        """
+        Import a single local or library dataset into a history of an instance of Galaxy
+
+        Args:
+            dataset (dict): The dataset entry from the config file
+            history_id (str): The ID of the history that the data will be imported to
+        Returns:
+            result (dict): Galaxy's description of the new history dataset
+        """
+        if dataset['source'] == 'local':
+            self.logger.info("Importing dataset from file: '%s'" % dataset['dataset_file'])
+            name = os.path.basename(dataset['dataset_file'])
+            inputs = {'file_type': 'auto', 'dbkey': '?', 'files_0|type': 'upload_dataset', 'files_0|NAME': name}
+            with open(dataset['dataset_file'], 'rb') as upload_file:
+                form = aiohttp.FormData()
+                form.add_field('history_id', history_id)
+                form.add_field('tool_id', 'upload1')
+                form.add_field('inputs', json.dumps(inputs))
+                form.add_field('files_0|file_data', upload_file, filename=name)
+                output = (await self.request('POST', 'tools', data=form))['outputs'][0]
+            self.gflow.metrics.add('bytes_uploaded', os.path.getsize(dataset['dataset_file']))
+            return output
+        self.logger.info("Importing dataset: '%s' from library: '%s'" % (dataset['dataset_id'],
+                         dataset['library_id']))
+        return await self.request('POST', 'histories/%s/contents' % history_id,
+                                  {'source': 'library', 'content': dataset['dataset_id']})
+
+    async def create_dataset_collection(self, history_id, name="DatasetList"):
+        """
+        Make a dataset collection with the datasets listed in self.gflow.dataset_collection
+
+        Args:
+            history_id (str): The ID of the history in which to create the dataset collection
+            name (str): The name of the new dataset collection
+        Returns:
+            dataset_collection (dict): Galaxy's description of the new collection
+        """
+        self.logger.info("Dataset collection name: '%s'" % name)
+        datasets = await self.import_datasets('dataset_collection', history_id)
+        payload = self.gflow.build_collection_description([(dataset['name'], dataset['id'])
+                                                           for dataset in datasets], name).to_dict()
+        payload['type'] = 'dataset_collection'
+        return await self.request('POST', 'histories/%s/contents' % history_id, payload)
+
+    async def populate_library(self, history_id):
+        """
+        Create the library named by self.gflow.library_name and copy datasets of the history into it
+
+        Either the datasets imported by this run or every dataset in the history is copied, depending on
+        self.gflow.library_imported_only, with at most self.gflow.max_parallel_library_copies copies at once.
+
+        Args:
+            history_id (str): The ID of the history the datasets are copied from
+        Returns:
+            lib (dict): Galaxy's description of the new library
+        """
+        self.logger.info("Creating library '%s'" % self.gflow.library_name)
+        lib = await self.request('POST', 'libraries', {'name': self.gflow.library_name})
+        if self.gflow.library_imported_only:
+            dataset_ids = list(self._imported_dataset_ids)
+        else:
+            contents = await self.request('GET', 'histories/%s/contents' % history_id)
+            dataset_ids = [item['id'] for item in contents
+                           if item.get('history_content_type', 'dataset') == 'dataset' and not item.get('deleted')]
+        self.logger.info("Copying %d dataset(s) to library '%s' with up to %d parallel copies"
+                         % (len(dataset_ids), self.gflow.library_name, self.gflow.max_parallel_library_copies))
+        semaphore = asyncio.Semaphore(self.gflow.max_parallel_library_copies)
+
+        async def copy_dataset(dataset_id):
+            async with semaphore:
+                return await self.request('POST', 'libraries/%s/contents' % lib['id'],
+                                          {'folder_id': lib['root_folder_id'], 'create_type': 'file',
+                                           'from_hda_id': dataset_id})
+
+        await asyncio.gather(*[copy_dataset(dataset_id) for dataset_id in dataset_ids])
+        return lib
+
+    async def abandon_staging(self, stages, temp_workflow_stage=None):
+        """
+        Clean up after a failure before the workflow was invoked
+
+        The stages still running are waited for, so nothing is still being written to the history when
+        it is purged. A temporary workflow imported by the run is then deleted. Cleanup failures are
+        logged without hiding the error that stopped the run.
+
+        Args:
+            stages (dict): Stage name to the task running it, the history is created by the 'create_history' stage
+            temp_workflow_stage (Task): The stage importing a workflow that is deleted after use, if any
+        """
+        await asyncio.gather(*[task for task in stages.values() if task is not None], return_exceptions=True)
+        if succeeded(stages.get('create_history')):
+            history = stages['create_history'].result()
+            self.logger.error("Deleting history '%s' as the run failed before invoking the workflow"
+                              % self.gflow.history_name)
+            try:
+                await self.request('DELETE', 'histories/%s' % history['id'], {'purge': True})
+            except Exception as e:
+                self.logger.warning("Could not delete history '%s': %s" % (self.gflow.history_name, e))
+        if succeeded(temp_workflow_stage):
+            self.logger.info("Deleting workflow: '%s'" % self.gflow.workflow)
+            try:
+                await self.request('DELETE', 'workflows/%s' % temp_workflow_stage.result().id)
+            except Exception as e:
+                self.logger.warning("Could not delete workflow '%s': %s" % (self.gflow.workflow, e))
+
+    async def find_invocation_id(self, workflow_id, history_id):
+        """
+        Find the invocation of a workflow that writes to a history
+
+        Args:
+            workflow_id (str): The ID of the workflow that was run
+            history_id (str): The ID of the history the workflow was run in
+        Returns:
+            invocation_id (str): The ID of the invocation, None if Galaxy does not list invocations
+        """
+        try:
+            invocations = await self.request('GET', 'workflows/%s/invocations' % workflow_id)
+        except ConnectionError as e:
+            self.logger.warning("Could not list the invocations of workflow '%s': %s" % (workflow_id, e))
+            return None
+        for invocation in reversed(invocations):
+            if invocation.get('history_id') == history_id:
+                return invocation['id']
+        return None
+
+    async def run(self, temp_wf=False, output_file=None):
+        """
+        Set up for the workflow then run it, opening a session first if none was given
+
+        Args:
+            temp_wf (bool): Flag to determine whether the workflow should be deleted after use
+            output_file (str): A file to write the JSON run manifest to, updated after every stage, see RunManifest
+        Returns:
+            results (dict): Galaxy's reply to the workflow invocation, with the output dataset IDs
+        """
+        manifest = RunManifest(output_file) if output_file else None
+        try:
+            with self.gflow.metrics.stage('run'):
+                if self.session is not None:
+                    return await self.run_stages(temp_wf, manifest)
+                async with open_session() as self.session:
+                    try:
+                        return await self.run_stages(temp_wf, manifest)
+                    finally:
+                        self.session = None
+        except BaseException as e:
+            # Also on cancellation and KeyboardInterrupt, so the manifest never stays 'running'
+            if manifest is not None:
+                manifest.update(status='failed', error=str(e) or e.__class__.__name__)
+            raise
+        finally:
+            if manifest is not None:
+                manifest.update(metrics=self.gflow.metrics.as_dict())
+
+    async def run_stages(self, temp_wf, manifest):
+        """
+        The stages of run(), each timed in self.gflow.metrics and recorded in the manifest if there is one
+        """
+        gflow = self.gflow
+        with gflow.metrics.stage('preflight'):
+            gflow.preflight()
+        self._imported_dataset_ids = []
+
+        # Importing a local workflow, building the dataset collection and importing the datasets all
+        # run at the same time. A workflow given by ID is fetched and checked before anything is written.
+        self.logger.info("Importing workflow '%s' from '%s' source" % (gflow.workflow, gflow.workflow_source))
+        stages = {}
+        temp_workflow_stage = None
+        try:
+            if gflow.workflow_source == 'local':
+                stages['import_workflow'] = asyncio.ensure_future(self.timed('import_workflow',
+                                                                             self.import_workflow()))
+                if temp_wf:
+                    temp_workflow_stage = stages['import_workflow']
+            else:
+                workflow = await self.timed('import_workflow', self.import_workflow())
+                gflow.preflight(workflow)
+
+            self.logger.info("Creating output history '%s'" % gflow.history_name)
+            stages['create_history'] = asyncio.ensure_future(self.timed(
+                'create_history', self.request('POST', 'histories', {'name': gflow.history_name})))
+            history = await stages['create_history']
+            if manifest is not None:
+                manifest.update(history={'id': history['id'], 'name': history['name']})
+
+            if gflow.dataset_collection:
+                self.logger.info("Creating dataset collection")
+                stages['create_dataset_collection'] = asyncio.ensure_future(self.timed(
+                    'create_dataset_collection', self.create_dataset_collection(history['id'])))
+            if gflow.datasets:
+                self.logger.info("Importing datasets to history")
+                stages['import_datasets'] = asyncio.ensure_future(self.timed(
+                    'import_datasets', self.import_datasets('datasets', history['id'])))
+
+            if 'import_workflow' in stages:
+                workflow = await stages['import_workflow']
+            params = {}
+            if gflow.runtime_params:
+                self.logger.info("Setting runtime tool parameters")
+                with gflow.metrics.stage('set_runtime_params'):
+                    params = gflow.set_runtime_params(workflow)
+
+            input_map = {}
+            if 'create_dataset_collection' in stages:
+                input_map[gflow.dataset_collection['input_label']] = await stages['create_dataset_collection']
+            if 'import_datasets' in stages:
+                imported_datasets = await stages['import_datasets']
+                for i in range(0, len(imported_datasets)):
+                    input_map[gflow.datasets[i]['input_label']] = imported_datasets[i]
+        except Exception:
+            await self.abandon_staging(stages, temp_workflow_stage)
+            raise
+
+        if manifest is not None:
+            manifest.update(workflow={'id': workflow.id, 'name': workflow.name},
+                            inputs=dict((label, RunManifest.describe(content)) for label, content in input_map.items()))
+
+        if gflow.library_name:
+            await self.timed('populate_library', self.populate_library(history['id']))
+
+        collection_label = gflow.dataset_collection['input_label'] if gflow.dataset_collection else None
+        ds_map = {}
+        for label, step_ids in workflow.input_labels_to_ids.items():
+            for step_id in step_ids:
+                if label in input_map:
+                    ds_map[step_id] = {'id': input_map[label]['id'],
+                                       'src': 'hdca' if label == collection_label else 'hda'}
+        self.logger.info("Initiating workflow")
+        results = await self.timed('invoke_workflow', self.request(
+            'POST', 'workflows', {'workflow_id': workflow.id, 'history': 'hist_id=%s' % history['id'],
+                                  'ds_map': ds_map, 'parameters': params}))
+        if manifest is not None:
+            manifest.update(status='invoked', invocation_id=await self.find_invocation_id(workflow.id, history['id']),
+                            outputs=[RunManifest.describe({'id': output_id})
+                                     for output_id in results.get('outputs') or []])
+
+        if temp_wf and gflow.workflow_source != 'id':
+            self.logger.info("Deleting workflow: '%s'" % gflow.workflow)
+            await self.request('DELETE', 'workflows/%s' % workflow.id)
+        return results
+
+
+async def run_all(flows, temp_wf=False, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """
+    Run many workflows concurrently over one shared connection pool
+
+    Args:
+        flows (list): The AsyncGalaxyCMDWorkflow objects to run
+        temp_wf (bool): Flag to determine whether imported workflows should be deleted after use
+        max_connections (int): The maximum number of connections open at once
+    Returns:
+        results (list): The result of each run, or the exception it raised, in the order of flows
+    """
+    async with open_session(max_connections) as session:
+        for flow in flows:
+            flow.session = session
+        return await asyncio.gather(*[flow.run(temp_wf) for flow in flows], return_exceptions=True)
@@ -0,0 +1,185 @@
+import copy
+import csv
+import json
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+from gflow.GalaxyCMDWorkflow import GalaxyCMDWorkflow
+
+
+DEFAULT_MAX_PARALLEL_RUNS = 4
+
+
+class BatchRunner(object):
+    def __init__(self, config, samples, columns, max_parallel_runs=DEFAULT_MAX_PARALLEL_RUNS):
+        """
+        Run one workflow over every sample of a sample sheet from a single process
+
+        The workflow is imported and the Galaxy connection made once, then each sample gets its own
+        history. All samples share the process wide HTTP connection pool. Every column of the sample
+        sheet other than 'sample' and 'history_name' is an input label, and its value is the local file
+        to use for that input.
+
+        Args:
+            config (dict): The base configuration parameters shared by all samples
+            samples (list): One dict per sample sheet row
+            columns (list): The sample sheet columns, in order
+            max_parallel_runs (int): The maximum number of samples processed at once
+        Attributes:
+            self.logger: For logging.
+            self.config (dict): The base configuration parameters shared by all samples
+            self.samples (list): One dict per sample sheet row
+            self.columns (list): The sample sheet columns, in order
+            self.max_parallel_runs (int): The maximum number of samples processed at once
+            self.metrics (dict): Sample name to the metrics of its run, for the samples that were run
+        """
+        self.logger = logging.getLogger('gflow.BatchRunner')
+        self.config = config
+        self.samples = samples
+        self.columns = columns
+        self.max_parallel_runs = max_parallel_runs
+        self.metrics = {}
+
+    @classmethod
+    def init_from_files(cls, samplefile, configfile, max_parallel_runs=None):
+        """
+        Makes a BatchRunner from a sample sheet and a base config file
+
+        Args:
+            samplefile (str): The tab separated sample sheet
+            configfile (str): The name of the config file to be read
+            max_parallel_runs (int): The maximum number of samples processed at once
+        """
+        config = GalaxyCMDWorkflow.load_config_file(configfile)
+        samples, columns = cls.read_sample_sheet(samplefile)
+        return cls(config, samples, columns,
+                   max_parallel_runs or config.get('max_parallel_runs') or DEFAULT_MAX_PARALLEL_RUNS)
+
+    @staticmethod
+    def read_sample_sheet(samplefile):
+        """
+        Read a tab separated sample sheet with a header row
+
+        Args:
+            samplefile (str): The name of the sample sheet
+        Returns:
+            samples (list), columns (list): One dict per row, and the column names in order
+        """
+        logger = logging.getLogger('gflow.BatchRunner')
+        with open(samplefile, 'r') as tsvfile:
+            reader = csv.DictReader(tsvfile, delimiter='\t')
+            samples = [row for row in reader if any(row.values())]
+            columns = reader.fieldnames or []
+        if 'sample' not in columns:
+            logger.error("Sample sheet '%s' has no 'sample' column" % samplefile)
+            raise ValueError("Sample sheet '%s' has no 'sample' column" % samplefile)
+        names = [row['sample'] for row in samples]
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            logger.error("Duplicate sample name(s) in sample sheet: %s" % str(duplicates))
+            raise ValueError("Duplicate sample name(s) in sample sheet: %s" % str(duplicates))
+        return samples, columns
+
+    def sample_config(self, sample):
+        """
+        Build the configuration parameters for one sample
+
+        Args:
+            sample (dict): The sample sheet row
+        Returns:
+            config (dict): The base configuration with this sample's history name and input files
+        """
+        config = copy.deepcopy(self.config)
+        config['history_name'] = sample.get('history_name') or '%s %s' % (self.config['history_name'],
+                                                                           sample['sample'])
+        datasets = config.get('datasets') or {}
+        label_index = dict((datasets[i]['input_label'], i) for i in range(0, len(datasets)))
+        for column in self.columns:
+            if column in ('sample', 'history_name') or not sample.get(column):
+                continue
+            entry = {'source': 'local', 'dataset_file': sample[column], 'input_label': column}
+            datasets[label_index.get(column, len(datasets))] = entry
+        config['datasets'] = datasets or None
+        return config
+
+    def run(self, temp_wf=False, wait=False):
+        """
+        Check every sample, then import the workflow once and run it for every sample that passed
+
+        Args:
+            temp_wf (bool): Flag to determine whether the workflow should be deleted after use
+            wait (bool): Flag to wait for each sample's jobs, failing samples whose datasets end in error
+        Returns:
+            report (list): A (sample name, error message) tuple per sample, the message is None on success
+        """
+        base = GalaxyCMDWorkflow(self.config)
+        # Every sample runs the same workflow, so a local workflow file is parsed for the whole batch
+        local_workflow = base.local_workflow if base.workflow_source == 'local' else None
+        self.logger.info("Checking %d sample(s) before connecting" % len(self.samples))
+        rejected = {}
+        runs = {}
+        for sample in self.samples:
+            try:
+                gflow = GalaxyCMDWorkflow(self.sample_config(sample))
+                if local_workflow is not None:
+                    gflow.local_workflow = local_workflow
+                gflow.preflight()
+                runs[sample['sample']] = gflow
+            except Exception as e:
+                self.logger.error("Sample '%s' failed pre-flight checks: %s" % (sample['sample'], e))
+                rejected[sample['sample']] = str(e) or e.__class__.__name__
+        samples = [sample for sample in self.samples if sample['sample'] not in rejected]
+        if not samples:
+            self.logger.error("No sample passed the pre-flight checks")
+            return [(sample['sample'], rejected[sample['sample']]) for sample in self.samples]
+
+        self.logger.info("Initiating Galaxy connection")
+        gi = base.connect()
+        self.logger.info("Importing workflow '%s' from '%s' source" % (base.workflow, base.workflow_source))
+        workflow = base.import_workflow(gi, temp_wf)
+
+        def run_sample(sample):
+            gflow = runs[sample['sample']]
+            try:
+                try:
+                    gflow.run(gi=gi, workflow=workflow, wait=wait)
+                finally:
+                    self.metrics[sample['sample']] = gflow.metrics.as_dict()
+                if gflow.history_state == 'error':
+                    raise RuntimeError("Workflow finished with failed dataset(s)")
+            except Exception as e:
+                # Whatever goes wrong with one sample, the others keep running
+                self.logger.error("Sample '%s' failed: %s" % (sample['sample'], e))
+                return sample['sample'], str(e) or e.__class__.__name__
+            self.logger.info("Sample '%s' succeeded" % sample['sample'])
+            return sample['sample'], None
+
+        self.logger.info("Running %d sample(s), up to %d at once" % (len(samples), self.max_parallel_runs))
+        pool = ThreadPool(max(1, min(self.max_parallel_runs, len(samples))))
+        try:
+            results = dict(pool.map(run_sample, samples))
+        finally:
+            pool.terminate()
+            if temp_wf and not base.workflow_reused and base.workflow_source != 'id':
+                self.logger.info("Deleting workflow: '%s'" % base.workflow)
+                workflow.delete()
+        results.update(rejected)
+        report = [(sample['sample'], results[sample['sample']]) for sample in self.samples]
+        failed = [name for name, error in report if error]
+        self.logger.info("%d sample(s) succeeded, %d failed" % (len(report) - len(failed), len(failed)))
+        return report
+
+    def write_metrics(self, filename):
+        """
+        Write the metrics of every sample that was run to a JSON file, keyed by sample name
+
+        Args:
+            filename (str): The file to write
+        """
+        try:
+            with open(filename, 'w') as metrics_file:
+                json.dump({'samples': self.metrics}, metrics_file, indent=2, sort_keys=True)
+        except IOError as e:
+            self.logger.error(e)
+            raise IOError(e)
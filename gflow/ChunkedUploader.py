@@ -0,0 +1,178 @@
+import logging
+import os
+import time
+import uuid
+
+import requests
+
+from gflow.JsonStore import JsonStore
+
+
+DEFAULT_CHUNK_SIZE = 10 * 1024 * 1024
+DEFAULT_CHUNKED_UPLOAD_THRESHOLD = 100 * 1024 * 1024
+DEFAULT_UPLOAD_RETRIES = 5
+
+
+class ChunkedUploader(object):
+    def __init__(self, galaxy_url, galaxy_key, chunk_size=DEFAULT_CHUNK_SIZE, retries=DEFAULT_UPLOAD_RETRIES,
+                 journal=None, http=None, metrics=None, progress=None):
+        """
+        Upload large files to Galaxy in fixed-size chunks through the /api/upload endpoint
+
+        The number of bytes Galaxy has acknowledged for each file is kept in a journal, keyed by the
+        file's path, size and modification time, so an interrupted upload can be picked up from the
+        last acknowledged chunk by a later run.
+
+        Args:
+            galaxy_url (str): The URL of an instance of Galaxy
+            galaxy_key (str): The API key of an instance of Galaxy
+            chunk_size (int): The number of bytes sent per request
+            retries (int): The number of times a failed chunk is re-sent before giving up
+            journal (JsonStore): Where upload progress is recorded, defaults to uploads.json in the cache dir
+            http: What requests are sent with, such as a ConnectionPool, defaults to the requests module
+            metrics (RunMetrics): Where the retries are counted, if given
+            progress (UploadProgress): What the bytes sent are reported to, if given
+        Attributes:
+            self.logger: For logging.
+            self.upload_url (str): The URL chunks are posted to
+            self.galaxy_key (str): The API key of an instance of Galaxy
+            self.chunk_size (int): The number of bytes sent per request
+            self.retries (int): The number of times a failed chunk is re-sent before giving up
+            self.journal (JsonStore): Where upload progress is recorded
+            self.http: What requests are sent with
+            self.metrics (RunMetrics): Where the retries are counted, or None
+            self.progress (UploadProgress): What the bytes sent are reported to, or None
+        """
+        self.logger = logging.getLogger('gflow.ChunkedUploader')
+        self.upload_url = galaxy_url.rstrip('/') + '/api/upload'
+        self.galaxy_key = galaxy_key
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.journal = journal if journal is not None else JsonStore.in_cache_dir('uploads.json')
+        self.http = http if http is not None else requests
+        self.metrics = metrics
+        self.progress = progress
+
+    @staticmethod
+    def journal_key(path):
+        """
+        Identify a version of a local file
+
+        Args:
+            path (str): The file to identify
+        Returns:
+            key (str): The absolute path, size and modification time of the file
+        """
+        stat = os.stat(path)
+        return '%s|%d|%d' % (os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+
+    def upload(self, path, gi, history_id):
+        """
+        Upload a local file into a history, resuming an earlier interrupted upload if there is one
+
+        Args:
+            path (str): The file to upload
+            gi (GalaxyInstance): The instance of Galaxy to upload the file to
+            history_id (str): The ID of the history the dataset will be created in
+        Returns:
+            dataset_id (str): The ID of the new history dataset
+        """
+        key = self.journal_key(path)
+        size = os.path.getsize(path)
+        entry = self.journal.get(key)
+        if entry and entry['chunk_size'] == self.chunk_size:
+            self.logger.info("Resuming upload of '%s' at byte %d of %d" % (path, entry['offset'], size))
+        else:
+            entry = {'session_id': uuid.uuid4().hex, 'offset': 0, 'chunk_size': self.chunk_size}
+            self.journal.set(key, entry)
+        try:
+            self.send_chunks(path, size, key, entry)
+        except ValueError:
+            self.logger.warning("Galaxy no longer holds the partial upload of '%s', starting over" % path)
+            entry = {'session_id': uuid.uuid4().hex, 'offset': 0, 'chunk_size': self.chunk_size}
+            self.journal.set(key, entry)
+            self.send_chunks(path, size, key, entry)
+        name = os.path.basename(path)
+        inputs = {
+            'file_type': 'auto',
+            'dbkey': '?',
+            'files_0|type': 'upload_dataset',
+            'files_0|NAME': name,
+            'files_0|file_data': {'session_id': entry['session_id'], 'name': name},
+        }
+        out_dict = gi.gi.tools.run_tool(history_id, 'upload1', inputs)
+        self.journal.delete(key)
+        return out_dict['outputs'][0]['id']
+
+    def send_chunks(self, path, size, key, entry):
+        """
+        Send the rest of a file, recording each acknowledged chunk in the journal and reporting it to self.progress
+
+        Args:
+            path (str): The file being uploaded
+            size (int): The size of the file
+            key (str): The journal key of the file
+            entry (dict): The journal entry of the upload, updated in place
+        Returns:
+            Raises ValueError if Galaxy's copy does not match the journal, IOError if a chunk keeps failing
+                or the file gets shorter than size
+        """
+        token = self.progress.start(path, size, entry['offset']) if self.progress is not None else None
+        complete = False
+        try:
+            with open(path, 'rb') as upload_file:
+                upload_file.seek(entry['offset'])
+                while entry['offset'] < size:
+                    chunk = upload_file.read(self.chunk_size)
+                    if not chunk:
+                        self.logger.error("'%s' shrank to %d bytes while being uploaded, expected %d"
+                                          % (path, entry['offset'], size))
+                        raise IOError("'%s' shrank to %d bytes while being uploaded, expected %d"
+                                      % (path, entry['offset'], size))
+                    self.send_chunk(entry['session_id'], entry['offset'], chunk)
+                    entry['offset'] += len(chunk)
+                    self.journal.set(key, entry)
+                    if token is not None:
+                        self.progress.advance(token, len(chunk))
+                    self.logger.debug("Uploaded %d of %d bytes of '%s'" % (entry['offset'], size, path))
+            complete = True
+        finally:
+            if token is not None:
+                self.progress.finish(token, complete)
+
+    def send_chunk(self, session_id, offset, chunk):
+        """
+        Post one chunk, retrying with exponential backoff
+
+        Galaxy rejects a chunk whose start does not match the size of its partial file. On a retry
+        this means the previous attempt was written even though its reply was lost, so the chunk
+        counts as acknowledged.
+
+        Args:
+            session_id (str): The upload session the chunk belongs to
+            offset (int): The position of the chunk in the file
+            chunk (bytes): The data to send
+        Returns:
+            Raises ValueError if the first attempt is rejected, IOError once all retries are used up
+        """
+        for attempt in range(0, self.retries + 1):
+            try:
+                response = self.http.post(self.upload_url, params={'key': self.galaxy_key},
+                                          data={'session_id': session_id, 'session_start': offset},
+                                          files={'session_chunk': ('chunk', chunk)})
+            except requests.exceptions.RequestException as e:
+                self.logger.warning("Chunk at byte %d failed: %s" % (offset, e))
+            else:
+                if response.status_code == 200:
+                    return
+                if 'Incorrect session start' in response.text:
+                    if attempt > 0:
+                        return
+                    raise ValueError("Incorrect session start %d for upload session '%s'" % (offset, session_id))
+                self.logger.warning("Chunk at byte %d failed with status %d" % (offset, response.status_code))
+            if attempt < self.retries:
+                if self.metrics is not None:
+                    self.metrics.add('upload_retries')
+                time.sleep(min(2 ** attempt, 60))
+        self.logger.error("Giving up on chunk at byte %d after %d retries" % (offset, self.retries))
+        raise IOError("Giving up on chunk at byte %d after %d retries" % (offset, self.retries))
@@ -0,0 +1,180 @@
+import csv
+import logging
+
+from bioblend.galaxy import dataset_collections as collections
+
+
+COLLECTION_TYPES = ('list', 'list:paired', 'list:list')
+PAIR_ROLES = ('forward', 'reverse')
+
+
+class CollectionBuilder(object):
+    def __init__(self, collection_type, entries):
+        """
+        Assemble the elements of a dataset collection as its datasets arrive, in any order
+
+        Only the name and ID of each dataset are kept. An element is built as soon as its dataset
+        arrives, and a paired or nested element as soon as its last dataset arrives.
+
+        Entries may carry an 'element' key naming their element, which defaults to the dataset's
+        name. For 'list:list', each entry needs a 'group' naming the outer element it belongs to.
+        For 'list:paired', entries either all carry a 'group' and a 'pair' of 'forward' or
+        'reverse', or none do and consecutive entries are paired, named after the forward dataset.
+
+        Args:
+            collection_type (str): 'list', 'list:paired' or 'list:list'
+            entries (list): The dataset entries from the config, in collection order
+        Attributes:
+            self.logger: For logging.
+            self.collection_type (str): The type of the collection
+            self.elements (list): The top level elements, None where some of the datasets are still missing
+        """
+        self.logger = logging.getLogger('gflow.CollectionBuilder')
+        if collection_type not in COLLECTION_TYPES:
+            self.logger.error("Dataset collection type must be 'list', 'list:paired' or 'list:list'")
+            raise ValueError("Dataset collection type must be 'list', 'list:paired' or 'list:list'")
+        self.collection_type = collection_type
+        self._element_names = [entry.get('element') for entry in entries]
+        if collection_type == 'list':
+            self._slots = [(i, None) for i in range(0, len(entries))]
+            self._group_names = [None] * len(entries)
+        elif collection_type == 'list:paired':
+            self.plan_pairs(entries)
+        else:
+            self.plan_groups(entries)
+        self.elements = [None] * len(self._group_names)
+        self._pending = {}
+
+    def plan_pairs(self, entries):
+        if not any('group' in entry for entry in entries):
+            if len(entries) % 2:
+                self.logger.error("A list:paired collection needs an even number of datasets, not %d" % len(entries))
+                raise ValueError("A list:paired collection needs an even number of datasets, not %d" % len(entries))
+            self._slots = [(i // 2, PAIR_ROLES[i % 2]) for i in range(0, len(entries))]
+            self._group_names = [None] * (len(entries) // 2)
+            return
+        self.plan_groups(entries)
+        for i in range(0, len(entries)):
+            if entries[i].get('pair') not in PAIR_ROLES:
+                self.logger.error("Dataset '%s' of a list:paired collection needs 'pair' set to 'forward' or 'reverse'"
+                                  % entries[i].get('group'))
+                raise ValueError("Dataset '%s' of a list:paired collection needs 'pair' set to 'forward' or 'reverse'"
+                                 % entries[i].get('group'))
+            self._slots[i] = (self._slots[i][0], entries[i]['pair'])
+        for index in range(0, len(self._group_names)):
+            roles = sorted(role for group, role in self._slots if group == index)
+            if roles != sorted(PAIR_ROLES):
+                self.logger.error("Pair '%s' needs exactly one forward and one reverse dataset"
+                                  % self._group_names[index])
+                raise ValueError("Pair '%s' needs exactly one forward and one reverse dataset"
+                                 % self._group_names[index])
+
+    def plan_groups(self, entries):
+        group_index = {}
+        self._group_names = []
+        self._group_sizes = []
+        self._slots = []
+        for entry in entries:
+            if not entry.get('group'):
+                self.logger.error("Every dataset of a %s collection needs a 'group'" % self.collection_type)
+                raise ValueError("Every dataset of a %s collection needs a 'group'" % self.collection_type)
+            if entry['group'] not in group_index:
+                group_index[entry['group']] = len(self._group_names)
+                self._group_names.append(entry['group'])
+                self._group_sizes.append(0)
+            index = group_index[entry['group']]
+            self._slots.append((index, self._group_sizes[index]))
+            self._group_sizes[index] += 1
+
+    def add(self, index, name, dataset_id):
+        """
+        Place a dataset that has arrived in the history
+
+        Args:
+            index (int): The position of the dataset's entry in the config
+            name (str): The name of the dataset, used when the entry does not name its element
+            dataset_id (str): The ID of the history dataset
+        """
+        group, role = self._slots[index]
+        element = collections.HistoryDatasetElement(name=self._element_names[index] or name, id=dataset_id)
+        if self.collection_type == 'list':
+            self.elements[group] = element
+            return
+        members = self._pending.setdefault(group, {})
+        if self.collection_type == 'list:paired':
+            members[role] = (name, dataset_id)
+            if len(members) == 2:
+                forward, reverse = members['forward'], members['reverse']
+                self.elements[group] = collections.CollectionElement(
+                    name=self._group_names[group] or forward[0],
+                    type='paired',
+                    elements=[
+                        collections.HistoryDatasetElement(name='forward', id=forward[1]),
+                        collections.HistoryDatasetElement(name='reverse', id=reverse[1]),
+                    ]
+                )
+                del self._pending[group]
+        else:
+            members[role] = element
+            if len(members) == self._group_sizes[group]:
+                self.elements[group] = collections.CollectionElement(
+                    name=self._group_names[group],
+                    type='list',
+                    elements=[members[i] for i in range(0, len(members))]
+                )
+                del self._pending[group]
+
+    def description(self, name="DatasetList"):
+        """
+        Describe the collection once every dataset has arrived
+
+        Args:
+            name (str): The name of the new dataset collection
+        Returns:
+            collection_description (CollectionDescription): The description to create the collection from
+        """
+        if any(element is None for element in self.elements):
+            self.logger.error("Dataset collection '%s' is missing datasets" % name)
+            raise RuntimeError("Dataset collection '%s' is missing datasets" % name)
+        return collections.CollectionDescription(name=name, type=self.collection_type, elements=self.elements)
+
+    @staticmethod
+    def read_sheet(samplefile, collection_type):
+        """
+        Read the datasets of a collection from a tab separated sample sheet with a header row
+
+        The columns are 'sample' and 'file' for a list, 'sample', 'forward' and 'reverse' for a
+        list:paired collection, and 'group', 'sample' and 'file' for a list:list collection. Files are local.
+
+        Args:
+            samplefile (str): The name of the sample sheet
+            collection_type (str): The type of the collection
+        Returns:
+            entries (list): The dataset entries, in sample sheet order
+        """
+        logger = logging.getLogger('gflow.CollectionBuilder')
+        columns = {'list': ('sample', 'file'), 'list:paired': ('sample', 'forward', 'reverse'),
+                   'list:list': ('group', 'sample', 'file')}
+        if collection_type not in columns:
+            logger.error("Dataset collection type must be 'list', 'list:paired' or 'list:list'")
+            raise ValueError("Dataset collection type must be 'list', 'list:paired' or 'list:list'")
+        entries = []
+        with open(samplefile, 'r') as tsvfile:
+            reader = csv.DictReader(tsvfile, delimiter='\t')
+            missing = [column for column in columns[collection_type] if column not in (reader.fieldnames or [])]
+            if missing:
+                logger.error("Sample sheet '%s' has no %s column(s)" % (samplefile, str(missing)))
+                raise ValueError("Sample sheet '%s' has no %s column(s)" % (samplefile, str(missing)))
+            for row in reader:
+                if not any(row.values()):
+                    continue
+                if collection_type == 'list:paired':
+                    for role in PAIR_ROLES:
+                        entries.append({'source': 'local', 'dataset_file': row[role], 'group': row['sample'],
+                                        'pair': role})
+                else:
+                    entry = {'source': 'local', 'dataset_file': row['file'], 'element': row['sample']}
+                    if collection_type == 'list:list':
+                        entry['group'] = row['group']
+                    entries.append(entry)
+        return entries
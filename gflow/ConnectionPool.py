@@ -0,0 +1,207 @@
+import contextlib
+import functools
+import logging
+import threading
+
+import requests
+# bioblend.galaxyclient can only be imported once bioblend.galaxy is
+import bioblend.galaxy
+import bioblend.galaxyclient
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+DEFAULT_POOL_SIZE = 10
+
+# Pools by (pool_size, keep_alive, timeout), see shared_pool()
+_shared_pools = {}
+_shared_pool_lock = threading.Lock()
+
+# The pool used by threads outside of any request scope, the one installed last
+_default_pool = None
+
+# The request count and pool of the run the current thread works for, see request_scope()
+_scope = threading.local()
+_scope_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True, timeout=None):
+        """
+        A pool of HTTP connections kept open between requests to Galaxy
+
+        Args:
+            pool_size (int): The number of connections kept open per host
+            keep_alive (bool): Whether connections are reused, if False each request opens a new one
+            timeout (float): Seconds to wait for a connection or a reply, None to wait forever
+        Attributes:
+            self.logger: For logging.
+            self.session (Session): The requests session holding the pool
+            self.timeout (float): Seconds to wait for a connection or a reply
+        """
+        self.logger = logging.getLogger('gflow.ConnectionPool')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._adapter.poolmanager.pool_classes_by_scheme = self._counting_pool_classes()
+        self._connects = 0
+        self._lock = threading.Lock()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def _counting_pool_classes(self):
+        """
+        Make connection pool classes that count every socket they open, including reconnects
+        """
+        pool = self
+
+        def count_connect(connection_class):
+            class CountingConnection(connection_class):
+                def connect(self):
+                    with pool._lock:
+                        pool._connects += 1
+                    return connection_class.connect(self)
+            return CountingConnection
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = count_connect(HTTPConnection)
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = count_connect(HTTPSConnection)
+
+        return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+    def request(self, method, url, **kwargs):
+        scope = current_scope()
+        if scope is not None:
+            with _scope_lock:
+                scope['requests'] += 1
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def __getattr__(self, name):
+        # Anything else bioblend looks up on the requests module, such as requests.exceptions
+        return getattr(requests, name)
+
+    def stats(self):
+        """
+        Count the requests made and connections opened by the pool
+
+        Returns:
+            stats (dict): The number of 'requests', 'new_connections' and 'reused_connections'
+        """
+        pools = self._adapter.poolmanager.pools
+        made = sum(pools[key].num_requests for key in list(pools.keys()))
+        with self._lock:
+            opened = self._connects
+        return {'requests': made, 'new_connections': opened, 'reused_connections': max(made - opened, 0)}
+
+    def install(self):
+        """
+        Make bioblend send its requests through this pool, unless they are made in a request scope with its own pool
+
+        bioblend looks requests up on a module, so what is installed there is a dispatcher shared by the
+        whole process, which picks the pool of the request scope the calling thread is in.
+        """
+        global _default_pool
+        with _shared_pool_lock:
+            _default_pool = self
+            if not isinstance(bioblend.galaxyclient.requests, _PoolDispatcher):
+                bioblend.galaxyclient.requests = _PoolDispatcher()
+
+
+class _PoolDispatcher(object):
+    """
+    Stands in for the requests module in bioblend, sending each request through the pool of the caller's run
+    """
+    def __getattr__(self, name):
+        scope = current_scope()
+        pool = scope.get('pool') if scope is not None else None
+        return getattr(pool or _default_pool or requests, name)
+
+
+def shared_pool(pool_size=DEFAULT_POOL_SIZE, keep_alive=True, timeout=None):
+    """
+    Get the connection pool shared by everything in this process that uses the same settings
+
+    Runs asking for the same settings get the same pool, so connections are reused across runs. A run
+    asking for different settings gets a pool of its own.
+
+    Args:
+        pool_size (int): The number of connections kept open per host
+        keep_alive (bool): Whether connections are reused
+        timeout (float): Seconds to wait for a connection or a reply
+    Returns:
+        pool (ConnectionPool): The shared pool
+    """
+    settings = (pool_size, keep_alive, timeout)
+    with _shared_pool_lock:
+        if settings not in _shared_pools:
+            if _shared_pools:
+                logging.getLogger('gflow.ConnectionPool').info(
+                    "Opening a separate connection pool for pool size %s, keep alive %s and timeout %s" % settings)
+            _shared_pools[settings] = ConnectionPool(pool_size, keep_alive, timeout)
+        return _shared_pools[settings]
+
+
+def current_scope():
+    """
+    Get the request scope the current thread counts its requests in, None outside of request_scope()
+    """
+    return getattr(_scope, 'current', None)
+
+
+@contextlib.contextmanager
+def request_scope(pool=None):
+    """
+    Count the requests a run makes through any pool, apart from those of other runs in the process
+
+    Requests are counted for the thread that entered the scope, and for the worker threads running
+    functions wrapped with carry_scope(). If a pool is given, the requests bioblend makes in the
+    scope go through it.
+
+    Args:
+        pool (ConnectionPool): The pool of the run, None for the one installed last
+    Returns:
+        scope (dict): Its 'requests' count, updated as requests are made, and its 'pool'
+    """
+    previous = current_scope()
+    _scope.current = {'requests': 0, 'pool': pool}
+    try:
+        yield _scope.current
+    finally:
+        _scope.current = previous
+
+
+def carry_scope(func):
+    """
+    Wrap a function so that it counts its requests in the caller's request scope, whichever thread runs it
+    """
+    scope = current_scope()
+
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        previous = current_scope()
+        _scope.current = scope
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _scope.current = previous
+    return call
@@ -0,0 +1,123 @@
+import logging
+import re
+
+import requests
+from bioblend.galaxy.client import ConnectionError
+
+from gflow.JsonStore import JsonStore
+
+
+class DatasetCache(object):
+    def __init__(self, galaxy_url, store=None):
+        """
+        Remember which Galaxy dataset holds the content of a local file
+
+        Entries map the content hash of a file to a history dataset ('hda') or library dataset
+        ('library') on one Galaxy instance, so later runs can import the existing dataset by
+        reference instead of uploading the file again.
+
+        Args:
+            galaxy_url (str): The URL of the instance of Galaxy the datasets live on
+            store (JsonStore): Where entries are kept, defaults to datasets.json in the cache dir
+        Attributes:
+            self.logger: For logging.
+            self.galaxy_url (str): The URL of the instance of Galaxy the datasets live on
+            self.store (JsonStore): Where entries are kept
+        """
+        self.logger = logging.getLogger('gflow.DatasetCache')
+        self.galaxy_url = galaxy_url.rstrip('/')
+        self.store = store if store is not None else JsonStore.in_cache_dir('datasets.json')
+
+    def key(self, digest):
+        return '%s|%s' % (self.galaxy_url, digest)
+
+    def remember(self, digest, src, dataset_id, library_id=None):
+        """
+        Record the dataset holding the content with the given digest
+
+        Args:
+            digest (str): The content hash of the file
+            src (str): Either 'hda' or 'library'
+            dataset_id (str): The ID of the history or library dataset
+            library_id (str): The ID of the library, for 'library' entries
+        """
+        self.store.set(self.key(digest), {'src': src, 'id': dataset_id, 'library_id': library_id})
+
+    def forget(self, digest):
+        self.store.delete(self.key(digest))
+
+    def lookup(self, gi, digest):
+        """
+        Find a usable dataset for the given content, dropping the entry if it has been deleted or purged
+
+        The entry is only dropped when Galaxy says the dataset is gone, with a 4xx reply or a deleted,
+        purged or failed dataset. If Galaxy cannot be asked, the entry is returned unchecked.
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the dataset lives on
+            digest (str): The content hash of the file
+        Returns:
+            entry (dict): The cache entry if the dataset is still available, None otherwise
+        """
+        entry = self.store.get(self.key(digest))
+        if not entry:
+            return None
+        try:
+            if entry['src'] == 'library':
+                info = gi.gi.libraries.show_dataset(entry['library_id'], entry['id'])
+            else:
+                info = gi.gi.datasets.show_dataset(entry['id'])
+        except (ConnectionError, ValueError, requests.exceptions.RequestException) as e:
+            status = self.http_status(e)
+            if status is None or not 400 <= status < 500:
+                # A timeout or server error says nothing about the dataset, so it is not uploaded again
+                self.logger.warning("Could not check cached dataset '%s', using it anyway: %s" % (entry['id'], e))
+                return entry
+            info = None
+        if not info or info.get('deleted') or info.get('purged') or info.get('state') in ('error', 'discarded'):
+            self.logger.info("Cached dataset '%s' is no longer available, forgetting it" % entry['id'])
+            self.forget(digest)
+            return None
+        return entry
+
+    @staticmethod
+    def http_status(error):
+        """
+        Get the HTTP status code Galaxy replied with from an error raised by bioblend
+
+        Args:
+            error (Exception): The error
+        Returns:
+            status (int): The status code, None if Galaxy sent no reply
+        """
+        status = getattr(error, 'status_code', None)
+        if status is None and getattr(error, 'response', None) is not None:
+            status = error.response.status_code
+        if status is None:
+            # Older bioblend only gives the status in the message, such as "GET: error 404: ..."
+            match = re.search(r'error (\d{3})\b|status code: (\d{3})\b|from galaxy: (\d{3})\b', str(error))
+            if match:
+                status = int(next(group for group in match.groups() if group))
+        return status
+
+    def import_cached(self, gi, history, digest):
+        """
+        Import the cached dataset for the given content into a history
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the dataset lives on
+            history (History): The history that the data will be imported to
+            digest (str): The content hash of the file
+        Returns:
+            dataset (HistoryDatasetAssociation): The imported dataset, None if nothing usable is cached
+        """
+        entry = self.lookup(gi, digest)
+        if entry is None:
+            return None
+        if entry['src'] == 'library':
+            res = gi.gi.histories.upload_dataset_from_library(history.id, entry['id'])
+        else:
+            res = gi.gi.make_post_request('%s/histories/%s/contents' % (gi.gi.url, history.id),
+                                          {'source': 'hda', 'content': entry['id']})
+        self.logger.info("Imported cached dataset '%s' instead of uploading" % entry['id'])
+        return history.get_dataset(res['id'])
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from gflow.JsonStore import JsonStore
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Fingerprinter(object):
+    def __init__(self, store=None, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Compute content digests of local files, remembering them between runs
+
+        A digest is reused for as long as the file's size, modification time and inode are unchanged,
+        so unchanged inputs are only ever read once.
+
+        Args:
+            store (JsonStore): Where digests are kept, defaults to fingerprints.json in the cache dir
+            block_size (int): The number of bytes hashed at a time
+        Attributes:
+            self.logger: For logging.
+            self.store (JsonStore): Where digests are kept
+            self.block_size (int): The number of bytes hashed at a time
+        """
+        self.logger = logging.getLogger('gflow.Fingerprinter')
+        self.store = store if store is not None else JsonStore.in_cache_dir('fingerprints.json')
+        self.block_size = block_size
+
+    @staticmethod
+    def stat_key(path):
+        """
+        Describe the version of a file a digest was computed for
+
+        Args:
+            path (str): The file to describe
+        Returns:
+            key (list): The size, modification time and inode of the file
+        """
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+    @staticmethod
+    def hash_file(path, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Compute the SHA-1 digest of a file through a read-only memory map
+
+        Only block_size bytes are copied out of the map at a time. Files that cannot be mapped
+        are read in block_size chunks instead.
+
+        Args:
+            path (str): The file to hash
+            block_size (int): The number of bytes hashed at a time
+        Returns:
+            digest (str): The hex digest of the file's content
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as data_file:
+            size = os.fstat(data_file.fileno()).st_size
+            try:
+                mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+            except (ValueError, EnvironmentError):
+                mapped = None
+            if mapped is not None:
+                try:
+                    for start in range(0, size, block_size):
+                        sha1.update(mapped[start:start + block_size])
+                finally:
+                    mapped.close()
+            else:
+                for block in iter(lambda: data_file.read(block_size), b''):
+                    sha1.update(block)
+        return sha1.hexdigest()
+
+    def digest(self, path):
+        """
+        Get the digest of a file, hashing it only if it changed since it was last hashed
+
+        Args:
+            path (str): The file to fingerprint
+        Returns:
+            digest (str): The hex digest of the file's content
+        """
+        path = os.path.abspath(path)
+        stat_key = self.stat_key(path)
+        entry = self.store.get(path)
+        if entry and entry['stat'] == stat_key:
+            return entry['digest']
+        self.logger.info("Hashing '%s'" % path)
+        digest = self.hash_file(path, self.block_size)
+        self.store.set(path, {'stat': stat_key, 'digest': digest})
+        return digest
+
+    def digest_all(self, paths, workers=None):
+        """
+        Get the digests of several files, hashing them in parallel
+
+        hashlib releases the interpreter lock while hashing large blocks, so a thread pool spreads
+        the work over all cores.
+
+        Args:
+            paths (list): The files to fingerprint
+            workers (int): The number of files hashed at once, defaults to the number of cores
+        Returns:
+            digests (dict): The digest of each path
+        """
+        paths = list(set(paths))
+        if len(paths) <= 1:
+            return dict((path, self.digest(path)) for path in paths)
+        pool = ThreadPool(min(workers or multiprocessing.cpu_count(), len(paths)))
+        try:
+            return dict(zip(paths, pool.map(self.digest, paths)))
+        finally:
+            pool.terminate()
@@ -1,9 +1,114 @@
 import json
 import logging
+import os
+import threading
 import yaml
 
+from multiprocessing.pool import ThreadPool
+
+from bioblend.galaxy.client import ConnectionError
 from bioblend.galaxy.objects import GalaxyInstance
-from bioblend.galaxy import dataset_collections as collections
+from bioblend.galaxy.objects import wrappers
+
+from gflow.ChunkedUploader import ChunkedUploader, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNKED_UPLOAD_THRESHOLD, \
+    DEFAULT_UPLOAD_RETRIES
+from gflow.CollectionBuilder import CollectionBuilder
+from gflow.ConnectionPool import shared_pool, request_scope, carry_scope, DEFAULT_POOL_SIZE
+from gflow.DatasetCache import DatasetCache
+from gflow.Fingerprinter import Fingerprinter
+from gflow.HistoryMonitor import HistoryMonitor, DEFAULT_POLL_INTERVAL, DEFAULT_MAX_POLL_INTERVAL
+from gflow.JsonStore import JsonStore
+from gflow.LocalWorkflow import LocalWorkflow
+from gflow.PathExpander import expand_entry
+from gflow.RunManifest import RunManifest
+from gflow.RunMetrics import RunMetrics
+from gflow.RuntimeParamIndex import RuntimeParamIndex
+from gflow.UploadProgress import UploadProgress, DEFAULT_PROGRESS_INTERVAL
+from gflow.WorkflowAnalyzer import find_runtime_values, unset_runtime_values, describe_runtime_values
+from gflow.WorkflowCache import WorkflowCache
+
+
+# Optional tuning settings and the values used when they are not in the config
+DEFAULT_SETTINGS = {
+    'max_parallel_uploads': 4,
+    'max_parallel_library_copies': 4,
+    'max_urls_per_request': 100,
+    'server_path_library': None,
+    'library_imported_only': False,
+    'upload_chunk_size': DEFAULT_CHUNK_SIZE,
+    'chunked_upload_threshold': DEFAULT_CHUNKED_UPLOAD_THRESHOLD,
+    'upload_retries': DEFAULT_UPLOAD_RETRIES,
+    'progress_interval': DEFAULT_PROGRESS_INTERVAL,
+    'cache_dir': None,
+    'use_dataset_cache': True,
+    'use_workflow_cache': True,
+    'wait_poll_interval': DEFAULT_POLL_INTERVAL,
+    'wait_max_poll_interval': DEFAULT_MAX_POLL_INTERVAL,
+    'wait_timeout': None,
+    'http_pool_size': DEFAULT_POOL_SIZE,
+    'http_keep_alive': True,
+    'http_timeout': None,
+}
+
+# The URLs Galaxy's upload tool can fetch
+URL_SCHEMES = ('http://', 'https://', 'ftp://')
+
+
+def parallel_imap(func, items, workers):
+    """
+    Apply func to every item using a pool of worker threads, yielding each result as soon as it is ready
+
+    The first exception raised by func is re-raised once the items already being processed are done,
+    and any work that has not started yet is abandoned. The same happens when the generator is closed.
+
+    Args:
+        func (function): The function to apply to each item
+        items (iterable): The items to process
+        workers (int): The maximum number of items processed at once
+    Returns:
+        results (generator): An (index of the item, result) tuple per item, in order of completion
+    """
+    items = list(items)
+    if not workers or workers <= 1 or len(items) <= 1:
+        for index in range(0, len(items)):
+            yield index, func(items[index])
+        return
+    abandoned = threading.Event()
+
+    def call(pair):
+        if abandoned.is_set():
+            return pair[0], None
+        return pair[0], func(pair[1])
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for index, result in pool.imap_unordered(carry_scope(call), enumerate(items)):
+            yield index, result
+    finally:
+        abandoned.set()
+        pool.close()
+        pool.join()
+
+
+def parallel_map(func, items, workers):
+    """
+    Apply func to every item using a pool of worker threads
+
+    Results are returned in the same order as items. The first exception raised by func
+    is re-raised immediately and any work that has not started yet is abandoned.
+
+    Args:
+        func (function): The function to apply to each item
+        items (iterable): The items to process
+        workers (int): The maximum number of items processed at once
+    Returns:
+        results (List): The result of func for each item, in input order
+    """
+    items = list(items)
+    results = [None] * len(items)
+    for index, result in parallel_imap(func, items, workers):
+        results[index] = result
+    return results
 
 
 class GalaxyCMDWorkflow(object):
@@ -24,6 +129,29 @@ class GalaxyCMDWorkflow(object):
             self.datasets (dict): A collection of filenames or URLs for the datasets
             self.runtime_params (dict): A collection of required runtime parameters
             self.library_name (str): The name of the library to be created
+            self.max_parallel_uploads (int): The maximum number of datasets imported at once
+            self.max_parallel_library_copies (int): The maximum number of datasets copied to the library at once
+            self.max_urls_per_request (int): The most URLs Galaxy is asked to fetch in one upload request
+            self.server_path_library (str): The library server paths are linked into, '<history_name> server paths'
+                if None
+            self.library_imported_only (bool): Whether only the datasets gflow imported are copied to the library
+            self.upload_chunk_size (int): The number of bytes sent per request by chunked uploads
+            self.chunked_upload_threshold (int): Local files of at least this many bytes are uploaded in chunks
+            self.upload_retries (int): The number of times a failed chunk is re-sent before giving up
+            self.progress_interval (float): The least number of seconds between two upload progress reports
+            self.cache_dir (str): Where upload journals and caches are kept, defaults to ~/.cache/gflow
+            self.use_dataset_cache (bool): Whether local files already in Galaxy are imported instead of uploaded
+            self.use_workflow_cache (bool): Whether a local workflow imported before is reused instead of re-imported
+            self.workflow_reused (bool): Whether import_workflow returned a previously imported workflow
+            self.wait_poll_interval (float): Seconds before the second poll of a history being waited on
+            self.wait_max_poll_interval (float): The longest delay between polls of a history, in seconds
+            self.wait_timeout (float): Seconds to wait for a history before giving up, never if None
+            self.http_pool_size (int): The number of HTTP connections kept open to Galaxy
+            self.http_keep_alive (bool): Whether HTTP connections are reused between requests
+            self.http_timeout (float): Seconds to wait for a connection or reply from Galaxy, forever if None
+            self.history_state (str): 'ok' or 'error' once run() has waited for the workflow, None before
+            self.metrics (RunMetrics): Stage times and counts of API calls, uploaded bytes and retries of the runs
+            self.upload_progress (UploadProgress): Reports the progress and throughput of local file uploads
         """
         self.logger = logging.getLogger('gflow.GalaxyCMDWorkflow')
         self.galaxy_url = datadict['galaxy_url']
@@ -54,6 +182,24 @@ class GalaxyCMDWorkflow(object):
         except KeyError as e:
             unset_params.append('library_name')
         self.logger.warning("Parameter(s) not set: %s" % str(unset_params))
+        for key, default in DEFAULT_SETTINGS.items():
+            value = datadict.get(key)
+            setattr(self, key, default if value is None else value)
+        self._chunked_uploader = None
+        self._dataset_cache = None
+        self._fingerprinter = None
+        self._workflow_cache = None
+        self._local_workflow = None
+        self._collection_entries = None
+        self._staging_library = None
+        self.workflow_reused = False
+        self.history_state = None
+        self.metrics = RunMetrics()
+        self.upload_progress = UploadProgress(self.metrics, self.progress_interval)
+        self._uploaded_digests = {}
+        self._imported_dataset_ids = []
+        self._abandoned = threading.Event()
+        self._lock = threading.Lock()
 
 
     @classmethod
@@ -64,6 +210,18 @@ class GalaxyCMDWorkflow(object):
         Args:
             configfile (str): The name of the config file to be read
         """
+        return cls(cls.load_config_file(configfile))
+
+    @classmethod
+    def load_config_file(cls, configfile):
+        """
+        Read a config file and check that it has all required parameters
+
+        Args:
+            configfile (str): The name of the config file to be read
+        Returns:
+            config (dict): The configuration parameters
+        """
         cls.logger = logging.getLogger('gflow.GalaxyCMDWorkflow')
         cls.logger.info("Reading configuration file")
         with open(configfile, "r") as ymlfile:
@@ -76,11 +234,12 @@ class GalaxyCMDWorkflow(object):
         except KeyError as e:
             cls.logger.error("Missing required parameter %s" % str(e))
             raise KeyError("Missing required parameter %s" % str(e))
-        return cls(config)
+        return config
 
     @classmethod
     def init_from_params(cls, galaxy_url, galaxy_key, history_name, workflow_source, workflow,
-                         dataset_collection=None, datasets=None, runtime_params=None, library_name=None):
+                         dataset_collection=None, datasets=None, runtime_params=None, library_name=None,
+                         max_parallel_uploads=None, **settings):
         """
         Makes GFlow object from provided parameters
 
@@ -94,13 +253,16 @@ class GalaxyCMDWorkflow(object):
             datasets (dict): A collection of filenames or URLs for the datasets
             runtime_params (dict): A collection of required runtime parameters
             library_name (str): The name of the library to be created
+            max_parallel_uploads (int): The maximum number of datasets imported at once
+            settings: Any other of the tuning settings in DEFAULT_SETTINGS
         """
         cls.logger = logging.getLogger('gflow.GalaxyCMDWorkflow')
         cls.logger.info("Reading from parameters")
         config = {'galaxy_url': galaxy_url, 'galaxy_key': galaxy_key,
                   'history_name': history_name, 'workflow_source': workflow_source, 'workflow': workflow,
                   'dataset_collection': dataset_collection, 'datasets': datasets, 'runtime_params': runtime_params,
-                  'library_name': library_name}
+                  'library_name': library_name, 'max_parallel_uploads': max_parallel_uploads}
+        config.update(settings)
         return cls(config)
 
     @staticmethod
@@ -124,37 +286,164 @@ class GalaxyCMDWorkflow(object):
         Check if any runtime parameters are required for the workflow
 
         Args:
-            workflow (Workflow): The Workflow object containing the tool information
+            workflow: The Workflow object, or the workflow dict from Galaxy or a .ga file
         Returns:
-            Name of parameter if runtime parameter is required, None otherwise
-        """
-        for step in workflow.sorted_step_ids():
-            values = workflow.steps[step].tool_inputs.viewvalues()
-            for i in values:
-                if isinstance(i, dict):
-                    more_values = i.viewvalues()
-                    for j in more_values:
-                        if str(j) == "RuntimeValue":
-                            return [key for key, value in workflow.steps[step].tool_inputs.iteritems() if value == i]
-        return None
+            A (step ID, step label, parameter path) tuple per required runtime parameter, None if there are none
+        """
+        return find_runtime_values(workflow) or None
 
-    def import_workflow(self, gi):
+    def check_runtime_params(self, workflow):
+        """
+        Make sure the runtime parameters in the config cover every parameter the workflow leaves unset
+
+        Args:
+            workflow: The Workflow or LocalWorkflow object, or the workflow dict from Galaxy or a .ga file
+        Returns:
+            Raises RuntimeError listing every missing runtime parameter, ValueError if a 'step' matches
+            no step, None otherwise
+        """
+        self.logger.info("Checking for missing tool parameters")
+        missing = unset_runtime_values(workflow, self.runtime_params)
+        if missing:
+            self.logger.error("Missing runtime parameter(s): %s" % describe_runtime_values(missing))
+            raise RuntimeError("Missing runtime parameter(s): %s" % describe_runtime_values(missing))
+
+    def preflight(self, workflow=None):
+        """
+        Check everything that can be checked before anything is written to Galaxy
+
+        The dataset entries, the local files and their sizes, the pairing of a list:paired collection,
+        the input labels and the runtime parameters are all checked. Without a workflow, a local workflow
+        file is checked against, while the labels and parameters of a workflow given by ID are left for a
+        later call with the workflow fetched from Galaxy.
+
+        Args:
+            workflow: The workflow to check input labels and runtime parameters against, such as a Workflow
+        Returns:
+            Raises ValueError, KeyError, IOError or RuntimeError on the first problem found, None otherwise
+        """
+        if workflow is None:
+            if self.workflow_source == 'local':
+                workflow = self.local_workflow
+            elif self.workflow_source != 'id':
+                self.logger.error("Workflow source must be either 'local' or 'id'")
+                raise ValueError("Workflow source must be either 'local' or 'id'")
+        entries = []
+        labels = []
+        if self.dataset_collection:
+            for key in ('input_label', 'type'):
+                if not self.dataset_collection.get(key):
+                    self.logger.error("Missing value for '%s' in dataset_collection" % key)
+                    raise KeyError("Missing value for '%s' in dataset_collection" % key)
+            collection_datasets = self.collection_entries()
+            if not collection_datasets:
+                self.logger.error("Missing value for 'datasets' in dataset_collection")
+                raise KeyError("Missing value for 'datasets' in dataset_collection")
+            CollectionBuilder(self.dataset_collection['type'], collection_datasets)
+            entries.extend(collection_datasets)
+            labels.append(self.dataset_collection['input_label'])
+        if self.datasets:
+            for i in range(0, len(self.datasets)):
+                if not self.datasets[i].get('input_label'):
+                    self.logger.error("Missing value for 'input_label' in dataset %s" % i)
+                    raise KeyError("Missing value for 'input_label' in dataset %s" % i)
+                entries.append(self.datasets[i])
+                labels.append(self.datasets[i]['input_label'])
+        total_size = 0
+        for entry in entries:
+            total_size += self.verify_dataset_entry(entry)
+        self.logger.info("Pre-flight: %d dataset(s), %d byte(s) of local files to import" % (len(entries), total_size))
+        if workflow is not None:
+            self.verify_input_labels(workflow, labels)
+            self.check_runtime_params(workflow)
+
+    def verify_workflow(self, workflow):
+        """
+        Check a workflow obtained from Galaxy before it is used
+
+        Args:
+            workflow (Workflow): The workflow
+        Returns:
+            Raises RuntimeError if tools are missing or a check of preflight() fails, None otherwise
+        """
+        if not workflow.is_runnable:
+            self.logger.error("Workflow not runnable, missing required tools")
+            raise RuntimeError("Workflow not runnable, missing required tools")
+        if self.workflow_source != 'local':
+            self.preflight(workflow)
+
+    def verify_dataset_entry(self, dataset):
+        """
+        Check that a dataset entry has what its source needs and that a local file can be uploaded
+
+        Args:
+            dataset (dict): The dataset entry from the config file
+        Returns:
+            size (int): The size of the local file, 0 for other sources
+        """
+        required = {'local': ('dataset_file',), 'library': ('library_id', 'dataset_id'), 'url': ('url',),
+                    'server_path': ('path',)}
+        for key in required.get(dataset.get('source'), ()):
+            if not dataset.get(key):
+                self.logger.error("Missing value for '%s' in %s dataset entry" % (key, dataset['source']))
+                raise KeyError("Missing value for '%s' in %s dataset entry" % (key, dataset['source']))
+        self.verify_dataset_source(dataset)
+        if dataset['source'] != 'local':
+            return 0
+        size = os.path.getsize(dataset['dataset_file'])
+        if size == 0:
+            self.logger.error("Dataset file '%s' is empty" % dataset['dataset_file'])
+            raise ValueError("Dataset file '%s' is empty" % dataset['dataset_file'])
+        return size
+
+    def verify_input_labels(self, workflow, labels):
+        """
+        Check that every input label in the config belongs to an input step of the workflow
+
+        Args:
+            workflow: The Workflow or LocalWorkflow object
+            labels (list): The input labels from the config
+        Returns:
+            Raises ValueError if a label matches no input step, None otherwise
+        """
+        known = workflow.input_labels_to_ids
+        unknown = [label for label in labels if label not in known]
+        if unknown:
+            self.logger.error("Input label(s) %s not found in the workflow, its inputs are %s"
+                              % (str(unknown), str(sorted(known))))
+            raise ValueError("Input label(s) %s not found in the workflow, its inputs are %s"
+                             % (str(unknown), str(sorted(known))))
+        unused = sorted(set(known) - set(labels))
+        if unused:
+            self.logger.warning("Workflow input(s) %s are not given a dataset" % str(unused))
+
+    def import_workflow(self, gi, temp_wf=False):
         """
         Import a workflow into an instance of Galaxy
 
+        A local workflow whose content was imported before is reused when it still exists in Galaxy,
+        in which case self.workflow_reused is set.
+
         Args:
             gi (GalaxyInstance): The instance of Galaxy to import the workflow to
+            temp_wf (bool): Flag for a workflow that will be deleted after use, so it is not cached
         Returns:
             wf (Workflow): The workflow object created
         """
+        self.workflow_reused = False
         if self.workflow_source == 'local':
-            try:
-                with open(self.workflow) as json_file:
-                    workflow = json.load(json_file)
-                wf = gi.workflows.import_new(workflow)
-            except IOError as e:
-                self.logger.error(e)
-                raise IOError(e)
+            workflow = self.load_workflow_file()
+            if not self.use_workflow_cache:
+                return gi.workflows.import_new(workflow)
+            digest = WorkflowCache.canonical_hash(workflow)
+            wf = self.workflow_cache.lookup(gi, digest)
+            if wf is not None:
+                self.logger.info("Reusing previously imported workflow '%s'" % wf.id)
+                self.workflow_reused = True
+                return wf
+            wf = gi.workflows.import_new(workflow)
+            if not temp_wf:
+                self.workflow_cache.remember(digest, wf.id)
         elif self.workflow_source == 'id':
             wf = gi.workflows.get(self.workflow)
         else:
@@ -162,6 +451,35 @@ class GalaxyCMDWorkflow(object):
             raise ValueError("Workflow source must be either 'local' or 'id'")
         return wf
 
+    def load_workflow_file(self):
+        """
+        Read the local workflow file
+
+        Returns:
+            workflow (dict): The workflow as loaded from the .ga file
+        """
+        try:
+            with open(self.workflow) as json_file:
+                return json.load(json_file)
+        except IOError as e:
+            self.logger.error(e)
+            raise IOError(e)
+
+    @property
+    def local_workflow(self):
+        """
+        The parsed local workflow file, read once unless an already parsed one was set
+        """
+        with self._lock:
+            if self._local_workflow is None:
+                self._local_workflow = LocalWorkflow.from_file(self.workflow)
+        return self._local_workflow
+
+    @local_workflow.setter
+    def local_workflow(self, local_workflow):
+        with self._lock:
+            self._local_workflow = local_workflow
+
     def import_datasets(self, data_group_type, gi, history):
         """
         Import the datasets into a history of an instance of Galaxy
@@ -174,63 +492,468 @@ class GalaxyCMDWorkflow(object):
             results (List): List of datasets imported into the history
         """
         if data_group_type == 'datasets':
-            datasets = self.datasets
+            datasets = [self.datasets[i] for i in range(0, len(self.datasets))]
         elif data_group_type == 'dataset_collection':
-            datasets = self.dataset_collection['datasets']
+            datasets = self.collection_entries()
         else:
             self.logger.error("Data group type must be 'datasets' or 'dataset_collection'")
             raise ValueError("Data group type must be 'datasets' or 'dataset_collection'")
-        results = []
-        for i in range(0, len(datasets)):
-            if datasets[i]['source'] == 'local':
-                self.logger.info("Importing dataset from file: '%s'" % datasets[i]['dataset_file'])
-                try:
-                    results.append(history.upload_dataset(datasets[i]['dataset_file']))
-                except IOError as e:
-                    self.logger.error("Dataset file '%s' does not exist" % datasets[i]['dataset_file'])
-                    raise IOError("Dataset file '%s' does not exist" % datasets[i]['dataset_file'])
-            elif datasets[i]['source'] == 'library':
-                self.logger.info("Importing dataset: '%s' from library: '%s'" % (datasets[i]['dataset_id'],
-                                  datasets[i]['library_id']))
-                lib = gi.libraries.get(datasets[i]['library_id'])
-                dataset = lib.get_dataset(datasets[i]['dataset_id'])
-                results.append(history.import_dataset(dataset))
+        results = [None] * len(datasets)
+        for index, dataset in self.iter_import_datasets(datasets, gi, history):
+            results[index] = dataset
+        return results
+
+    def iter_import_datasets(self, datasets, gi, history):
+        """
+        Import dataset entries into a history, yielding each dataset as soon as it is in the history
+
+        Args:
+            datasets (list): The dataset entries from the config file
+            gi (GalaxyInstance): The instance of Galaxy to import the data to
+            history (History): The history that the data will be imported to
+        Returns:
+            results (generator): An (index of the entry, HistoryDatasetAssociation) tuple per entry,
+                in order of completion
+        """
+        for dataset in datasets:
+            self.verify_dataset_source(dataset)
+        if self.use_dataset_cache:
+            self.fingerprinter.digest_all([dataset['dataset_file'] for dataset in datasets
+                                           if dataset['source'] == 'local'])
+        self.find_library_datasets(gi, [dataset for dataset in datasets if dataset['source'] == 'library'])
+        # Galaxy fetches URLs and links server paths itself in a few requests, made before the uploads start
+        batched = {'url': self.fetch_url_datasets, 'server_path': self.link_server_datasets}
+        importers = [([i for i in range(0, len(datasets)) if datasets[i]['source'] == source], batched[source])
+                     for source in ('url', 'server_path')]
+        importers.append(([i for i in range(0, len(datasets)) if datasets[i]['source'] not in batched],
+                          self.upload_datasets))
+        for indexes, importer in importers:
+            if not indexes:
+                continue
+            for index, result in importer([datasets[i] for i in indexes], gi, history):
+                with self._lock:
+                    self._imported_dataset_ids.append(result.id)
+                self.metrics.add('datasets_imported')
+                yield indexes[index], result
+
+    def upload_datasets(self, datasets, gi, history):
+        """
+        Import local and library dataset entries into a history, max_parallel_uploads at a time
+
+        Args:
+            datasets (list): The dataset entries from the config file
+            gi (GalaxyInstance): The instance of Galaxy to import the data to
+            history (History): The history that the data will be imported to
+        Returns:
+            results (generator): An (index of the entry, HistoryDatasetAssociation) tuple per entry,
+                in order of completion
+        """
+        self.logger.info("Importing %d dataset(s) with up to %d parallel upload(s)"
+                         % (len(datasets), self.max_parallel_uploads))
+        return parallel_imap(lambda dataset: self.import_dataset(dataset, gi, history), datasets,
+                             self.max_parallel_uploads)
+
+    def collection_entries(self):
+        """
+        The dataset entries of self.dataset_collection, in collection order
+
+        Entries with a 'pattern' or 'directory' are expanded into one entry per matching file.
+        The file system is only walked once, later calls return the same entries.
+
+        Returns:
+            entries (list): The entries listed under 'datasets', or read from the collection's 'sample_sheet'
+        """
+        if self._collection_entries is not None and self._collection_entries[0] is self.dataset_collection:
+            return self._collection_entries[1]
+        if self.dataset_collection.get('sample_sheet'):
+            entries = CollectionBuilder.read_sheet(self.dataset_collection['sample_sheet'],
+                                                   self.dataset_collection['type'])
+        else:
+            datasets = self.dataset_collection.get('datasets') or {}
+            entries = []
+            for i in range(0, len(datasets)):
+                if 'pattern' in datasets[i] or 'directory' in datasets[i]:
+                    entries.extend(expand_entry(datasets[i], self.dataset_collection.get('type')))
+                else:
+                    entries.append(datasets[i])
+        self._collection_entries = (self.dataset_collection, entries)
+        return entries
+
+    def verify_dataset_source(self, dataset):
+        """
+        Check that a dataset entry can be imported before any upload is started
+
+        Args:
+            dataset (dict): The dataset entry from the config file
+        Returns:
+            Raises ValueError if the source is unknown or a URL is not one Galaxy can fetch,
+            IOError if a local file is missing, None otherwise
+        """
+        if dataset['source'] == 'local':
+            if not os.path.isfile(dataset['dataset_file']):
+                self.logger.error("Dataset file '%s' does not exist" % dataset['dataset_file'])
+                raise IOError("Dataset file '%s' does not exist" % dataset['dataset_file'])
+        elif dataset['source'] == 'url':
+            if not dataset['url'].startswith(URL_SCHEMES):
+                self.logger.error("Dataset URL '%s' must start with http://, https:// or ftp://" % dataset['url'])
+                raise ValueError("Dataset URL '%s' must start with http://, https:// or ftp://" % dataset['url'])
+        elif dataset['source'] == 'server_path':
+            if not os.path.isabs(dataset['path']):
+                self.logger.error("Server path '%s' must be absolute" % dataset['path'])
+                raise ValueError("Server path '%s' must be absolute" % dataset['path'])
+        elif dataset['source'] != 'library':
+            self.logger.error("Dataset source must be 'local', 'library', 'url' or 'server_path'")
+            raise ValueError("Dataset source must be 'local', 'library', 'url' or 'server_path'")
+
+    def find_library_datasets(self, gi, datasets):
+        """
+        Check that the library datasets exist, listing the contents of each library only once
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the libraries live on
+            datasets (list): The dataset entries from the config file with a 'library' source
+        Returns:
+            Raises ValueError if a dataset is not in its library, None otherwise
+        """
+        wanted = {}
+        for dataset in datasets:
+            wanted.setdefault(dataset['library_id'], set()).add(dataset['dataset_id'])
+        for library_id, dataset_ids in wanted.items():
+            self.logger.info("Listing %d dataset(s) in library '%s'" % (len(dataset_ids), library_id))
+            contents = gi.gi.libraries.show_library(library_id, contents=True)
+            missing = dataset_ids - set(item['id'] for item in contents if item.get('type') == 'file')
+            if missing:
+                self.logger.error("Dataset(s) %s not found in library '%s'" % (str(sorted(missing)), library_id))
+                raise ValueError("Dataset(s) %s not found in library '%s'" % (str(sorted(missing)), library_id))
+
+    def import_dataset(self, dataset, gi, history):
+        """
+        Import a single dataset into a history of an instance of Galaxy
+
+        Args:
+            dataset (dict): The dataset entry from the config file
+            gi (GalaxyInstance): The instance of Galaxy to import the data to
+            history (History): The history that the data will be imported to
+        Returns:
+            result (HistoryDatasetAssociation): The dataset imported into the history
+        """
+        if self._abandoned.is_set():
+            self.logger.error("Not importing more datasets into history '%s', the run failed" % self.history_name)
+            raise RuntimeError("Not importing more datasets into history '%s', the run failed" % self.history_name)
+        if dataset['source'] == 'local':
+            self.logger.info("Importing dataset from file: '%s'" % dataset['dataset_file'])
+            if not self.use_dataset_cache:
+                return self.upload_local_dataset(dataset['dataset_file'], gi, history)
+            digest = self.fingerprinter.digest(dataset['dataset_file'])
+            result = self.dataset_cache.import_cached(gi, history, digest)
+            if result is None:
+                result = self.upload_local_dataset(dataset['dataset_file'], gi, history)
+                self.dataset_cache.remember(digest, 'hda', result.id)
             else:
-                self.logger.error("Dataset source must be either 'local' or 'library'")
-                raise ValueError("Dataset source must be either 'local' or 'library'")
+                self.metrics.add('datasets_from_cache')
+            with self._lock:
+                self._uploaded_digests[result.id] = digest
+            return result
+        elif dataset['source'] == 'library':
+            self.logger.info("Importing dataset: '%s' from library: '%s'" % (dataset['dataset_id'],
+                             dataset['library_id']))
+            # The reply already describes the new dataset, so neither the library nor the history is re-read
+            res = gi.gi.histories.upload_dataset_from_library(history.id, dataset['dataset_id'])
+            return wrappers.HistoryDatasetAssociation(res, history, gi=gi)
+        elif dataset['source'] == 'url':
+            return self.fetch_url_datasets([dataset], gi, history)[0][1]
+        elif dataset['source'] == 'server_path':
+            return list(self.link_server_datasets([dataset], gi, history))[0][1]
+        else:
+            self.logger.error("Dataset source must be 'local', 'library', 'url' or 'server_path'")
+            raise ValueError("Dataset source must be 'local', 'library', 'url' or 'server_path'")
+
+    @staticmethod
+    def batch_entries(datasets, key, limit=None):
+        """
+        Group dataset entries into the requests they can share
+
+        Args:
+            datasets (list): The dataset entries from the config file
+            key (function): Gives the tuple of values an entry's request is made with
+            limit (int): The most entries in one request, no limit if None
+        Returns:
+            batches (list): One (key, indexes of the entries) tuple per request, in entry order
+        """
+        groups = {}
+        batches = []
+        for index in range(0, len(datasets)):
+            value = key(datasets[index])
+            if value not in groups or (limit and len(batches[groups[value]][1]) >= limit):
+                groups[value] = len(batches)
+                batches.append((value, []))
+            batches[groups[value]][1].append(index)
+        return batches
+
+    def url_batches(self, datasets):
+        """
+        Group URL dataset entries into upload requests
+
+        URLs with the same 'file_type' and 'dbkey' share requests of at most max_urls_per_request URLs.
+
+        Args:
+            datasets (list): The dataset entries from the config file with a 'url' source
+        Returns:
+            batches (list): One (file_type, dbkey, indexes of the entries) tuple per request, in entry order
+        """
+        return [(file_type, dbkey, indexes) for (file_type, dbkey), indexes in self.batch_entries(
+            datasets, lambda dataset: (dataset.get('file_type', 'auto'), dataset.get('dbkey', '?')),
+            max(1, self.max_urls_per_request))]
+
+    def fetch_url_datasets(self, datasets, gi, history):
+        """
+        Have Galaxy fetch URLs into a history itself, many URLs per request
+
+        Galaxy creates one dataset per line of a pasted URL list, in order, so the data never passes
+        through this machine and each request only waits for the datasets to be queued.
+
+        Args:
+            datasets (list): The dataset entries from the config file with a 'url' source
+            gi (GalaxyInstance): The instance of Galaxy to fetch the data to
+            history (History): The history that the data will be fetched to
+        Returns:
+            results (list): An (index of the entry, HistoryDatasetAssociation) tuple per entry
+        """
+        results = []
+        for file_type, dbkey, indexes in self.url_batches(datasets):
+            self.logger.info("Fetching %d dataset(s) from URLs" % len(indexes))
+            res = gi.gi.tools.put_url('\n'.join(datasets[i]['url'] for i in indexes), history.id,
+                                      file_type=file_type, dbkey=dbkey)
+            outputs = res.get('outputs', [])
+            if len(outputs) != len(indexes):
+                self.logger.error("Galaxy created %d dataset(s) for %d URL(s)" % (len(outputs), len(indexes)))
+                raise RuntimeError("Galaxy created %d dataset(s) for %d URL(s)" % (len(outputs), len(indexes)))
+            for i in range(0, len(indexes)):
+                results.append((indexes[i], wrappers.HistoryDatasetAssociation(outputs[i], history, gi=gi)))
         return results
 
+    def staging_library(self, gi):
+        """
+        The library server paths are linked into before they are imported into the history, made once
+        """
+        name = self.server_path_library or "%s server paths" % self.history_name
+        with self._lock:
+            if self._staging_library is None:
+                existing = gi.libraries.list(name=name)
+                if existing:
+                    self._staging_library = existing[0]
+                else:
+                    self.logger.info("Creating library '%s' for server paths" % name)
+                    self._staging_library = gi.libraries.create(name)
+        return self._staging_library
+
+    def link_server_datasets(self, datasets, gi, history):
+        """
+        Have Galaxy link files on its own file system into a history, without copying them
+
+        The files of each directory are registered in the staging library with one request, as links
+        to the files rather than copies, and are then imported from there into the history.
+
+        Args:
+            datasets (list): The dataset entries from the config file with a 'server_path' source
+            gi (GalaxyInstance): The instance of Galaxy to link the data to
+            history (History): The history that the data will be imported to
+        Returns:
+            results (generator): An (index of the entry, HistoryDatasetAssociation) tuple per entry,
+                in order of completion
+        """
+        lib = self.staging_library(gi)
+        folder_id = lib.wrapped.get('root_folder_id') or lib.root_folder.id
+        library_ids = [None] * len(datasets)
+        batches = self.batch_entries(datasets, lambda dataset: (os.path.dirname(dataset['path']),
+                                                                dataset.get('file_type', 'auto'),
+                                                                dataset.get('dbkey', '?')))
+        for (directory, file_type, dbkey), indexes in batches:
+            self.logger.info("Linking %d dataset(s) from '%s'" % (len(indexes), directory))
+            paths = '\n'.join(datasets[i]['path'] for i in indexes)
+            res = gi.gi.libraries.upload_from_galaxy_filesystem(lib.id, paths, folder_id=folder_id,
+                                                                file_type=file_type, dbkey=dbkey,
+                                                                link_data_only='link_to_files')
+            linked = dict((item['name'], item['id']) for item in res)
+            for i in indexes:
+                name = os.path.basename(datasets[i]['path'])
+                if name not in linked:
+                    self.logger.error("Galaxy did not link server path '%s'" % datasets[i]['path'])
+                    raise RuntimeError("Galaxy did not link server path '%s'" % datasets[i]['path'])
+                library_ids[i] = linked[name]
+
+        def import_linked(index):
+            res = gi.gi.histories.upload_dataset_from_library(history.id, library_ids[index])
+            return wrappers.HistoryDatasetAssociation(res, history, gi=gi)
+
+        return parallel_imap(import_linked, range(0, len(datasets)), self.max_parallel_uploads)
+
+    def upload_local_dataset(self, path, gi, history):
+        """
+        Upload a local file into a history, in chunks if it is large
+
+        Args:
+            path (str): The file to upload
+            gi (GalaxyInstance): The instance of Galaxy to upload the file to
+            history (History): The history that the data will be uploaded to
+        Returns:
+            result (HistoryDatasetAssociation): The uploaded dataset
+        """
+        size = os.path.getsize(path)
+        if size >= self.chunked_upload_threshold:
+            return history.get_dataset(self.chunked_uploader.upload(path, gi, history.id))
+        # The whole file is sent in one request, so its bytes are counted once it is uploaded
+        token = self.upload_progress.start(path, size)
+        result = None
+        try:
+            result = history.upload_dataset(path)
+        except IOError as e:
+            self.logger.error("Dataset file '%s' does not exist" % path)
+            raise IOError("Dataset file '%s' does not exist" % path)
+        finally:
+            self.upload_progress.finish(token, complete=result is not None)
+        return result
+
+    @property
+    def dataset_cache(self):
+        """
+        The cache of datasets already holding the content of local files
+        """
+        with self._lock:
+            if self._dataset_cache is None:
+                self._dataset_cache = DatasetCache(self.galaxy_url,
+                                                   JsonStore.in_cache_dir('datasets.json', self.cache_dir))
+        return self._dataset_cache
+
+    @property
+    def workflow_cache(self):
+        """
+        The workflows previously imported from local .ga files
+        """
+        with self._lock:
+            if self._workflow_cache is None:
+                self._workflow_cache = WorkflowCache(self.galaxy_url,
+                                                     JsonStore.in_cache_dir('workflows.json', self.cache_dir))
+        return self._workflow_cache
+
+    @property
+    def fingerprinter(self):
+        """
+        The content digests of local files, kept between runs
+        """
+        with self._lock:
+            if self._fingerprinter is None:
+                self._fingerprinter = Fingerprinter(JsonStore.in_cache_dir('fingerprints.json', self.cache_dir))
+        return self._fingerprinter
+
+    @property
+    def chunked_uploader(self):
+        """
+        The uploader used for local files of at least self.chunked_upload_threshold bytes
+        """
+        with self._lock:
+            if self._chunked_uploader is None:
+                self._chunked_uploader = ChunkedUploader(
+                    self.galaxy_url, self.galaxy_key, chunk_size=self.upload_chunk_size, retries=self.upload_retries,
+                    journal=JsonStore.in_cache_dir('uploads.json', self.cache_dir), http=self.connection_pool,
+                    metrics=self.metrics, progress=self.upload_progress)
+        return self._chunked_uploader
+
+    @property
+    def connection_pool(self):
+        """
+        The HTTP connection pool shared by every run in this process with the same pool settings
+        """
+        return shared_pool(self.http_pool_size, self.http_keep_alive, self.http_timeout)
+
+    def connect(self):
+        """
+        Make a connection to the instance of Galaxy that sends its requests through the shared pool
+
+        Requests made during run() always go through the pool of this run's settings, even when the
+        connection is shared with runs using other settings.
+
+        Returns:
+            gi (GalaxyInstance): The connection
+        """
+        self.connection_pool.install()
+        return GalaxyInstance(self.galaxy_url, self.galaxy_key)
+
+    def populate_library(self, gi, history):
+        """
+        Create the library named by self.library_name and copy datasets of the history into it
+
+        Either the datasets imported by this run or every dataset in the history is copied, depending on
+        self.library_imported_only. Copies run in parallel and uploaded files are remembered in the
+        dataset cache under their library copy.
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy to create the library on
+            history (History): The history the datasets are copied from
+        Returns:
+            lib (Library): The new library
+        """
+        self.logger.info("Creating library '%s'" % self.library_name)
+        lib = gi.libraries.create(self.library_name)
+        folder_id = lib.wrapped.get('root_folder_id') or lib.root_folder.id
+        if self.library_imported_only:
+            dataset_ids = list(self._imported_dataset_ids)
+        else:
+            contents = gi.gi.histories.show_history(history.id, contents=True)
+            dataset_ids = [item['id'] for item in contents
+                           if item.get('history_content_type', 'dataset') == 'dataset' and not item.get('deleted')]
+        self.logger.info("Copying %d dataset(s) to library '%s' with up to %d parallel copies"
+                         % (len(dataset_ids), self.library_name, self.max_parallel_library_copies))
+        copied = [0]
+
+        def copy_dataset(dataset_id):
+            res = gi.gi.libraries.copy_from_dataset(lib.id, dataset_id, folder_id=folder_id)
+            if dataset_id in self._uploaded_digests:
+                self.dataset_cache.remember(self._uploaded_digests[dataset_id], 'library', res['library_dataset_id'],
+                                            library_id=lib.id)
+            with self._lock:
+                copied[0] += 1
+                self.logger.info("Copied %d of %d dataset(s) to library '%s'"
+                                 % (copied[0], len(dataset_ids), self.library_name))
+            return res['library_dataset_id']
+
+        parallel_map(copy_dataset, dataset_ids, self.max_parallel_library_copies)
+        return lib
+
     def set_runtime_params(self, wf):
         """
         Map the parameters of tools requiring runtime parameters to the step ID of each tool
 
+        A tool entry may name the step it is meant for with a 'step' key holding the step's label, UUID,
+        tool ID or step ID. Without one, its parameters apply to every step with a parameter of that name.
+
         Args:
             wf (Workflow): The workflow object containing the tools
         Returns:
             params (dict): The dictionary containing the step IDs and parameters
         """
+        index = RuntimeParamIndex(wf, self.local_workflow if self.workflow_source == 'local' else None)
         params = {}
         for i in range(0, len(self.runtime_params)):
+            tool = self.runtime_params['tool_%d' % i]
             param_dict = {}
-            for j in range(0, len(self.runtime_params['tool_' + str(i)])):
+            for key in sorted((key for key in tool if key.startswith('param_')), key=lambda key: int(key[6:])):
                 try:
-                    param_dict[self.runtime_params['tool_' + str(i)]['param_' + str(j)]['name']] \
-                        = self.runtime_params['tool_' + str(i)]['param_' + str(j)]['value']
+                    param_dict[tool[key]['name']] = tool[key]['value']
                 except KeyError as e:
                     self.logger.error("Missing value for %s key in runtime parameters" % e)
                     raise KeyError("Missing value for %s key in runtime parameters" % e)
-                for s in wf.sorted_step_ids():
-                    try:
-                        if wf.steps[s].tool_inputs[self.runtime_params['tool_' + str(i)]['param_' + str(j)]['name']]:
-                            params[s] = param_dict
-                    except KeyError:
-                        pass
+            for name in param_dict:
+                for step_id in index.steps_for(name, tool.get('step')):
+                    params.setdefault(step_id, {}).update(param_dict)
         return params
 
     def create_dataset_collection(self, gi, outputhist, name="DatasetList"):
         """
         Make a dataset collection with the datasets listed in self.dataset_collection
 
+        Elements are assembled as their datasets arrive in the history, keeping only dataset IDs.
+
         Args:
             gi (GalaxyInstance): The current instance of Galaxy being used
             outputhist (History): The history in which to create the dataset collection
@@ -239,97 +962,213 @@ class GalaxyCMDWorkflow(object):
             dataset_collection (HistoryDatasetCollectionAssociation): The new dataset collection object
         """
         self.logger.info("Dataset collection name: '%s'" % name)
-        collection_elements = []
-        datasets = self.import_datasets('dataset_collection', gi, outputhist)
-        if self.dataset_collection['type'] == 'list':
-            for i in range(0, len(datasets)):
-                collection_elements.append(collections.HistoryDatasetElement(name=datasets[i].name, id=datasets[i].id))
-        elif self.dataset_collection['type'] == 'list:paired':
-            pair_num = 1
-            for i in range(0, len(datasets), 2):
-                collection_elements.append(
-                    collections.CollectionElement(
-                        name=datasets[i].name,
-                        type='paired',
-                        elements=[
-                            collections.HistoryDatasetElement(name='forward', id=datasets[i].id),
-                            collections.HistoryDatasetElement(name='reverse', id=datasets[i+1].id),
-                        ]
-                    )
-                )
-                pair_num += 1
-        else:
-            self.logger.error("Dataset collection type must be 'list' or 'list:paired'")
-            raise ValueError("Dataset collection type must be 'list' or 'list:paired'")
-        collection_description = collections.CollectionDescription(
-                name=name,
-                type=self.dataset_collection['type'],
-                elements=collection_elements
-            )
-        dataset_collection = outputhist.create_dataset_collection(collection_description)
+        entries = self.collection_entries()
+        builder = CollectionBuilder(self.dataset_collection['type'], entries)
+        for index, dataset in self.iter_import_datasets(entries, gi, outputhist):
+            builder.add(index, dataset.name, dataset.id)
+        dataset_collection = outputhist.create_dataset_collection(builder.description(name))
         return dataset_collection
 
-    def run(self, temp_wf=False, output_file=None):
+    def abandon_staging(self, stages, history, temp_workflow_stage=None):
+        """
+        Clean up after a failure before the workflow was invoked
+
+        The stages still running are told to start no more imports and waited for, so nothing is still
+        being written to the history when it is purged. A temporary workflow imported by the run is then
+        deleted. Cleanup failures are logged without hiding the error that stopped the run.
+
+        Args:
+            stages (list): The AsyncResult of each stage started, or None
+            history (History): The history created by the run, None if there is none yet
+            temp_workflow_stage (AsyncResult): The stage importing a workflow that is deleted after use, if any
+        """
+        self._abandoned.set()
+        for stage in stages:
+            if stage is not None:
+                stage.wait()
+        if history is not None:
+            self.logger.error("Deleting history '%s' as the run failed before invoking the workflow"
+                              % self.history_name)
+            try:
+                history.delete(purge=True)
+            except Exception as e:
+                self.logger.warning("Could not delete history '%s': %s" % (self.history_name, e))
+        if temp_workflow_stage is not None and temp_workflow_stage.successful() and not self.workflow_reused:
+            self.logger.info("Deleting workflow: '%s'" % self.workflow)
+            try:
+                temp_workflow_stage.get().delete()
+            except Exception as e:
+                self.logger.warning("Could not delete workflow '%s': %s" % (self.workflow, e))
+
+    def find_invocation_id(self, gi, workflow, history):
+        """
+        Find the invocation of a workflow that writes to a history
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the workflow was run on
+            workflow (Workflow): The workflow that was run
+            history (History): The history the workflow was run in
+        Returns:
+            invocation_id (str): The ID of the invocation, None if Galaxy does not list invocations
+        """
+        try:
+            invocations = gi.gi.workflows.get_invocations(workflow.id)
+        except ConnectionError as e:
+            self.logger.warning("Could not list the invocations of workflow '%s': %s" % (workflow.id, e))
+            return None
+        for invocation in reversed(invocations):
+            if invocation.get('history_id') == history.id:
+                return invocation['id']
+        return None
+
+    def build_collection_description(self, datasets, name="DatasetList"):
+        """
+        Describe a dataset collection of the type in self.dataset_collection
+
+        Args:
+            datasets (list): (name, id) pairs of the history datasets making up the collection, in entry order
+            name (str): The name of the new dataset collection
+        Returns:
+            collection_description (CollectionDescription): The description to create the collection from
+        """
+        builder = CollectionBuilder(self.dataset_collection['type'], self.collection_entries())
+        for i in range(0, len(datasets)):
+            builder.add(i, datasets[i][0], datasets[i][1])
+        return builder.description(name)
+
+    def run(self, temp_wf=False, output_file=None, gi=None, workflow=None, wait=False):
         """
         Make the connection, set up for the workflow, then run it
 
         Args:
             temp_wf (bool): Flag to determine whether the workflow should be deleted after use
+            output_file (str): A file to write the JSON run manifest to, updated after every stage, see RunManifest
+            gi (GalaxyInstance): An existing connection to reuse instead of making a new one
+            workflow (Workflow): An already imported workflow to run, it is never deleted by this method
+            wait (bool): Flag to wait for the workflow's jobs to finish, the outcome is kept in self.history_state
         Returns:
             results (tuple): List of output datasets and output history if successful, None if not successful
         """
-        self.logger.info("Initiating Galaxy connection")
-        gi = GalaxyInstance(self.galaxy_url, self.galaxy_key)
+        manifest = RunManifest(output_file) if output_file else None
+        scope = None
+        try:
+            with request_scope(self.connection_pool) as scope, self.metrics.stage('run'):
+                return self.run_stages(temp_wf, manifest, gi, workflow, wait)
+        except BaseException as e:
+            # Also on KeyboardInterrupt and SystemExit, so the manifest never stays 'running'
+            if manifest is not None:
+                manifest.update(status='failed', error=str(e) or e.__class__.__name__)
+            raise
+        finally:
+            self.metrics.add('api_calls', scope['requests'] if scope is not None else 0)
+            if manifest is not None:
+                manifest.update(metrics=self.metrics.as_dict())
+
+    def run_stages(self, temp_wf, manifest, gi, workflow, wait):
+        """
+        The stages of run(), each timed in self.metrics and recorded in the manifest if there is one
+        """
+        with self.metrics.stage('preflight'):
+            self.preflight()
 
-        self.logger.info("Importing workflow '%s' from '%s' source" % (self.workflow,  self.workflow_source))
-        workflow = self.import_workflow(gi)
-        if not workflow.is_runnable:
-            self.logger.error("Workflow not runnable, missing required tools")
-            raise RuntimeError("Workflow not runnable, missing required tools")
+        if gi is None:
+            self.logger.info("Initiating Galaxy connection")
+            gi = self.connect()
 
-        self.logger.info("Creating output history '%s'" % self.history_name)
-        outputhist = gi.histories.create(self.history_name)
+        # Stages that do not depend on each other run at the same time: importing a local workflow,
+        # building the dataset collection and importing the datasets all start once the history exists.
+        # A workflow given by ID is fetched and checked first, since nothing may be written before then.
+        imported_workflow = workflow is None
+        # Nothing an earlier run on this instance imported belongs to this run
+        self._abandoned.clear()
+        with self._lock:
+            self._imported_dataset_ids = []
+            self._uploaded_digests = {}
+        self.history_state = None
+        stages = ThreadPool(3)
+        workflow_stage = collection_stage = datasets_stage = outputhist = None
+        try:
+            if imported_workflow:
+                self.logger.info("Importing workflow '%s' from '%s' source" % (self.workflow,  self.workflow_source))
+                if self.workflow_source == 'local':
+                    workflow_stage = stages.apply_async(carry_scope(self.metrics.timed),
+                                                        ('import_workflow', self.import_workflow, gi, temp_wf))
+                else:
+                    workflow = self.metrics.timed('import_workflow', self.import_workflow, gi, temp_wf)
+            if workflow_stage is None:
+                self.verify_workflow(workflow)
 
-        input_map = dict()
-        if self.dataset_collection:
-            self.logger.info("Creating dataset collection")
-            dataset_collection = self.create_dataset_collection(gi, outputhist)
-            input_map[self.dataset_collection['input_label']] = dataset_collection
+            self.logger.info("Creating output history '%s'" % self.history_name)
+            outputhist = self.metrics.timed('create_history', gi.histories.create, self.history_name)
+            if manifest is not None:
+                manifest.update(history={'id': outputhist.id, 'name': outputhist.name})
 
-        datasets = []
-        if self.datasets:
-            self.logger.info("Importing datasets to history")
-            imported_datasets = self.import_datasets('datasets', gi, outputhist)
-            for i in range(0, len(imported_datasets)):
-                input_map[self.datasets[i]['input_label']] = imported_datasets[i]
+            if self.dataset_collection:
+                self.logger.info("Creating dataset collection")
+                collection_stage = stages.apply_async(carry_scope(self.metrics.timed),
+                                                      ('create_dataset_collection', self.create_dataset_collection,
+                                                       gi, outputhist))
+            if self.datasets:
+                self.logger.info("Importing datasets to history")
+                datasets_stage = stages.apply_async(carry_scope(self.metrics.timed),
+                                                    ('import_datasets', self.import_datasets, 'datasets', gi,
+                                                     outputhist))
+
+            if workflow_stage is not None:
+                workflow = workflow_stage.get()
+                self.verify_workflow(workflow)
+            params = None
+            if self.runtime_params:
+                self.logger.info("Setting runtime tool parameters")
+                params = self.metrics.timed('set_runtime_params', self.set_runtime_params, workflow)
+
+            input_map = dict()
+            if collection_stage is not None:
+                input_map[self.dataset_collection['input_label']] = collection_stage.get()
+            if datasets_stage is not None:
+                imported_datasets = datasets_stage.get()
+                for i in range(0, len(imported_datasets)):
+                    input_map[self.datasets[i]['input_label']] = imported_datasets[i]
+        except Exception:
+            self.abandon_staging([workflow_stage, collection_stage, datasets_stage], outputhist,
+                                 workflow_stage if temp_wf else None)
+            raise
+        finally:
+            stages.terminate()
+
+        if manifest is not None:
+            manifest.update(workflow={'id': workflow.id, 'name': workflow.name},
+                            inputs=dict((label, RunManifest.describe(content)) for label, content in input_map.items()))
 
         if self.library_name:
-            self.logger.info("Creating library '%s'" % self.library_name)
-            lib = gi.libraries.create(self.library_name)
-            self.logger.info("Copying datasets to library '%s'" % self.library_name)
-            for data in outputhist.get_datasets():
-                lib.copy_from_dataset(data)
-
-        if self.runtime_params:
-            self.logger.info("Setting runtime tool parameters")
-            params = self.set_runtime_params(workflow)
-            self.logger.info("Initiating workflow")
-            results = workflow.run(input_map, outputhist, params)
+            self.metrics.timed('populate_library', self.populate_library, gi, outputhist)
+
+        self.logger.info("Initiating workflow")
+        if params is not None:
+            results = self.metrics.timed('invoke_workflow', workflow.run, input_map, outputhist, params)
         else:
-            self.logger.info("Checking for missing tool parameters")
-            missing_param = self.verify_runtime_params(workflow)
-            if missing_param:
-                self.logger.error("Missing runtime parameter for '%s'" % str(missing_param))
-                raise RuntimeError("Missing runtime parameter for '%s'" % str(missing_param))
-            self.logger.info("Initiating workflow")
-            results = workflow.run(input_map, outputhist)
-            if output_file:
-                f = open(output_file, 'w')
-                f.write(str(results))
-                f.close()
-
-        if temp_wf and self.workflow_source != 'id':
+            results = self.metrics.timed('invoke_workflow', workflow.run, input_map, outputhist)
+        if manifest is not None:
+            manifest.update(status='invoked', invocation_id=self.find_invocation_id(gi, workflow, outputhist),
+                            outputs=[RunManifest.describe(dataset) for dataset in results[0]])
+
+        if wait:
+            self.logger.info("Waiting for history '%s' to finish" % self.history_name)
+            monitor = HistoryMonitor(gi, outputhist.id, expected_datasets=len(results[0]),
+                                     poll_interval=self.wait_poll_interval,
+                                     max_poll_interval=self.wait_max_poll_interval, timeout=self.wait_timeout)
+            self.history_state = self.metrics.timed('wait', monitor.wait)
+            if self.history_state == 'error':
+                self.logger.error("Workflow finished with failed dataset(s) in history '%s'" % self.history_name)
+            if manifest is not None:
+                # One listing of the history gives the final state and size of every input and output
+                manifest.refresh(gi.gi.histories.show_history(outputhist.id, contents=True, details='all'))
+                manifest.update(status=self.history_state)
+
+        if temp_wf and imported_workflow and not self.workflow_reused and self.workflow_source != 'id':
             self.logger.info("Deleting workflow: '%s'" % self.workflow)
             workflow.delete()
 
+        self.logger.info("HTTP connections so far: %(requests)d request(s), %(new_connections)d new and "
+                         "%(reused_connections)d reused connection(s)" % self.connection_pool.stats())
         return results
@@ -0,0 +1,80 @@
+import logging
+import random
+import time
+
+
+# Dataset states that still have work ahead of them
+PENDING_STATES = ('new', 'upload', 'queued', 'running', 'setting_metadata')
+# Dataset states that mean a job failed, Galaxy pauses the jobs that depend on a failed one
+ERROR_STATES = ('error', 'failed_metadata', 'paused')
+
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_MAX_POLL_INTERVAL = 60
+
+
+class HistoryMonitor(object):
+    def __init__(self, gi, history_id, expected_datasets=0, poll_interval=DEFAULT_POLL_INTERVAL,
+                 max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, timeout=None):
+        """
+        Wait for the jobs of a history to finish
+
+        Only the aggregate state of the history is requested, so each poll costs one API call
+        however many datasets the history holds. The delay between polls doubles up to
+        max_poll_interval, with random jitter so many monitors do not poll in lockstep.
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the history lives on
+            history_id (str): The ID of the history to watch
+            expected_datasets (int): The number of datasets the history must hold before it can be done
+            poll_interval (float): The delay before the second poll, in seconds
+            max_poll_interval (float): The longest delay between polls, in seconds
+            timeout (float): Give up after this many seconds, never if None
+        Attributes:
+            self.logger: For logging.
+            self.polls (int): The number of times the history has been polled
+        """
+        self.logger = logging.getLogger('gflow.HistoryMonitor')
+        self.gi = gi
+        self.history_id = history_id
+        self.expected_datasets = expected_datasets
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.polls = 0
+
+    def poll(self):
+        """
+        Get the aggregate state of the history
+
+        Returns:
+            state (str): 'error' if any dataset failed, 'ok' once every dataset is done, 'running' otherwise
+        """
+        self.polls += 1
+        info = self.gi.gi.histories.show_history(self.history_id)
+        details = info.get('state_details') or {}
+        if any(details.get(state) for state in ERROR_STATES):
+            return 'error'
+        if any(details.get(state) for state in PENDING_STATES) or sum(details.values()) < self.expected_datasets:
+            return 'running'
+        return 'ok'
+
+    def wait(self):
+        """
+        Poll the history until all of its jobs are finished or one of them fails
+
+        Returns:
+            state (str): Either 'ok' or 'error', raises RuntimeError on timeout
+        """
+        start = time.time()
+        interval = self.poll_interval
+        while True:
+            state = self.poll()
+            if state != 'running':
+                self.logger.info("History '%s' finished in state '%s' after %d poll(s)"
+                                 % (self.history_id, state, self.polls))
+                return state
+            if self.timeout is not None and time.time() - start > self.timeout:
+                self.logger.error("Timed out waiting for history '%s'" % self.history_id)
+                raise RuntimeError("Timed out waiting for history '%s'" % self.history_id)
+            time.sleep(interval / 2.0 + random.uniform(0, interval / 2.0))
+            interval = min(interval * 2, self.max_poll_interval)
@@ -0,0 +1,142 @@
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Marks a key deleted by this store, until the deletion is written
+DELETED = object()
+
+# The stores opened with in_cache_dir, one per file, shared by every run in the process
+_shared_stores = {}
+_shared_stores_lock = threading.Lock()
+
+
+def default_cache_dir():
+    """
+    Get the directory gflow keeps its local state in
+
+    Returns:
+        cache_dir (str): $XDG_CACHE_HOME/gflow if set, ~/.cache/gflow otherwise
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'gflow')
+
+
+class JsonStore(object):
+    def __init__(self, filename):
+        """
+        A small persistent key/value index kept as a JSON file
+
+        Every change is written straight to disk through a temporary file and a rename, so an
+        interrupted run never leaves a half written index behind. Several stores, in this or other
+        processes, can share a file: each write holds a lock on '<filename>.lock', re-reads the file
+        and only replaces the keys this store changed. Locking needs fcntl, so it is skipped on Windows.
+
+        Args:
+            filename (str): The file the index is stored in
+        Attributes:
+            self.logger: For logging.
+            self.filename (str): The file the index is stored in
+            self.entries (dict): The entries currently in the index
+        """
+        self.logger = logging.getLogger('gflow.JsonStore')
+        self.filename = filename
+        self.entries = self.read()
+        self._changes = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def in_cache_dir(cls, name, cache_dir=None):
+        """
+        Open the index called name in the gflow cache directory
+
+        The store is shared by every caller in the process, so runs in parallel threads, such as the
+        samples of a batch, see each other's entries straight away.
+
+        Args:
+            name (str): The file name of the index
+            cache_dir (str): The cache directory, defaults to default_cache_dir()
+        """
+        filename = os.path.abspath(os.path.join(cache_dir or default_cache_dir(), name))
+        with _shared_stores_lock:
+            if filename not in _shared_stores:
+                _shared_stores[filename] = cls(filename)
+            return _shared_stores[filename]
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.entries.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self._changes[key] = value
+            self.save()
+
+    def delete(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+            self._changes[key] = DELETED
+            self.save()
+
+    def read(self):
+        """
+        Read the index from disk
+
+        Returns:
+            entries (dict): The entries in the file, empty if it is missing or unreadable
+        """
+        try:
+            with open(self.filename, 'r') as json_file:
+                return json.load(json_file)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            self.logger.warning("Ignoring unreadable index file '%s'" % self.filename)
+            return {}
+
+    def save(self):
+        """
+        Merge the changes of this store into the index on disk, keeping the changes of other stores
+        """
+        with self._lock:
+            self.make_dir()
+            with open(self.filename + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                entries = self.read()
+                for key, value in self._changes.items():
+                    if value is DELETED:
+                        entries.pop(key, None)
+                    else:
+                        entries[key] = value
+                self.write(entries)
+                self.entries = entries
+                self._changes = {}
+
+    def make_dir(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def write(self, entries):
+        """
+        Atomically replace the file with entries
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(entries, tmp_file, indent=1, sort_keys=True)
+            os.rename(tmp_name, self.filename)
+        except Exception:
+            os.remove(tmp_name)
+            raise
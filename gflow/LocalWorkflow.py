@@ -0,0 +1,169 @@
+import json
+import itertools
+import logging
+
+from gflow.WorkflowAnalyzer import decode_state, find_runtime_values
+
+INPUT_STEP_TYPES = ('data_input', 'data_collection_input')
+
+
+class WorkflowStep(object):
+    __slots__ = ('id', 'type', 'name', 'label', 'uuid', 'tool_id', 'tool_version', 'tool_state', 'input_steps')
+
+    def __init__(self, step_id, step_dict):
+        """
+        One step of a workflow file
+
+        Args:
+            step_id (str): The step's key in the file, which is also its position in the workflow
+            step_dict (dict): The step as loaded from the file
+        Attributes:
+            self.id (str): The step's key in the file
+            self.type (str): 'tool', 'data_input', 'data_collection_input' or 'pause'
+            self.name (str): The name of the tool, or 'Input dataset' and the like for inputs
+            self.label (str): The label given to the step in the workflow editor, may be None
+            self.uuid (str): The step's UUID, may be None
+            self.tool_id (str): The ID of the tool the step runs, None for inputs
+            self.tool_version (str): The version of the tool the step runs
+            self.tool_state (dict): The decoded tool state
+            self.input_steps (dict): Input name to a list of (source step ID, output name) tuples, more than
+                one for a multiple input
+        """
+        self.id = str(step_id)
+        self.type = step_dict.get('type')
+        self.name = step_dict.get('name')
+        self.label = step_dict.get('label')
+        self.uuid = step_dict.get('uuid')
+        self.tool_id = step_dict.get('tool_id')
+        self.tool_version = step_dict.get('tool_version')
+        self.tool_state = decode_state(step_dict.get('tool_state') or {})
+        self.input_steps = {}
+        for name, connections in (step_dict.get('input_connections') or {}).items():
+            if isinstance(connections, dict):
+                connections = [connections]
+            self.input_steps[name] = [(str(connection['id']), connection.get('output_name'))
+                                      for connection in connections]
+
+    def as_dict(self):
+        """
+        The step in the form of a step dict from Galaxy, with the tool state already decoded
+        """
+        return {'id': self.id, 'type': self.type, 'name': self.name, 'label': self.label, 'uuid': self.uuid,
+                'tool_id': self.tool_id, 'tool_version': self.tool_version, 'tool_inputs': self.tool_state}
+
+    @property
+    def input_label(self):
+        """
+        The label Galaxy matches datasets to this step by, None if it is not an input step
+        """
+        if self.type not in INPUT_STEP_TYPES:
+            return None
+        return self.tool_state.get('name') or self.label
+
+
+class LocalWorkflow(object):
+    __slots__ = ('logger', 'name', 'uuid', 'steps', 'dag', 'inv_dag')
+
+    def __init__(self, workflow_dict):
+        """
+        A workflow read from a .ga file, for inspecting it without Galaxy
+
+        Args:
+            workflow_dict (dict): The workflow as loaded from the .ga file
+        Attributes:
+            self.logger: For logging.
+            self.name (str): The name of the workflow
+            self.uuid (str): The UUID of the workflow, may be None
+            self.steps (dict): Step ID to WorkflowStep
+            self.dag (dict): Step ID to the set of IDs of the steps that use its outputs
+            self.inv_dag (dict): Step ID to the set of IDs of the steps whose outputs it uses
+        """
+        self.logger = logging.getLogger('gflow.LocalWorkflow')
+        if not isinstance(workflow_dict, dict) or not isinstance(workflow_dict.get('steps'), dict):
+            self.logger.error("Not a Galaxy workflow, there are no steps")
+            raise ValueError("Not a Galaxy workflow, there are no steps")
+        self.name = workflow_dict.get('name')
+        self.uuid = workflow_dict.get('uuid')
+        self.steps = dict((str(step_id), WorkflowStep(step_id, step))
+                          for step_id, step in workflow_dict['steps'].items())
+        self.dag = dict((step_id, set()) for step_id in self.steps)
+        self.inv_dag = dict((step_id, set()) for step_id in self.steps)
+        for step in self.steps.values():
+            for source_id, output_name in itertools.chain.from_iterable(step.input_steps.values()):
+                if source_id not in self.steps:
+                    self.logger.error("Step %s takes input from step %s, which does not exist" % (step.id, source_id))
+                    raise ValueError("Step %s takes input from step %s, which does not exist" % (step.id, source_id))
+                self.dag[source_id].add(step.id)
+                self.inv_dag[step.id].add(source_id)
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a workflow from a .ga file
+
+        Args:
+            filename (str): The .ga file
+        Returns:
+            workflow (LocalWorkflow): The parsed workflow
+        """
+        logger = logging.getLogger('gflow.LocalWorkflow')
+        try:
+            with open(filename) as json_file:
+                workflow_dict = json.load(json_file)
+        except IOError as e:
+            logger.error(e)
+            raise IOError(e)
+        except ValueError as e:
+            logger.error("Workflow file '%s' is not valid JSON: %s" % (filename, e))
+            raise ValueError("Workflow file '%s' is not valid JSON: %s" % (filename, e))
+        return cls(workflow_dict)
+
+    def sorted_step_ids(self):
+        """
+        Order the steps so that every step comes after the steps it takes input from
+
+        Returns:
+            step_ids (list): The step IDs, ties broken by step ID, raises ValueError on a cycle
+        """
+        waiting = dict((step_id, len(sources)) for step_id, sources in self.inv_dag.items())
+        ready = sorted((step_id for step_id, count in waiting.items() if count == 0), key=int, reverse=True)
+        ordered = []
+        while ready:
+            step_id = ready.pop()
+            ordered.append(step_id)
+            for next_id in self.dag[step_id]:
+                waiting[next_id] -= 1
+                if waiting[next_id] == 0:
+                    ready.append(next_id)
+            ready.sort(key=int, reverse=True)
+        if len(ordered) != len(self.steps):
+            self.logger.error("Workflow '%s' has a cycle" % self.name)
+            raise ValueError("Workflow '%s' has a cycle" % self.name)
+        return ordered
+
+    @property
+    def input_labels_to_ids(self):
+        """
+        Input label to the set of IDs of the input steps with that label
+        """
+        labels = {}
+        for step in self.steps.values():
+            if step.input_label is not None:
+                labels.setdefault(step.input_label, set()).add(step.id)
+        return labels
+
+    @property
+    def tool_ids(self):
+        """
+        The IDs of the tools the workflow runs
+        """
+        return set(step.tool_id for step in self.steps.values() if step.type == 'tool')
+
+    def runtime_values(self):
+        """
+        List every tool parameter left to be set at runtime
+
+        Returns:
+            missing (list): A (step ID, step label, parameter path) tuple per RuntimeValue, in step order
+        """
+        return find_runtime_values(self)
@@ -0,0 +1,187 @@
+import fnmatch
+import itertools
+import logging
+import os
+import re
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+BRACES = re.compile(r'\{([^{}]*)\}')
+WILDCARDS = re.compile(r'[*?\[]')
+
+
+def expand_braces(pattern):
+    """
+    Expand the {a,b} alternatives of a pattern
+
+    Args:
+        pattern (str): The pattern, such as 'reads/*_R{1,2}.fastq.gz'
+    Returns:
+        patterns (list): One (pattern, alternatives) tuple per combination, alternatives holding the chosen
+            text of each brace group, such as [('reads/*_R1.fastq.gz', ('1',)), ('reads/*_R2.fastq.gz', ('2',))]
+    """
+    parts = BRACES.split(pattern)
+    literals, groups = parts[0::2], [group.split(',') for group in parts[1::2]]
+    expanded = []
+    for choice in itertools.product(*groups):
+        text = literals[0]
+        for i in range(0, len(choice)):
+            text += choice[i] + literals[i + 1]
+        expanded.append((text, choice))
+    return expanded
+
+
+def list_dir(path):
+    """
+    List a directory as (name, is_dir, is_file) tuples, sorted by name, using scandir where available
+    """
+    if scandir is not None:
+        entries = [(entry.name, entry.is_dir(), entry.is_file()) for entry in scandir(path)]
+    else:
+        entries = [(name, os.path.isdir(os.path.join(path, name)), os.path.isfile(os.path.join(path, name)))
+                   for name in os.listdir(path)]
+    return sorted(entries)
+
+
+def iter_glob(pattern):
+    """
+    Walk the file system for the files matching a glob pattern, one directory at a time
+
+    Only directories that can still match are read. A '**' component matches any number of
+    directories. Hidden files are only matched by components starting with '.'.
+
+    Args:
+        pattern (str): The glob pattern, without braces
+    Returns:
+        paths (generator): The matching file paths, in sorted order within each directory
+    """
+    components = [component for component in pattern.split('/') if component]
+    root = '/' if pattern.startswith('/') else ''
+    return walk(root, components)
+
+
+def walk(path, components):
+    if not components:
+        if os.path.isfile(path):
+            yield path
+        return
+    component, rest = components[0], components[1:]
+    if component == '**':
+        for found in walk(path, rest):
+            yield found
+        for name, is_dir, is_file in list_dir(path or '.'):
+            if is_dir and not name.startswith('.'):
+                for found in walk(os.path.join(path, name), components):
+                    yield found
+        return
+    if not WILDCARDS.search(component):
+        if os.path.exists(os.path.join(path, component)):
+            for found in walk(os.path.join(path, component), rest):
+                yield found
+        return
+    if not os.path.isdir(path or '.'):
+        return
+    for name, is_dir, is_file in list_dir(path or '.'):
+        if name.startswith('.') and not component.startswith('.'):
+            continue
+        if not fnmatch.fnmatchcase(name, component):
+            continue
+        if rest and is_dir:
+            for found in walk(os.path.join(path, name), rest):
+                yield found
+        elif not rest and is_file:
+            yield os.path.join(path, name)
+
+
+def wildcard_regex(pattern):
+    """
+    Translate a glob pattern into a regular expression capturing what each wildcard matched
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '((?:[^/]*/)*)'
+            i += 3
+        elif pattern[i] == '*':
+            regex += '([^/]*)'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '([^/])'
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex += '([' + body + '])'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + '$')
+
+
+def sample_name(pattern, path):
+    """
+    Name a matched file after the text its pattern's wildcards matched, such as 's1' for 'reads/*_R1.fq'
+    """
+    match = wildcard_regex(pattern).match(path)
+    captured = [part.strip('/') for part in match.groups() if part.strip('/')] if match else []
+    return '_'.join(captured) or os.path.basename(path)
+
+
+def expand_entry(entry, collection_type):
+    """
+    Turn a collection entry with a 'pattern' or 'directory' into one local dataset entry per matching file
+
+    A 'directory' entry matches its 'pattern' (default '*') inside the directory, in every subdirectory
+    too if 'recursive' is set. For a list:paired collection, a pattern with one {forward,reverse} brace
+    group of two alternatives pairs the files whose wildcards matched the same text, naming each pair
+    after that text. Other keys of the entry, such as 'group', are copied to every dataset.
+
+    Args:
+        entry (dict): The collection entry from the config
+        collection_type (str): The type of the collection
+    Returns:
+        entries (list): The dataset entries, in sorted order
+    """
+    logger = logging.getLogger('gflow.PathExpander')
+    pattern = entry.get('pattern') or '*'
+    if entry.get('directory'):
+        pattern = '%s/%s%s' % (entry['directory'].rstrip('/'), '**/' if entry.get('recursive') else '', pattern)
+    shared = dict((key, value) for key, value in entry.items()
+                  if key not in ('pattern', 'directory', 'recursive', 'source'))
+    expanded = expand_braces(pattern)
+    entries = []
+    if collection_type == 'list:paired' and len(expanded) == 2 and len(expanded[0][1]) == 1:
+        pairs = {}
+        for role, (alternative, choice) in zip(('forward', 'reverse'), expanded):
+            for path in iter_glob(alternative):
+                pairs.setdefault(sample_name(alternative, path), {})[role] = path
+        for name in sorted(pairs):
+            for role in ('forward', 'reverse'):
+                if role not in pairs[name]:
+                    logger.error("No %s file for '%s' matching '%s'" % (role, name, pattern))
+                    raise ValueError("No %s file for '%s' matching '%s'" % (role, name, pattern))
+                dataset = dict(shared)
+                dataset.update({'source': 'local', 'dataset_file': pairs[name][role], 'group': name, 'pair': role})
+                entries.append(dataset)
+    else:
+        for alternative, choice in expanded:
+            for path in iter_glob(alternative):
+                dataset = dict(shared)
+                dataset.update({'source': 'local', 'dataset_file': path})
+                entries.append(dataset)
+    if not entries:
+        logger.error("No files match '%s'" % pattern)
+        raise IOError("No files match '%s'" % pattern)
+    logger.info("'%s' matches %d file(s)" % (pattern, len(entries)))
+    return entries
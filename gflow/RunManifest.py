@@ -0,0 +1,70 @@
+import time
+
+from gflow.JsonStore import JsonStore
+
+
+class RunManifest(JsonStore):
+    def __init__(self, filename):
+        """
+        A JSON description of one run, for other programs to read instead of querying Galaxy
+
+        The manifest is rewritten atomically after every stage, so a reader always sees a complete
+        file describing how far the run got. 'status' is 'running' until the workflow is invoked,
+        then 'invoked', or the state of the history if the run waited for it ('ok' or 'error'),
+        or 'failed' with an 'error' message if the run stopped.
+
+        Args:
+            filename (str): The file the manifest is written to, replacing any earlier content
+        """
+        super(RunManifest, self).__init__(filename)
+        self.entries = {}
+        self.update(status='running', started=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+
+    @staticmethod
+    def describe(content):
+        """
+        Describe a history dataset or dataset collection
+
+        Args:
+            content (Wrapper or dict): The dataset or collection, or its dict as returned by the API
+        Returns:
+            description (dict): Its 'id', 'name', 'type', 'state' and 'file_size', as far as they are known
+        """
+        info = getattr(content, 'wrapped', content)
+        return {'id': info.get('id'), 'name': info.get('name'),
+                'type': info.get('history_content_type') or ('dataset_collection' if 'collection_type' in info
+                                                             else 'dataset'),
+                'state': info.get('state'), 'file_size': info.get('file_size')}
+
+    def save(self):
+        """
+        Replace the file with the manifest, a manifest belongs to a single run so nothing is merged
+        """
+        with self._lock:
+            self.make_dir()
+            self.write(self.entries)
+
+    def update(self, **fields):
+        """
+        Set some fields of the manifest and write it
+        """
+        with self._lock:
+            self.entries.update(fields)
+            self.save()
+
+    def refresh(self, contents):
+        """
+        Update the state and size of the inputs and outputs from a listing of the history
+
+        Args:
+            contents (list): The history contents as returned by the API, with details
+        """
+        latest = dict((info['id'], info) for info in contents)
+        with self._lock:
+            inputs = self.entries.get('inputs') or {}
+            for description in list(inputs.values()) + list(self.entries.get('outputs') or []):
+                if description['id'] in latest:
+                    for key in ('state', 'file_size'):
+                        if latest[description['id']].get(key) is not None:
+                            description[key] = latest[description['id']][key]
+            self.save()
@@ -0,0 +1,123 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+
+
+COUNTERS = ('api_calls', 'bytes_uploaded', 'upload_retries', 'datasets_imported', 'datasets_from_cache')
+
+
+class RunMetrics(object):
+    def __init__(self):
+        """
+        Wall time per stage and counters for the runs of one GalaxyCMDWorkflow
+
+        Stages can run at the same time in different threads, so stage times can add up to more
+        than the time of the whole run. A stage entered more than once accumulates its time.
+
+        Attributes:
+            self.logger: For logging.
+            self.stages (dict): Stage name to the seconds spent in it
+            self.counters (dict): Counter name to its value, see COUNTERS
+            self.uploads (list): The name, bytes sent, seconds taken and outcome of each local file upload
+        """
+        self.logger = logging.getLogger('gflow.RunMetrics')
+        self.stages = {}
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.uploads = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the code run inside the with block as part of a stage
+
+        Args:
+            name (str): The name of the stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.add_time(name, elapsed)
+            self.logger.debug("Stage '%s' took %.3f s" % (name, elapsed))
+
+    def add_time(self, name, seconds):
+        """
+        Add time measured elsewhere to a stage
+
+        Args:
+            name (str): The name of the stage
+            seconds (float): The time to add
+        """
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def timed(self, name, func, *args):
+        """
+        Call a function as part of a stage
+
+        Args:
+            name (str): The name of the stage
+            func: The function to call
+            args: The arguments to call it with
+        Returns:
+            result: What the function returned
+        """
+        with self.stage(name):
+            return func(*args)
+
+    def add(self, counter, amount=1):
+        """
+        Add to a counter
+
+        Args:
+            counter (str): The name of the counter
+            amount (int): How much to add
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def add_upload(self, name, nbytes, seconds, complete=True):
+        """
+        Record the upload of one local file
+
+        Args:
+            name (str): The name of the file
+            nbytes (int): The number of bytes sent by this run
+            seconds (float): The time the upload took
+            complete (bool): Whether the file was uploaded, False if the upload failed
+        """
+        with self._lock:
+            self.uploads.append({'name': name, 'bytes': nbytes, 'seconds': seconds, 'complete': complete})
+
+    def as_dict(self):
+        """
+        The metrics as a JSON serializable dict
+
+        Returns:
+            metrics (dict): 'stages' mapping stage names to seconds, one key per counter, 'uploads' and
+                'upload_mb_per_second', the bytes uploaded over the time at least one upload was running
+        """
+        with self._lock:
+            metrics = {'stages': dict(self.stages), 'uploads': [dict(upload) for upload in self.uploads]}
+            metrics.update(self.counters)
+        upload_seconds = metrics['stages'].get('upload')
+        metrics['upload_mb_per_second'] = metrics['bytes_uploaded'] / 1e6 / upload_seconds if upload_seconds else None
+        return metrics
+
+    def write(self, filename):
+        """
+        Write the metrics to a JSON file
+
+        Args:
+            filename (str): The file to write
+        """
+        try:
+            with open(filename, 'w') as metrics_file:
+                json.dump(self.as_dict(), metrics_file, indent=2, sort_keys=True)
+        except IOError as e:
+            self.logger.error(e)
+            raise IOError(e)
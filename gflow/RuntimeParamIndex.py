@@ -0,0 +1,85 @@
+import logging
+
+from gflow.WorkflowAnalyzer import decode_state, parameter_paths
+
+
+class RuntimeParamIndex(object):
+    def __init__(self, workflow, local_workflow=None):
+        """
+        Look up the steps of a workflow by parameter name, label, UUID, tool ID or step ID
+
+        The index is built once per workflow so resolving each runtime parameter is a dict lookup
+        rather than a scan of every step. Galaxy does not always report step labels and UUIDs, so
+        they are also taken from the .ga file the workflow was imported from when it is given.
+
+        Args:
+            workflow (Workflow): The imported workflow
+            local_workflow (LocalWorkflow): The .ga file the workflow was imported from, if it was imported from one
+        Attributes:
+            self.logger: For logging.
+            self.by_param (dict): Tool parameter path, such as 'cond|value' or 'rep_0|value', to the IDs of
+                the steps that have it, see parameter_paths
+            self.by_ref (dict): Step label, UUID, tool ID or step ID to the IDs of the matching steps
+        """
+        self.logger = logging.getLogger('gflow.RuntimeParamIndex')
+        self.by_param = {}
+        self.by_ref = {}
+        for step_id, step in workflow.steps.items():
+            self.add_ref(step_id, step_id)
+            if step.type != 'tool':
+                continue
+            self.add_ref(step.tool_id, step_id)
+            self.add_ref(step.wrapped.get('label'), step_id)
+            self.add_ref(step.wrapped.get('uuid'), step_id)
+            for name in parameter_paths(decode_state(step.tool_inputs or {})):
+                self.by_param.setdefault(name, []).append(step_id)
+        if local_workflow is not None:
+            self.add_ga_refs(workflow, local_workflow)
+        for ids in list(self.by_param.values()) + list(self.by_ref.values()):
+            ids.sort(key=int)
+
+    def add_ref(self, ref, step_id):
+        if ref is not None and step_id not in self.by_ref.get(str(ref), []):
+            self.by_ref.setdefault(str(ref), []).append(step_id)
+
+    def add_ga_refs(self, workflow, local_workflow):
+        """
+        Add the labels and UUIDs from the .ga file
+
+        Galaxy numbers the steps of an imported workflow in the order of the file's steps, so the n-th
+        step of each is matched. Nothing is added if the two do not line up.
+        """
+        ga_steps = [local_workflow.steps[key] for key in sorted(local_workflow.steps, key=int)]
+        step_ids = sorted(workflow.steps, key=int)
+        if len(ga_steps) != len(step_ids) or \
+                any(ga_steps[i].tool_id != workflow.steps[step_ids[i]].tool_id for i in range(0, len(step_ids))):
+            self.logger.warning("Steps of the workflow file do not match the imported workflow, "
+                                "steps can only be targeted by tool or step ID")
+            return
+        for i in range(0, len(step_ids)):
+            if ga_steps[i].type == 'tool':
+                self.add_ref(ga_steps[i].label, step_ids[i])
+                self.add_ref(ga_steps[i].uuid, step_ids[i])
+
+    def steps_for(self, name, step=None):
+        """
+        Find the steps a runtime parameter applies to
+
+        Args:
+            name (str): The name of the tool parameter
+            step (str): A step label, UUID, tool ID or step ID to restrict the match to
+        Returns:
+            step_ids (list): The IDs of the matching steps, raises ValueError if step matches nothing
+        """
+        candidates = self.by_param.get(name, [])
+        if step is not None:
+            if str(step) not in self.by_ref:
+                self.logger.error("No step matches '%s' in runtime parameters" % step)
+                raise ValueError("No step matches '%s' in runtime parameters" % step)
+            candidates = [step_id for step_id in self.by_ref[str(step)] if step_id in candidates]
+        if len(candidates) > 1:
+            self.logger.warning("Runtime parameter '%s' matches steps %s, set 'step' to target one of them"
+                                % (name, str(candidates)))
+        elif not candidates:
+            self.logger.warning("Runtime parameter '%s' matches no step" % name)
+        return candidates
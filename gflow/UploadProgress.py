@@ -0,0 +1,149 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+
+DEFAULT_PROGRESS_INTERVAL = 10
+MEGABYTE = 1000.0 * 1000.0
+
+
+class UploadProgress(object):
+    def __init__(self, metrics=None, interval=DEFAULT_PROGRESS_INTERVAL):
+        """
+        Follow the bytes sent by every upload of a run and report progress and throughput
+
+        Uploads running at the same time are tracked together. At most one report is logged every
+        interval seconds, with the overall throughput, the time left for the files being uploaded and
+        how far each of them got. Throughput is measured over the time at least one upload was running.
+
+        Args:
+            metrics (RunMetrics): Where the bytes sent, the upload time and each file's upload are recorded, if given
+            interval (float): The least number of seconds between two reports
+        Attributes:
+            self.logger: For logging.
+            self.metrics (RunMetrics): Where the bytes sent, the upload time and each file's upload are recorded
+            self.interval (float): The least number of seconds between two reports
+            self.sent (int): The number of bytes sent so far
+            self.busy_seconds (float): The time uploads were running, not counting the uploads still running
+        """
+        self.logger = logging.getLogger('gflow.UploadProgress')
+        self.metrics = metrics
+        self.interval = interval
+        self.sent = 0
+        self.busy_seconds = 0.0
+        self._uploads = {}
+        self._tokens = itertools.count()
+        self._busy_since = None
+        self._last_report = None
+        self._lock = threading.Lock()
+
+    def start(self, path, size, sent=0):
+        """
+        Start following the upload of a file
+
+        Args:
+            path (str): The file being uploaded
+            size (int): The size of the file
+            sent (int): The number of bytes Galaxy already holds, for a resumed upload
+        Returns:
+            token (int): Identifies the upload in calls to advance and finish
+        """
+        now = time.time()
+        with self._lock:
+            token = next(self._tokens)
+            if not self._uploads:
+                self._busy_since = now
+                self._last_report = now
+            self._uploads[token] = {'name': os.path.basename(path), 'size': size, 'done': sent, 'sent': 0,
+                                    'started': now}
+        return token
+
+    def advance(self, token, nbytes):
+        """
+        Count bytes sent for an upload, then report if the last report is old enough
+
+        Args:
+            token (int): The upload, as returned by start
+            nbytes (int): The number of bytes sent
+        """
+        with self._lock:
+            upload = self._uploads[token]
+            upload['done'] += nbytes
+            upload['sent'] += nbytes
+            self.sent += nbytes
+        if self.metrics is not None:
+            self.metrics.add('bytes_uploaded', nbytes)
+        self.report()
+
+    def finish(self, token, complete=True):
+        """
+        Stop following an upload
+
+        Bytes of a complete upload that were not counted with advance, such as those of a file sent in
+        a single request, are counted now.
+
+        Args:
+            token (int): The upload, as returned by start
+            complete (bool): Whether the file was uploaded, False if the upload failed
+        """
+        with self._lock:
+            upload = self._uploads[token]
+            remaining = upload['size'] - upload['done']
+        if complete and remaining > 0:
+            self.advance(token, remaining)
+        now = time.time()
+        with self._lock:
+            del self._uploads[token]
+            if not self._uploads:
+                self.busy_seconds += now - self._busy_since
+                busy = now - self._busy_since
+            else:
+                busy = None
+        seconds = now - upload['started']
+        if complete:
+            self.logger.info("Uploaded '%s': %.1f MB in %.1f s (%.2f MB/s)"
+                             % (upload['name'], upload['sent'] / MEGABYTE, seconds, self.rate(upload['sent'], seconds)))
+        if self.metrics is not None:
+            self.metrics.add_upload(upload['name'], upload['sent'], seconds, complete)
+            if busy is not None:
+                self.metrics.add_time('upload', busy)
+
+    @staticmethod
+    def rate(nbytes, seconds):
+        """
+        Megabytes per second, 0 if no time has passed
+        """
+        return nbytes / MEGABYTE / seconds if seconds > 0 else 0.0
+
+    def throughput(self):
+        """
+        The overall upload rate in megabytes per second, over the time at least one upload was running
+        """
+        with self._lock:
+            seconds = self.busy_seconds
+            if self._uploads:
+                seconds += time.time() - self._busy_since
+            return self.rate(self.sent, seconds)
+
+    def report(self, force=False):
+        """
+        Log the progress of the running uploads, unless the last report is less than self.interval seconds old
+
+        Args:
+            force (bool): Report even if the last report is recent
+        """
+        now = time.time()
+        with self._lock:
+            if not self._uploads or (not force and now - self._last_report < self.interval):
+                return
+            self._last_report = now
+            uploads = [dict(upload) for upload in self._uploads.values()]
+        throughput = self.throughput()
+        remaining = sum(upload['size'] - upload['done'] for upload in uploads)
+        eta = "%d s" % (remaining / MEGABYTE / throughput) if throughput > 0 else "unknown"
+        files = ', '.join("%s %d%%" % (upload['name'], 100 * upload['done'] // upload['size'] if upload['size'] else 100)
+                          for upload in sorted(uploads, key=lambda upload: upload['started']))
+        self.logger.info("Uploading %d file(s) at %.2f MB/s, %.1f MB left, ETA %s: %s"
+                         % (len(uploads), throughput, remaining / MEGABYTE, eta, files))
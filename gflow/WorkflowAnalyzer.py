@@ -0,0 +1,194 @@
+import json
+import logging
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def decode_state(value):
+    """
+    Decode a tool state value, which Galaxy stores as JSON nested inside JSON strings
+
+    Args:
+        value: A value from a step's tool_state or tool_inputs
+    Returns:
+        value: The value with every JSON encoded string in it decoded
+    """
+    while isinstance(value, string_types) and value[:1] in ('{', '[', '"'):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            break
+    if isinstance(value, dict):
+        return dict((key, decode_state(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [decode_state(item) for item in value]
+    return value
+
+
+def runtime_value_paths(state, prefix=''):
+    """
+    Find the parameters left to be set at runtime in a decoded tool state
+
+    Args:
+        state (dict): The decoded tool state
+        prefix (str): The path of state within the step's tool state
+    Returns:
+        paths (list): The '|' separated path of each RuntimeValue, repeats are named '<name>_<index>'
+    """
+    paths = []
+    for key in sorted(state):
+        if key.startswith('__'):
+            continue
+        value = state[key]
+        path = prefix + key
+        if isinstance(value, dict):
+            if value.get('__class__') == 'RuntimeValue':
+                paths.append(path)
+            else:
+                paths.extend(runtime_value_paths(value, path + '|'))
+        elif isinstance(value, list):
+            for i in range(0, len(value)):
+                if isinstance(value[i], dict):
+                    paths.extend(runtime_value_paths(value[i], '%s_%s|' % (path, value[i].get('__index__', i))))
+    return paths
+
+
+def parameter_paths(state, prefix=''):
+    """
+    Find every name a runtime parameter can give to set a value in a decoded tool state
+
+    These are the '|' separated paths of the parameters, and of the conditionals and repeats holding
+    them, named the way runtime_value_paths names them. A runtime parameter sets the value at its
+    path and every value nested under it.
+
+    Args:
+        state (dict): The decoded tool state
+        prefix (str): The path of state within the step's tool state
+    Returns:
+        paths (list): The path of every parameter, conditional and repeat
+    """
+    paths = []
+    for key in sorted(state):
+        if key.startswith('__'):
+            continue
+        value = state[key]
+        path = prefix + key
+        paths.append(path)
+        if isinstance(value, dict) and '__class__' not in value:
+            paths.extend(parameter_paths(value, path + '|'))
+        elif isinstance(value, list):
+            for i in range(0, len(value)):
+                if isinstance(value[i], dict):
+                    paths.extend(parameter_paths(value[i], '%s_%s|' % (path, value[i].get('__index__', i))))
+    return paths
+
+
+def sets_path(name, path):
+    """
+    Whether a runtime parameter with the given name sets the value at a path, see parameter_paths
+    """
+    return name == path or path.startswith(name + '|')
+
+
+def workflow_steps(workflow):
+    """
+    Get the step dicts of a workflow, whatever form it is in
+
+    Args:
+        workflow: A Workflow object, a LocalWorkflow, a dict from Galaxy's API or a dict loaded from a .ga file
+    Returns:
+        steps (dict): Step ID to step dict
+    """
+    if isinstance(workflow, dict):
+        return workflow.get('steps', {})
+    return dict((step_id, step.wrapped if hasattr(step, 'wrapped') else step.as_dict())
+                for step_id, step in workflow.steps.items())
+
+
+def find_runtime_values(workflow):
+    """
+    List every tool parameter of a workflow that is left to be set at runtime, in one pass over its steps
+
+    Args:
+        workflow: A Workflow object, a LocalWorkflow, a dict from Galaxy's API or a dict loaded from a .ga file
+    Returns:
+        missing (list): A (step ID, step label, parameter path) tuple per RuntimeValue, in step order
+    """
+    missing = []
+    steps = workflow_steps(workflow)
+    for step_id in sorted(steps, key=lambda step_id: int(step_id)):
+        step = steps[step_id]
+        if step.get('type') != 'tool':
+            continue
+        state = decode_state(step['tool_state'] if 'tool_state' in step else step.get('tool_inputs') or {})
+        label = step.get('label') or step.get('name') or step.get('tool_id')
+        for path in runtime_value_paths(state):
+            missing.append((str(step_id), label, path))
+    return missing
+
+
+def step_refs(step_id, step):
+    """
+    The ways a runtime parameter entry in the config can name a step
+
+    Args:
+        step_id (str): The ID of the step
+        step (dict): The step dict
+    Returns:
+        refs (set): The step's ID, label, UUID and tool ID
+    """
+    return set(str(ref) for ref in (step_id, step.get('label'), step.get('uuid'), step.get('tool_id'))
+               if ref is not None)
+
+
+def unset_runtime_values(workflow, runtime_params):
+    """
+    List the RuntimeValues of a workflow that the runtime parameters from the config do not set
+
+    A parameter sets a RuntimeValue when its name is the value's path or the path of a parameter
+    containing it, and its tool entry either has no 'step' or names the value's step. This is the
+    rule RuntimeParamIndex binds parameters to steps by when the workflow is run. A 'step' must name
+    a step of the workflow by label, UUID, tool ID or step ID.
+
+    Args:
+        workflow: A Workflow object, a LocalWorkflow, a dict from Galaxy's API or a dict loaded from a .ga file
+        runtime_params (dict): The runtime_params section of the config, may be None
+    Returns:
+        missing (list): A (step ID, step label, parameter path) tuple per RuntimeValue left unset,
+            raises ValueError if a 'step' matches no step
+    """
+    configured = []
+    for tool in (runtime_params or {}).values():
+        for key, param in tool.items():
+            if key.startswith('param_') and isinstance(param, dict) and 'name' in param:
+                configured.append((tool.get('step'), param['name']))
+    steps = workflow_steps(workflow)
+    all_refs = set()
+    for step_id in steps:
+        all_refs |= step_refs(step_id, steps[step_id])
+    for step, name in configured:
+        if step is not None and str(step) not in all_refs:
+            logger = logging.getLogger('gflow.WorkflowAnalyzer')
+            logger.error("No step matches '%s' in runtime parameters" % step)
+            raise ValueError("No step matches '%s' in runtime parameters" % step)
+    missing = []
+    for step_id, label, path in find_runtime_values(workflow):
+        refs = step_refs(step_id, steps[step_id])
+        if not any((step is None or str(step) in refs) and sets_path(name, path) for step, name in configured):
+            missing.append((step_id, label, path))
+    return missing
+
+
+def describe_runtime_values(missing):
+    """
+    Describe RuntimeValues for a log or error message
+
+    Args:
+        missing (list): (step ID, step label, parameter path) tuples
+    Returns:
+        description (str): One 'step <id> (<label>): <path>' entry per value, separated by semicolons
+    """
+    return '; '.join("step %s (%s): %s" % entry for entry in missing)
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import logging
+
+from bioblend.galaxy.client import ConnectionError
+
+from gflow.JsonStore import JsonStore
+
+
+class WorkflowCache(object):
+    def __init__(self, galaxy_url, store=None):
+        """
+        Remember which Galaxy workflow was imported from the content of a .ga file
+
+        Args:
+            galaxy_url (str): The URL of the instance of Galaxy the workflows live on
+            store (JsonStore): Where entries are kept, defaults to workflows.json in the cache dir
+        Attributes:
+            self.logger: For logging.
+            self.galaxy_url (str): The URL of the instance of Galaxy the workflows live on
+            self.store (JsonStore): Where entries are kept
+        """
+        self.logger = logging.getLogger('gflow.WorkflowCache')
+        self.galaxy_url = galaxy_url.rstrip('/')
+        self.store = store if store is not None else JsonStore.in_cache_dir('workflows.json')
+
+    @staticmethod
+    def canonical_hash(workflow):
+        """
+        Hash a workflow so that formatting and key order in the .ga file do not matter
+
+        Args:
+            workflow (dict): The workflow as loaded from the .ga file
+        Returns:
+            digest (str): The SHA-1 hex digest of the workflow's canonical JSON form
+        """
+        canonical = json.dumps(workflow, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def key(self, digest):
+        return '%s|%s' % (self.galaxy_url, digest)
+
+    def remember(self, digest, workflow_id):
+        self.store.set(self.key(digest), workflow_id)
+
+    def forget(self, digest):
+        self.store.delete(self.key(digest))
+
+    def lookup(self, gi, digest):
+        """
+        Get the workflow previously imported from the same content, if it still exists
+
+        Args:
+            gi (GalaxyInstance): The instance of Galaxy the workflow lives on
+            digest (str): The canonical hash of the workflow
+        Returns:
+            wf (Workflow): The workflow, None if it was never imported or has since been deleted
+        """
+        workflow_id = self.store.get(self.key(digest))
+        if workflow_id is None:
+            return None
+        try:
+            wf = gi.workflows.get(workflow_id)
+        except (ConnectionError, ValueError) as e:
+            wf = None
+        if wf is None or wf.deleted:
+            self.logger.info("Cached workflow '%s' is no longer available, forgetting it" % workflow_id)
+            self.forget(digest)
+            return None
+        return wf
@@ -30,5 +30,7 @@ setup(
     author = "Alex MacLean",
     author_email = "maclean199@gmail.com",
     url = "https://github.com/AAFC-MBB/gflow",
+    # gflow.AsyncGalaxyCMDWorkflow needs Python 3.5 or later and aiohttp, nothing else does
+    extras_require = {'async': ['aiohttp']},
     cmdclass = {'test': PyTest}
 )
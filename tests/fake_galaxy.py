@@ -0,0 +1,572 @@
+"""
+A stand-in Galaxy server for tests and benchmarks
+
+FakeGalaxy serves the parts of the Galaxy API that gflow uses (workflows, histories and their
+contents, dataset collections, libraries, datasets, tools and chunked uploads) from memory, on a
+local port, in a background thread. Every request can be slowed down by a fixed latency, the bytes
+sent and received by all requests share one bandwidth limit, and new datasets can be made to take a while
+to finish, so concurrency and caching can be measured without a real Galaxy.
+
+    with FakeGalaxy(latency=0.05) as galaxy:
+        gflow = GalaxyCMDWorkflow.init_from_params(galaxy.url, galaxy.api_key, ...)
+        gflow.run()
+        print(galaxy.request_count('POST', '/api/tools'))
+"""
+import email.parser
+import email.policy
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_API_KEY = 'fake-galaxy-key'
+
+
+class GalaxyError(Exception):
+    def __init__(self, status, message):
+        super(GalaxyError, self).__init__(message)
+        self.status = status
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeGalaxy(object):
+    def __init__(self, latency=0.0, bandwidth=None, job_seconds=0.0, tools=None, api_key=DEFAULT_API_KEY):
+        """
+        An in-memory Galaxy that answers HTTP requests on 127.0.0.1
+
+        Args:
+            latency (float): Seconds added to every request
+            bandwidth (float): Bytes per second shared by the bodies and replies of all requests, unlimited if None
+            job_seconds (float): Seconds a new dataset stays 'queued' before it is 'ok'
+            tools (list): The IDs of the installed tools, any tool a workflow uses if None
+            api_key (str): The only API key accepted
+        Attributes:
+            self.url (str): The URL of the server, once started
+            self.requests (list): A (method, path) tuple per request received, in order
+            self.histories, self.datasets, self.collections, self.libraries, self.library_datasets,
+            self.workflows (dict): What the server holds, by ID
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.job_seconds = job_seconds
+        self.tools = tools
+        self.api_key = api_key
+        self.url = None
+        self.requests = []
+        self.histories = {}
+        self.datasets = {}
+        self.collections = {}
+        self.libraries = {}
+        self.library_datasets = {}
+        self.workflows = {}
+        self.invocations = {}
+        self.uploads = {}
+        self._ids = 0
+        self._link_free_at = 0.0
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+        self.routes = [
+            ('GET', r'/api/tools', self.list_tools),
+            ('POST', r'/api/tools', self.run_tool),
+            ('POST', r'/api/upload', self.upload_chunk),
+            ('GET', r'/api/histories', self.list_histories),
+            ('POST', r'/api/histories', self.create_history),
+            ('GET', r'/api/histories/(\w+)', self.show_history),
+            ('DELETE', r'/api/histories/(\w+)', self.delete_history),
+            ('GET', r'/api/histories/(\w+)/contents', self.history_contents),
+            ('POST', r'/api/histories/(\w+)/contents', self.add_history_content),
+            ('GET', r'/api/histories/(\w+)/contents/dataset_collections/(\w+)', self.show_collection),
+            ('GET', r'/api/histories/(\w+)/contents/(?:datasets/)?(\w+)', self.show_history_dataset),
+            ('GET', r'/api/datasets/(\w+)', self.show_dataset),
+            ('GET', r'/api/libraries', self.list_libraries),
+            ('POST', r'/api/libraries', self.create_library),
+            ('GET', r'/api/libraries/(\w+)', self.show_library),
+            ('DELETE', r'/api/libraries/(\w+)', self.delete_library),
+            ('GET', r'/api/libraries/(\w+)/contents', self.library_contents),
+            ('POST', r'/api/libraries/(\w+)/contents', self.add_library_content),
+            ('GET', r'/api/libraries/(\w+)/contents/(\w+)', self.show_library_dataset),
+            ('GET', r'/api/workflows', self.list_workflows),
+            ('POST', r'/api/workflows/upload', self.upload_workflow),
+            ('POST', r'/api/workflows', self.invoke_workflow),
+            ('GET', r'/api/workflows/(\w+)', self.show_workflow),
+            ('GET', r'/api/workflows/(\w+)/invocations', self.list_invocations),
+            ('DELETE', r'/api/workflows/(\w+)', self.delete_workflow),
+        ]
+
+    def start(self):
+        """
+        Start serving on a free port
+
+        Returns:
+            galaxy (FakeGalaxy): self, with self.url set
+        """
+        self._server = ThreadingServer(('127.0.0.1', 0), make_handler(self))
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def request_count(self, method=None, path=None):
+        """
+        Count the requests received, optionally only those with the given method and path
+        """
+        return len([request for request in self.requests
+                    if method in (None, request[0]) and (path is None or re.match(path + '$', request[1]))])
+
+    def transfer_delay(self, nbytes):
+        """
+        Reserve the shared link for a transfer, queued behind the transfers already on it
+
+        Args:
+            nbytes (int): The number of bytes to send
+        Returns:
+            delay (float): Seconds from now until the transfer is done
+        """
+        if not self.bandwidth:
+            return 0.0
+        with self._lock:
+            now = time.time()
+            self._link_free_at = max(now, self._link_free_at) + float(nbytes) / self.bandwidth
+            return self._link_free_at - now
+
+    def new_id(self):
+        with self._lock:
+            self._ids += 1
+            return '%016x' % self._ids
+
+    def handle(self, method, path, params, body):
+        """
+        Answer one API request
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path of the URL
+            params (dict): The query parameters
+            body (dict): The decoded request body
+        Returns:
+            status (int), reply: The HTTP status and the object to send back as JSON
+        """
+        with self._lock:
+            self.requests.append((method, path))
+        if self.api_key not in (params.get('key'), body.get('key')):
+            return 403, {'err_msg': 'Provided API key is not valid.'}
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern + '/?$', path)
+            if route_method == method and match:
+                try:
+                    with self._lock:
+                        return 200, handler(params, body, *match.groups())
+                except GalaxyError as e:
+                    return e.status, {'err_msg': str(e)}
+        return 404, {'err_msg': 'No route for %s %s' % (method, path)}
+
+    def lookup(self, table, item_id, kind):
+        if item_id not in table or table[item_id].get('purged'):
+            raise GalaxyError(400, 'Invalid %s id (%s) specified' % (kind, item_id))
+        return table[item_id]
+
+    # Datasets
+
+    def new_dataset(self, history_id, name, size, file_ext='auto', ready=False):
+        history = self.lookup(self.histories, history_id, 'history')
+        dataset = {'id': self.new_id(), 'name': name, 'history_id': history_id, 'hid': len(history['contents']) + 1,
+                   'file_size': size, 'file_ext': 'data' if file_ext == 'auto' else file_ext, 'deleted': False,
+                   'purged': False, 'visible': True, 'ready_at': 0 if ready else time.time() + self.job_seconds}
+        self.datasets[dataset['id']] = dataset
+        history['contents'].append(dataset['id'])
+        return dataset
+
+    def dataset_state(self, dataset):
+        return 'ok' if time.time() >= dataset['ready_at'] else 'queued'
+
+    def dataset_dict(self, dataset):
+        info = dict((key, value) for key, value in dataset.items() if key != 'ready_at')
+        info.update({'state': self.dataset_state(dataset), 'type': 'file', 'history_content_type': 'dataset',
+                     'model_class': 'HistoryDatasetAssociation', 'data_type': dataset['file_ext'],
+                     'url': '/api/histories/%s/contents/%s' % (dataset['history_id'], dataset['id'])})
+        return info
+
+    def show_dataset(self, params, body, dataset_id):
+        return self.dataset_dict(self.lookup(self.datasets, dataset_id, 'dataset'))
+
+    def show_history_dataset(self, params, body, history_id, dataset_id):
+        dataset = self.lookup(self.datasets, dataset_id, 'dataset')
+        if dataset['history_id'] != history_id:
+            raise GalaxyError(400, 'Dataset %s is not in history %s' % (dataset_id, history_id))
+        return self.dataset_dict(dataset)
+
+    # Tools and uploads
+
+    def list_tools(self, params, body):
+        tool_ids = set(self.tools if self.tools is not None else [])
+        if self.tools is None:
+            for workflow in self.workflows.values():
+                tool_ids |= set(step['tool_id'] for step in workflow['ga']['steps'].values() if step.get('tool_id'))
+        return [{'id': tool_id, 'name': tool_id, 'version': '1.0'} for tool_id in sorted(tool_ids | {'upload1'})]
+
+    def upload_chunk(self, params, body):
+        session_id, start = body['session_id'], int(body['session_start'])
+        if start != self.uploads.get(session_id, 0):
+            raise GalaxyError(400, 'Incorrect session start.')
+        self.uploads[session_id] = start + len(body['session_chunk'])
+        return {'message': 'Successful.'}
+
+    def run_tool(self, params, body):
+        inputs = body.get('inputs') or {}
+        if isinstance(inputs, str):
+            inputs = json.loads(inputs)
+        if body.get('tool_id') != 'upload1':
+            raise GalaxyError(400, "Tool '%s' cannot be run directly" % body.get('tool_id'))
+        file_type = inputs.get('file_type', 'auto')
+        if 'files_0|file_data' in body:
+            uploads = [(inputs.get('files_0|NAME') or 'upload', len(body['files_0|file_data']))]
+        elif isinstance(inputs.get('files_0|file_data'), dict):
+            session = inputs['files_0|file_data']
+            if session['session_id'] not in self.uploads:
+                raise GalaxyError(400, "No upload session '%s'" % session['session_id'])
+            uploads = [(session.get('name') or 'upload', self.uploads.pop(session['session_id']))]
+        elif inputs.get('files_0|url_paste'):
+            uploads = [(line.strip(), 0) for line in inputs['files_0|url_paste'].splitlines() if line.strip()]
+        else:
+            raise GalaxyError(400, 'Nothing to upload')
+        outputs = [self.dataset_dict(self.new_dataset(body['history_id'], name, size, file_type))
+                   for name, size in uploads]
+        return {'outputs': outputs, 'jobs': [{'id': self.new_id(), 'state': 'queued'}],
+                'output_collections': [], 'implicit_collections': []}
+
+    # Histories
+
+    def history_dict(self, history):
+        details = dict((state, 0) for state in ('ok', 'queued', 'running', 'error', 'new', 'paused', 'upload'))
+        for dataset_id in history['contents']:
+            dataset = self.datasets.get(dataset_id)
+            if dataset and not dataset['deleted']:
+                details[self.dataset_state(dataset)] += 1
+        pending = details['queued'] or details['running']
+        return {'id': history['id'], 'name': history['name'], 'deleted': history['deleted'],
+                'purged': history['purged'], 'state': 'queued' if pending else 'ok', 'state_details': details,
+                'url': '/api/histories/%s' % history['id'], 'model_class': 'History'}
+
+    def list_histories(self, params, body):
+        deleted = params.get('deleted') in ('true', 'True')
+        return [self.history_dict(history) for history in self.histories.values()
+                if history['deleted'] == deleted and not history['purged']
+                and params.get('name') in (None, history['name'])]
+
+    def create_history(self, params, body):
+        history = {'id': self.new_id(), 'name': body.get('name') or 'Unnamed history', 'deleted': False,
+                   'purged': False, 'contents': []}
+        self.histories[history['id']] = history
+        return self.history_dict(history)
+
+    def show_history(self, params, body, history_id):
+        return self.history_dict(self.lookup(self.histories, history_id, 'history'))
+
+    def delete_history(self, params, body, history_id):
+        history = self.lookup(self.histories, history_id, 'history')
+        history['deleted'] = True
+        if body.get('purge') or params.get('purge') in ('true', 'True'):
+            history['purged'] = True
+            for dataset_id in history['contents']:
+                if dataset_id in self.datasets:
+                    self.datasets[dataset_id].update({'deleted': True, 'purged': True})
+        return self.history_dict(history)
+
+    def history_contents(self, params, body, history_id):
+        history = self.lookup(self.histories, history_id, 'history')
+        contents = []
+        for item_id in history['contents']:
+            if item_id in self.datasets:
+                info = self.dataset_dict(self.datasets[item_id])
+            else:
+                info = self.collection_dict(self.collections[item_id])
+            if params.get('details') == 'all':
+                contents.append(info)
+                continue
+            contents.append(dict((key, info[key]) for key in ('id', 'name', 'hid', 'type', 'history_content_type',
+                                                              'deleted', 'visible', 'url', 'state') if key in info))
+        return contents
+
+    def add_history_content(self, params, body, history_id):
+        history = self.lookup(self.histories, history_id, 'history')
+        if body.get('type') == 'dataset_collection':
+            return self.create_collection(history, body)
+        source = body.get('source')
+        if source == 'library':
+            original = self.lookup(self.library_datasets, body.get('content'), 'library dataset')
+            return self.dataset_dict(self.new_dataset(history_id, original['name'], original['file_size'],
+                                                      original['file_ext'], ready=True))
+        if source == 'hda':
+            original = self.lookup(self.datasets, body.get('content'), 'dataset')
+            copy = self.new_dataset(history_id, original['name'], original['file_size'], original['file_ext'])
+            copy['ready_at'] = original['ready_at']
+            return self.dataset_dict(copy)
+        raise GalaxyError(400, "Unknown source '%s'" % source)
+
+    # Dataset collections
+
+    def collection_elements(self, identifiers, history_id):
+        elements = []
+        for index, identifier in enumerate(identifiers):
+            if identifier.get('src') == 'new_collection':
+                element = {'element_type': 'dataset_collection',
+                           'object': {'collection_type': identifier['collection_type'],
+                                      'elements': self.collection_elements(identifier['element_identifiers'],
+                                                                           history_id)}}
+            elif identifier.get('src') == 'hda':
+                element = {'element_type': 'hda',
+                           'object': self.dataset_dict(self.lookup(self.datasets, identifier['id'], 'dataset'))}
+            else:
+                raise GalaxyError(400, "Unknown element source '%s'" % identifier.get('src'))
+            element.update({'element_identifier': identifier['name'], 'element_index': index})
+            elements.append(element)
+        return elements
+
+    def create_collection(self, history, body):
+        collection = {'id': self.new_id(), 'name': body.get('name'), 'history_id': history['id'],
+                      'hid': len(history['contents']) + 1, 'collection_type': body['collection_type'],
+                      'elements': self.collection_elements(body.get('element_identifiers') or [], history['id']),
+                      'deleted': False, 'visible': True}
+        self.collections[collection['id']] = collection
+        history['contents'].append(collection['id'])
+        return self.collection_dict(collection)
+
+    def collection_dict(self, collection):
+        info = dict(collection)
+        info.update({'type': 'collection', 'history_content_type': 'dataset_collection', 'populated': True,
+                     'model_class': 'HistoryDatasetCollectionAssociation', 'element_count': len(collection['elements']),
+                     'url': '/api/histories/%s/contents/dataset_collections/%s' % (collection['history_id'],
+                                                                                   collection['id'])})
+        return info
+
+    def show_collection(self, params, body, history_id, collection_id):
+        return self.collection_dict(self.lookup(self.collections, collection_id, 'dataset collection'))
+
+    # Libraries
+
+    def library_dict(self, library):
+        return {'id': library['id'], 'name': library['name'], 'deleted': library['deleted'],
+                'root_folder_id': library['root_folder_id'], 'description': '', 'synopsis': '',
+                'url': '/api/libraries/%s' % library['id'], 'model_class': 'Library'}
+
+    def list_libraries(self, params, body):
+        deleted = params.get('deleted') in ('true', 'True')
+        return [self.library_dict(library) for library in self.libraries.values() if library['deleted'] == deleted]
+
+    def create_library(self, params, body):
+        library_id = self.new_id()
+        library = {'id': library_id, 'name': body.get('name'), 'deleted': False, 'root_folder_id': 'F' + library_id,
+                   'contents': []}
+        self.libraries[library_id] = library
+        return self.library_dict(library)
+
+    def show_library(self, params, body, library_id):
+        return self.library_dict(self.lookup(self.libraries, library_id, 'library'))
+
+    def delete_library(self, params, body, library_id):
+        library = self.lookup(self.libraries, library_id, 'library')
+        library['deleted'] = True
+        return self.library_dict(library)
+
+    def library_dataset_dict(self, dataset):
+        info = dict(dataset)
+        info.update({'type': 'file', 'state': 'ok', 'model_class': 'LibraryDataset', 'data_type': dataset['file_ext'],
+                     'url': '/api/libraries/%s/contents/%s' % (dataset['library_id'], dataset['id'])})
+        return info
+
+    def library_contents(self, params, body, library_id):
+        library = self.lookup(self.libraries, library_id, 'library')
+        contents = [{'id': library['root_folder_id'], 'name': '/', 'type': 'folder',
+                     'url': '/api/libraries/%s/contents/%s' % (library_id, library['root_folder_id'])}]
+        for dataset_id in library['contents']:
+            dataset = self.library_datasets[dataset_id]
+            contents.append({'id': dataset_id, 'name': '/' + dataset['name'], 'type': 'file',
+                             'url': '/api/libraries/%s/contents/%s' % (library_id, dataset_id)})
+        return contents
+
+    def new_library_dataset(self, library, name, size, file_ext, **extra):
+        dataset = {'id': self.new_id(), 'name': name, 'library_id': library['id'], 'file_size': size,
+                   'file_ext': 'data' if file_ext == 'auto' else file_ext, 'deleted': False}
+        dataset.update(extra)
+        self.library_datasets[dataset['id']] = dataset
+        library['contents'].append(dataset['id'])
+        return dataset
+
+    def add_library_content(self, params, body, library_id):
+        library = self.lookup(self.libraries, library_id, 'library')
+        if body.get('from_hda_id'):
+            original = self.lookup(self.datasets, body['from_hda_id'], 'dataset')
+            dataset = self.new_library_dataset(library, original['name'], original['file_size'], original['file_ext'])
+            info = self.library_dataset_dict(dataset)
+            info['library_dataset_id'] = dataset['id']
+            return info
+        if body.get('upload_option') == 'upload_paths':
+            created = []
+            for path in body.get('filesystem_paths', '').splitlines():
+                if not path.strip().startswith('/'):
+                    raise GalaxyError(400, "Invalid path '%s'" % path)
+                dataset = self.new_library_dataset(library, path.strip().rsplit('/', 1)[1], 0,
+                                                   body.get('file_type', 'auto'), path=path.strip(),
+                                                   linked=body.get('link_data_only') == 'link_to_files')
+                created.append({'id': dataset['id'], 'name': dataset['name'],
+                                'url': '/api/libraries/%s/contents/%s' % (library_id, dataset['id'])})
+            return created
+        raise GalaxyError(400, 'Unsupported library upload')
+
+    def show_library_dataset(self, params, body, library_id, dataset_id):
+        dataset = self.lookup(self.library_datasets, dataset_id, 'library dataset')
+        if dataset['library_id'] != library_id:
+            raise GalaxyError(400, 'Dataset %s is not in library %s' % (dataset_id, library_id))
+        return self.library_dataset_dict(dataset)
+
+    # Workflows
+
+    def list_workflows(self, params, body):
+        return [{'id': workflow['id'], 'name': workflow['name'], 'deleted': False, 'published': False,
+                 'url': '/api/workflows/%s' % workflow['id'], 'model_class': 'StoredWorkflow'}
+                for workflow in self.workflows.values()
+                if not workflow['deleted'] and params.get('name') in (None, workflow['name'])]
+
+    def upload_workflow(self, params, body):
+        ga = body.get('workflow')
+        if isinstance(ga, str):
+            ga = json.loads(ga)
+        if not isinstance(ga, dict) or not isinstance(ga.get('steps'), dict):
+            raise GalaxyError(400, 'Not a workflow')
+        workflow = {'id': self.new_id(), 'name': ga.get('name'), 'ga': ga, 'deleted': False}
+        self.workflows[workflow['id']] = workflow
+        return {'id': workflow['id'], 'name': workflow['name'], 'url': '/api/workflows/%s' % workflow['id']}
+
+    def show_workflow(self, params, body, workflow_id):
+        workflow = self.lookup(self.workflows, workflow_id, 'workflow')
+        if workflow['deleted']:
+            raise GalaxyError(400, 'Workflow %s has been deleted' % workflow_id)
+        steps, inputs = {}, {}
+        for key, step in workflow['ga']['steps'].items():
+            state = step.get('tool_state') or '{}'
+            state = json.loads(state) if isinstance(state, str) else state
+            if step['type'] in ('data_input', 'data_collection_input'):
+                label = state.get('name') or step.get('label')
+                inputs[str(key)] = {'label': label, 'value': ''}
+                tool_inputs = {}
+            else:
+                tool_inputs = dict((name, value if isinstance(value, str) else json.dumps(value))
+                                   for name, value in state.items() if not name.startswith('__'))
+            steps[str(key)] = {
+                'id': int(key), 'type': step['type'], 'tool_id': step.get('tool_id'),
+                'tool_version': step.get('tool_version'), 'annotation': step.get('annotation'),
+                'tool_inputs': tool_inputs,
+                'input_steps': dict((name, {'source_step': connection['id'], 'step_output': connection['output_name']})
+                                    for name, connection in (step.get('input_connections') or {}).items()),
+            }
+        return {'id': workflow_id, 'name': workflow['name'], 'steps': steps, 'inputs': inputs, 'deleted': False,
+                'published': False, 'tags': [], 'url': '/api/workflows/%s' % workflow_id,
+                'model_class': 'StoredWorkflow'}
+
+    def delete_workflow(self, params, body, workflow_id):
+        self.lookup(self.workflows, workflow_id, 'workflow')['deleted'] = True
+        return "Workflow '%s' successfully deleted" % workflow_id
+
+    def invoke_workflow(self, params, body):
+        workflow = self.lookup(self.workflows, body.get('workflow_id'), 'workflow')
+        history_id = body.get('history', '').replace('hist_id=', '')
+        self.lookup(self.histories, history_id, 'history')
+        ds_map = body.get('ds_map') or {}
+        parameters = body.get('parameters') or {}
+        outputs = []
+        for key in sorted(workflow['ga']['steps'], key=int):
+            step = workflow['ga']['steps'][key]
+            if step['type'] in ('data_input', 'data_collection_input'):
+                if str(key) not in ds_map:
+                    raise GalaxyError(400, 'Workflow input %s has no dataset' % key)
+                continue
+            state = step.get('tool_state') or '{}'
+            state = json.loads(state) if isinstance(state, str) else state
+            for name, value in state.items():
+                if 'RuntimeValue' in str(value) and name not in parameters.get(str(key), {}):
+                    raise GalaxyError(400, "Step %s has no value for runtime parameter '%s'" % (key, name))
+            for output in step.get('outputs') or []:
+                dataset = self.new_dataset(history_id, '%s on step %s' % (step.get('name'), key), 0,
+                                           output.get('type', 'auto'))
+                outputs.append(dataset['id'])
+        invocation = {'id': self.new_id(), 'workflow_id': workflow['id'], 'history_id': history_id,
+                      'state': 'scheduled', 'model_class': 'WorkflowInvocation'}
+        self.invocations[invocation['id']] = invocation
+        return {'history': history_id, 'outputs': outputs}
+
+    def list_invocations(self, params, body, workflow_id):
+        self.lookup(self.workflows, workflow_id, 'workflow')
+        return [dict(invocation) for invocation in self.invocations.values() if invocation['workflow_id'] == workflow_id]
+
+
+def read_body(headers, raw):
+    """
+    Decode a JSON, form or multipart request body into a dict
+    """
+    content_type = headers.get('Content-Type', '')
+    if not raw:
+        return {}
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + raw)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            fields[name] = payload if part.get_filename() else payload.decode('utf-8')
+        return fields
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict((key, values[0]) for key, values in parse_qs(raw.decode('utf-8')).items())
+    try:
+        body = json.loads(raw.decode('utf-8'))
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+def make_handler(galaxy):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            url = urlsplit(self.path)
+            params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+            raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            status, reply = galaxy.handle(self.command, url.path, params, read_body(self.headers, raw))
+            data = json.dumps(reply).encode('utf-8')
+            delay = galaxy.latency + galaxy.transfer_delay(len(raw) + len(data))
+            if delay:
+                time.sleep(delay)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -1,10 +1,30 @@
+import hashlib
+import json
+import logging
 import os
+import threading
 import uuid
 import pytest
+import requests
 import bioblend.galaxy.objects.galaxy_instance as galaxy_instance
 import bioblend.galaxy.objects.wrappers as wrappers
+from bioblend.galaxy.client import ConnectionError
 
-from gflow.GalaxyCMDWorkflow import GalaxyCMDWorkflow
+from gflow.BatchRunner import BatchRunner
+from gflow.ChunkedUploader import ChunkedUploader
+from gflow.CollectionBuilder import CollectionBuilder
+from gflow.ConnectionPool import ConnectionPool
+from gflow.DatasetCache import DatasetCache
+from gflow.Fingerprinter import Fingerprinter
+from gflow.HistoryMonitor import HistoryMonitor
+from gflow.GalaxyCMDWorkflow import GalaxyCMDWorkflow, parallel_map
+from gflow.JsonStore import JsonStore
+from gflow.LocalWorkflow import LocalWorkflow
+from gflow.PathExpander import expand_braces, expand_entry
+from gflow.RunMetrics import RunMetrics
+from gflow.UploadProgress import UploadProgress
+from gflow.WorkflowAnalyzer import find_runtime_values, unset_runtime_values
+from gflow.WorkflowCache import WorkflowCache
 
 
 @pytest.fixture()
@@ -18,6 +38,22 @@ def gflow():
 def gi(gflow):
     return galaxy_instance.GalaxyInstance(gflow.galaxy_url, gflow.galaxy_key)
 
+@pytest.fixture()
+def fake_galaxy():
+    # The fake server is Python 3 only, its tests are skipped on Python 2
+    fake_galaxy_module = pytest.importorskip("fake_galaxy")
+    with fake_galaxy_module.FakeGalaxy() as galaxy:
+        yield galaxy
+
+def fake_gflow(galaxy, tmpdir, **params):
+    datasets = {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+                1: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Features'}}
+    return GalaxyCMDWorkflow.init_from_params(
+        galaxy.url, galaxy.api_key, "Test History", "local", "workflows/galaxy101.ga", cache_dir=str(tmpdir),
+        datasets=params.pop('datasets', datasets),
+        runtime_params=params.pop('runtime_params', {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}}),
+        **params)
+
 def test_config_file_missing_required_parameter_is_rejected(tmpdir):
     p = tmpdir.mkdir("sub").join("tmp_config.yml")
     p.write("something: value")
@@ -49,6 +85,148 @@ def test_config_file_with_all_required_values_is_accepted(tmpdir):
     assert gflow.workflow_source == "something"
     assert gflow.workflow == "something"
 
+def test_batch_sample_config_fills_inputs_by_label(tmpdir):
+    p = tmpdir.join("samples.tsv")
+    p.write("sample\tExons\tFeatures\n"
+            "s1\tdata/exons.bed\tdata/s1.bed\n"
+            "s2\tdata/exons.bed\tdata/s2.bed\n")
+    samples, columns = BatchRunner.read_sample_sheet(str(p))
+    config = {'galaxy_url': 'something', 'galaxy_key': 'something', 'history_name': 'Batch',
+              'workflow_source': 'local', 'workflow': 'workflows/galaxy101.ga',
+              'datasets': {0: {'source': 'library', 'library_id': 'lib', 'dataset_id': 'ds', 'input_label': 'Exons'}}}
+    runner = BatchRunner(config, samples, columns)
+    sample_config = runner.sample_config(samples[1])
+    assert sample_config['history_name'] == 'Batch s2'
+    assert sample_config['datasets'] == {
+        0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+        1: {'source': 'local', 'dataset_file': 'data/s2.bed', 'input_label': 'Features'}}
+    assert config['datasets'][0]['source'] == 'library'
+
+def test_batch_sample_sheet_requires_unique_samples(tmpdir):
+    p = tmpdir.join("samples.tsv")
+    p.write("sample\tExons\ns1\ta.bed\ns1\tb.bed\n")
+    with pytest.raises(ValueError) as excinfo:
+        BatchRunner.read_sample_sheet(str(p))
+    assert "Duplicate sample name(s) in sample sheet: ['s1']" in str(excinfo.value)
+
+def test_batch_rejects_samples_before_connecting(tmpdir, monkeypatch):
+    p = tmpdir.join("samples.tsv")
+    p.write("sample\tExons\tExtra\n"
+            "s1\tdata/missing.bed\t\n"
+            "s2\tdata/exons.bed\tdata/exons.bed\n")
+    samples, columns = BatchRunner.read_sample_sheet(str(p))
+    config = {'galaxy_url': 'something', 'galaxy_key': 'something', 'history_name': 'Batch',
+              'workflow_source': 'local', 'workflow': 'workflows/galaxy101.ga', 'cache_dir': str(tmpdir),
+              'runtime_params': {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}}}
+    monkeypatch.setattr(GalaxyCMDWorkflow, 'connect', None)
+    report = BatchRunner(config, samples, columns).run()
+    assert report[0] == ('s1', "Dataset file 'data/missing.bed' does not exist")
+    assert report[1][0] == 's2' and "Input label(s) ['Extra'] not found" in report[1][1]
+
+def test_connection_pool_reuses_connections():
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/api/histories' % server.server_port
+    try:
+        pool = ConnectionPool(pool_size=2, timeout=5)
+        for i in range(0, 3):
+            assert pool.get(url).json() == {}
+        assert pool.stats() == {'requests': 3, 'new_connections': 1, 'reused_connections': 2}
+        closing = ConnectionPool(keep_alive=False, timeout=5)
+        for i in range(0, 3):
+            closing.get(url)
+        assert closing.stats()['new_connections'] == 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def fake_history_galaxy(states):
+    class FakeGalaxy(object):
+        class gi(object):
+            class histories(object):
+                @staticmethod
+                def show_history(history_id):
+                    return {'id': history_id, 'state_details': states.pop(0)}
+    return FakeGalaxy
+
+def test_history_monitor_backs_off_until_done(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('gflow.HistoryMonitor.time.sleep', sleeps.append)
+    gi = fake_history_galaxy([{'queued': 2, 'ok': 1}, {'running': 1, 'ok': 2}, {'running': 1, 'ok': 2},
+                              {'ok': 3}])
+    monitor = HistoryMonitor(gi, 'history_id', expected_datasets=3, poll_interval=2, max_poll_interval=5)
+    assert monitor.wait() == 'ok'
+    assert monitor.polls == 4
+    assert 1 <= sleeps[0] <= 2 and 2 <= sleeps[1] <= 4 and 2.5 <= sleeps[2] <= 5
+
+def test_history_monitor_stops_on_first_error(monkeypatch):
+    monkeypatch.setattr('gflow.HistoryMonitor.time.sleep', lambda seconds: None)
+    gi = fake_history_galaxy([{'running': 2}, {'error': 1, 'running': 1}])
+    assert HistoryMonitor(gi, 'history_id').wait() == 'error'
+
+def test_history_monitor_treats_paused_datasets_as_failed(monkeypatch):
+    monkeypatch.setattr('gflow.HistoryMonitor.time.sleep', lambda seconds: None)
+    gi = fake_history_galaxy([{'running': 1, 'ok': 1}, {'paused': 1, 'ok': 1}])
+    assert HistoryMonitor(gi, 'history_id').wait() == 'error'
+
+def test_workflow_cache_hash_ignores_formatting():
+    with open('workflows/select_sort.ga') as json_file:
+        workflow = json.load(json_file)
+    reordered = json.loads(json.dumps(workflow, indent=4, sort_keys=True))
+    assert WorkflowCache.canonical_hash(workflow) == WorkflowCache.canonical_hash(reordered)
+    workflow['name'] = 'changed'
+    assert WorkflowCache.canonical_hash(workflow) != WorkflowCache.canonical_hash(reordered)
+
+def test_workflow_cache_forgets_deleted_workflows(tmpdir):
+    class Workflow(object):
+        def __init__(self, workflow_id):
+            self.id = workflow_id
+            self.deleted = workflow_id == 'deleted'
+
+    class FakeGalaxy(object):
+        class workflows(object):
+            get = Workflow
+
+    cache = WorkflowCache('http://galaxy', JsonStore(str(tmpdir.join("workflows.json"))))
+    cache.remember('digest', 'available')
+    assert cache.lookup(FakeGalaxy, 'digest').id == 'available'
+    cache.remember('digest', 'deleted')
+    assert cache.lookup(FakeGalaxy, 'digest') is None
+    assert cache.store.entries == {}
+
+def test_import_workflow_twice_reuses_cached_workflow(gflow, gi, tmpdir):
+    gflow.cache_dir = str(tmpdir)
+    workflow = gflow.import_workflow(gi)
+    assert not gflow.workflow_reused
+    workflow_copy = gflow.import_workflow(gi)
+    assert gflow.workflow_reused
+    assert workflow_copy.id == workflow.id
+    workflow.delete()
+
 def test_import_workflow_from_file(gflow, gi):
     workflow = gflow.import_workflow(gi)
     assert workflow.name == "galaxy101-2015_avjasdvuweufwevw9wf (imported from API)"
@@ -96,12 +274,594 @@ def test_import_dataset_from_library(gflow, gi):
     library.delete()
     history.delete(purge=True)
 
+def test_library_datasets_are_listed_once_per_library(tmpdir):
+    listed = []
+
+    class FakeGalaxy(object):
+        class gi(object):
+            class libraries(object):
+                @staticmethod
+                def show_library(library_id, contents=False):
+                    listed.append(library_id)
+                    return [{'id': '%s_ds%d' % (library_id, i), 'type': 'file', 'name': 'ds%d' % i}
+                            for i in range(0, 3)] + [{'id': 'folder', 'type': 'folder', 'name': '/'}]
+
+            class histories(object):
+                @staticmethod
+                def upload_dataset_from_library(history_id, dataset_id):
+                    return {'id': 'hda_' + dataset_id, 'name': dataset_id}
+
+    class History(object):
+        id = 'history_id'
+
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/galaxy101.ga", cache_dir=str(tmpdir))
+    gflow.datasets = dict((i, {'source': 'library', 'library_id': 'lib%d' % (i % 2),
+                               'dataset_id': 'lib%d_ds%d' % (i % 2, i // 2), 'input_label': 'Input'})
+                          for i in range(0, 6))
+    imported = gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert sorted(listed) == ['lib0', 'lib1']
+    assert [dataset.id for dataset in imported] == ['hda_lib0_ds0', 'hda_lib1_ds0', 'hda_lib0_ds1',
+                                                    'hda_lib1_ds1', 'hda_lib0_ds2', 'hda_lib1_ds2']
+    gflow.datasets[5]['dataset_id'] = 'missing'
+    with pytest.raises(ValueError) as excinfo:
+        gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert "not found in library 'lib1'" in str(excinfo.value)
+
+def test_url_datasets_are_fetched_by_galaxy_in_batches(tmpdir):
+    requests_made = []
+
+    class FakeGalaxy(object):
+        class gi(object):
+            class tools(object):
+                @staticmethod
+                def put_url(content, history_id, file_type='auto', dbkey='?'):
+                    urls = content.split('\n')
+                    requests_made.append((file_type, len(urls)))
+                    return {'outputs': [{'id': 'hda_' + url.rsplit('/', 1)[1], 'name': url} for url in urls]}
+
+    class History(object):
+        id = 'history_id'
+
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/galaxy101.ga", cache_dir=str(tmpdir),
+                                               max_urls_per_request=3)
+    gflow.datasets = dict((i, {'source': 'url', 'url': 'https://mirror/r%d' % i, 'input_label': 'Input'})
+                          for i in range(0, 7))
+    gflow.datasets[2]['file_type'] = 'bed'
+    imported = gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert [dataset.id for dataset in imported] == ['hda_r%d' % i for i in range(0, 7)]
+    assert requests_made == [('auto', 3), ('bed', 1), ('auto', 3)]
+    gflow.datasets = {0: {'source': 'url', 'url': '/data/r0', 'input_label': 'Input'}}
+    with pytest.raises(ValueError) as excinfo:
+        gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert "must start with http://, https:// or ftp://" in str(excinfo.value)
+
+def test_server_paths_are_linked_once_per_directory(tmpdir):
+    linked = []
+    created = []
+
+    class Library(object):
+        id = 'staging'
+        wrapped = {'root_folder_id': 'root'}
+
+    class FakeGalaxy(object):
+        class libraries(object):
+            @staticmethod
+            def list(name=None):
+                return []
+
+            @staticmethod
+            def create(name):
+                created.append(name)
+                return Library()
+
+        class gi(object):
+            class libraries(object):
+                @staticmethod
+                def upload_from_galaxy_filesystem(library_id, paths, folder_id=None, file_type='auto', dbkey='?',
+                                                  link_data_only=None):
+                    linked.append((paths.split('\n'), link_data_only))
+                    return [{'id': 'ld_' + os.path.basename(path), 'name': os.path.basename(path)}
+                            for path in paths.split('\n')]
+
+            class histories(object):
+                @staticmethod
+                def upload_dataset_from_library(history_id, dataset_id):
+                    return {'id': 'hda_' + dataset_id, 'name': dataset_id[3:]}
+
+    class History(object):
+        id = 'history_id'
+
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/galaxy101.ga", cache_dir=str(tmpdir))
+    paths = ['/lustre/run1/a.fq', '/lustre/run2/b.fq', '/lustre/run1/c.fq']
+    gflow.datasets = dict((i, {'source': 'server_path', 'path': paths[i], 'input_label': 'Input'})
+                          for i in range(0, 3))
+    imported = gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert [dataset.id for dataset in imported] == ['hda_ld_a.fq', 'hda_ld_b.fq', 'hda_ld_c.fq']
+    assert linked == [(['/lustre/run1/a.fq', '/lustre/run1/c.fq'], 'link_to_files'),
+                      (['/lustre/run2/b.fq'], 'link_to_files')]
+    assert created == ['Test History server paths']
+    gflow.datasets = {0: {'source': 'server_path', 'path': 'run1/a.fq', 'input_label': 'Input'}}
+    with pytest.raises(ValueError) as excinfo:
+        gflow.import_datasets('datasets', FakeGalaxy, History())
+    assert "Server path 'run1/a.fq' must be absolute" in str(excinfo.value)
+
+def test_populate_library_copies_history_or_imported_datasets(tmpdir):
+    copies = []
+
+    class Library(object):
+        id = 'lib_id'
+        wrapped = {'root_folder_id': 'root'}
+
+    class FakeGalaxy(object):
+        class libraries(object):
+            @staticmethod
+            def create(name):
+                return Library()
+
+        class gi(object):
+            class histories(object):
+                @staticmethod
+                def show_history(history_id, contents=False):
+                    return [{'id': 'hda1'}, {'id': 'hda2', 'deleted': True}, {'id': 'hda3'},
+                            {'id': 'hdca1', 'history_content_type': 'dataset_collection'}]
+
+            class libraries(object):
+                @staticmethod
+                def copy_from_dataset(library_id, dataset_id, folder_id=None):
+                    copies.append((library_id, dataset_id, folder_id))
+                    return {'library_dataset_id': 'ld_' + dataset_id}
+
+    class History(object):
+        id = 'history_id'
+
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/galaxy101.ga", library_name='Test Library',
+                                               cache_dir=str(tmpdir))
+    gflow._imported_dataset_ids = ['hda3']
+    gflow._uploaded_digests = {'hda3': 'digest'}
+    assert gflow.populate_library(FakeGalaxy, History()).id == 'lib_id'
+    assert sorted(copies) == [('lib_id', 'hda1', 'root'), ('lib_id', 'hda3', 'root')]
+    assert gflow.dataset_cache.store.entries['http://galaxy|digest']['id'] == 'ld_hda3'
+    del copies[:]
+    gflow.library_imported_only = True
+    gflow.populate_library(FakeGalaxy, History())
+    assert copies == [('lib_id', 'hda3', 'root')]
+
+def test_import_datasets_in_parallel_keeps_order(gflow, gi):
+    history = gi.histories.create(gflow.history_name)
+    gflow.max_parallel_uploads = 4
+    gflow.datasets = dict((i, {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'})
+                          for i in range(0, 4))
+    gflow.datasets[2]['dataset_file'] = 'workflows/select_sort.ga'
+    imported = gflow.import_datasets('datasets', gi, history)
+    assert [dataset.name for dataset in imported] == ['exons.bed', 'exons.bed', 'select_sort.ga', 'exons.bed']
+    history.delete(purge=True)
+
+def test_collection_builder_assembles_pairs_in_any_order(tmpdir):
+    p = tmpdir.join("pairs.tsv")
+    p.write("sample\tforward\treverse\n"
+            "s1\ts1_R1.fq\ts1_R2.fq\n"
+            "s2\ts2_R1.fq\ts2_R2.fq\n")
+    entries = CollectionBuilder.read_sheet(str(p), 'list:paired')
+    assert entries[1] == {'source': 'local', 'dataset_file': 's1_R2.fq', 'group': 's1', 'pair': 'reverse'}
+    builder = CollectionBuilder('list:paired', entries)
+    for index in (3, 0, 2):
+        builder.add(index, entries[index]['dataset_file'], 'hda%d' % index)
+    assert builder.elements[0] is None and builder.elements[1].name == 's2'
+    with pytest.raises(RuntimeError):
+        builder.description()
+    builder.add(1, 's1_R2.fq', 'hda1')
+    description = builder.description('Pairs').to_dict()
+    assert description['collection_type'] == 'list:paired'
+    assert [element['name'] for element in description['element_identifiers']] == ['s1', 's2']
+    assert description['element_identifiers'][0]['element_identifiers'] == [
+        {'name': 'forward', 'src': 'hda', 'id': 'hda0'}, {'name': 'reverse', 'src': 'hda', 'id': 'hda1'}]
+
+def test_collection_builder_nests_lists_and_checks_pairs():
+    entries = [{'group': 'g1', 'element': 'a'}, {'group': 'g2'}, {'group': 'g1', 'element': 'b'}]
+    builder = CollectionBuilder('list:list', entries)
+    for index in (2, 1, 0):
+        builder.add(index, 'dataset%d' % index, 'hda%d' % index)
+    description = builder.description().to_dict()
+    assert [(element['name'], [inner['name'] for inner in element['element_identifiers']])
+            for element in description['element_identifiers']] == [('g1', ['a', 'b']), ('g2', ['dataset1'])]
+    with pytest.raises(ValueError) as excinfo:
+        CollectionBuilder('list:paired', [{'group': 's1', 'pair': 'forward'}, {'group': 's1', 'pair': 'forward'}])
+    assert "Pair 's1' needs exactly one forward and one reverse dataset" in str(excinfo.value)
+    with pytest.raises(ValueError) as excinfo:
+        CollectionBuilder('list:list', [{'element': 'a'}])
+    assert "needs a 'group'" in str(excinfo.value)
+
+def test_pattern_pairs_files_by_wildcard_text(tmpdir):
+    reads = tmpdir.mkdir("reads")
+    for name in ("s2_R2.fq", "s1_R1.fq", "s2_R1.fq", "s1_R2.fq", ".s3_R1.fq", "notes.txt"):
+        reads.join(name).write("ACGT")
+    assert expand_braces("r/*_R{1,2}.fq") == [("r/*_R1.fq", ("1",)), ("r/*_R2.fq", ("2",))]
+    entries = expand_entry({'pattern': str(reads) + "/*_R{1,2}.fq"}, 'list:paired')
+    assert [(entry['group'], entry['pair'], os.path.basename(entry['dataset_file'])) for entry in entries] == [
+        ('s1', 'forward', 's1_R1.fq'), ('s1', 'reverse', 's1_R2.fq'),
+        ('s2', 'forward', 's2_R1.fq'), ('s2', 'reverse', 's2_R2.fq')]
+    CollectionBuilder('list:paired', entries)
+    reads.join("s4_R1.fq").write("ACGT")
+    with pytest.raises(ValueError) as excinfo:
+        expand_entry({'pattern': str(reads) + "/*_R{1,2}.fq"}, 'list:paired')
+    assert "No reverse file for 's4'" in str(excinfo.value)
+    with pytest.raises(IOError):
+        expand_entry({'pattern': str(reads) + "/*.bam"}, 'list')
+
+def test_directory_entries_expand_once(tmpdir):
+    reads = tmpdir.mkdir("reads")
+    reads.join("a.fq").write("ACGT")
+    reads.mkdir("lane2").join("b.fq").write("ACGT")
+    gflow = GalaxyCMDWorkflow.init_from_params(
+        'http://galaxy', 'key', "Test History", "local", "workflows/galaxy101.ga", cache_dir=str(tmpdir),
+        dataset_collection={'input_label': 'Exons', 'type': 'list:list',
+                            'datasets': {0: {'directory': str(reads), 'pattern': '*.fq', 'recursive': True,
+                                             'group': 'reads'},
+                                         1: {'source': 'local', 'dataset_file': 'data/exons.bed', 'group': 'bed'}}})
+    entries = gflow.collection_entries()
+    assert [(entry['group'], os.path.basename(entry['dataset_file'])) for entry in entries] == [
+        ('reads', 'a.fq'), ('reads', 'b.fq'), ('bed', 'exons.bed')]
+    assert all(entry['source'] == 'local' for entry in entries)
+    reads.join("c.fq").write("ACGT")
+    assert gflow.collection_entries() is entries
+
+def test_fake_galaxy_runs_workflow_end_to_end(fake_galaxy, tmpdir):
+    gflow = fake_gflow(fake_galaxy, tmpdir, library_name="Test Library")
+    outputs, history = gflow.run(wait=True)
+    assert gflow.history_state == 'ok'
+    assert len(outputs) == 5
+    assert fake_galaxy.request_count('POST', '/api/tools') == 2
+    assert fake_galaxy.request_count('POST', '/api/workflows') == 1
+    library = list(fake_galaxy.libraries.values())[0]
+    assert library['name'] == "Test Library" and len(library['contents']) == 2
+    gflow = fake_gflow(fake_galaxy, tmpdir, runtime_params=None)
+    with pytest.raises(RuntimeError) as excinfo:
+        gflow.run()
+    assert "step 5 (Select first): lineNum" in str(excinfo.value)
+
+def test_run_manifest_is_written_for_successful_and_failed_runs(fake_galaxy, tmpdir):
+    manifest_file = str(tmpdir.join("manifest.json"))
+    outputs, history = fake_gflow(fake_galaxy, tmpdir).run(output_file=manifest_file, wait=True)
+    manifest = json.loads(open(manifest_file).read())
+    assert manifest['status'] == 'ok' and manifest['history']['id'] == history.id
+    assert manifest['invocation_id'] in fake_galaxy.invocations
+    assert [output['id'] for output in manifest['outputs']] == [output.id for output in outputs]
+    assert set(output['state'] for output in manifest['outputs']) == set(['ok'])
+    assert manifest['inputs']['Exons']['file_size'] == os.path.getsize('data/exons.bed')
+    assert manifest['metrics']['stages']['invoke_workflow'] > 0
+    with pytest.raises(RuntimeError):
+        fake_gflow(fake_galaxy, tmpdir, runtime_params=None).run(output_file=manifest_file)
+    manifest = json.loads(open(manifest_file).read())
+    assert manifest['status'] == 'failed' and 'lineNum' in manifest['error']
+    assert 'outputs' not in manifest and manifest['metrics']['stages']['run'] > 0
+
+def test_run_manifest_records_an_interrupted_run_as_failed(fake_galaxy, tmpdir, monkeypatch):
+    def interrupt(*args):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(GalaxyCMDWorkflow, 'run_stages', interrupt)
+    manifest_file = str(tmpdir.join("manifest.json"))
+    with pytest.raises(KeyboardInterrupt):
+        fake_gflow(fake_galaxy, tmpdir).run(output_file=manifest_file)
+    manifest = json.loads(open(manifest_file).read())
+    assert manifest['status'] == 'failed' and manifest['error'] == 'KeyboardInterrupt'
+
+def test_misspelled_runtime_param_step_fails_before_writing(fake_galaxy, tmpdir):
+    gflow = fake_gflow(fake_galaxy, tmpdir,
+                       runtime_params={'tool_0': {'step': 'Selekt first', 'param_0': {'name': 'lineNum', 'value': '10'}}})
+    with pytest.raises(ValueError) as excinfo:
+        gflow.run()
+    assert "No step matches 'Selekt first'" in str(excinfo.value)
+    assert fake_galaxy.histories == {} and fake_galaxy.request_count('POST') == 0
+
+def test_async_run_checks_workflow_by_id_before_creating_history(fake_galaxy, tmpdir):
+    asyncio = pytest.importorskip("asyncio")
+    pytest.importorskip("aiohttp")
+    from gflow.AsyncGalaxyCMDWorkflow import AsyncGalaxyCMDWorkflow
+    workflow = fake_gflow(fake_galaxy, tmpdir).import_workflow(galaxy_instance.GalaxyInstance(fake_galaxy.url,
+                                                                                             fake_galaxy.api_key))
+    flow = AsyncGalaxyCMDWorkflow.init_from_params(
+        fake_galaxy.url, fake_galaxy.api_key, "Test History", "id", workflow.id, cache_dir=str(tmpdir),
+        datasets={0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'}},
+        runtime_params={'tool_0': {'step': 'Selekt first', 'param_0': {'name': 'lineNum', 'value': '10'}}})
+    with pytest.raises(ValueError):
+        asyncio.new_event_loop().run_until_complete(flow.run())
+    assert fake_galaxy.histories == {}
+
+def test_async_run_copies_imported_datasets_with_bounded_library_copies(fake_galaxy, tmpdir):
+    asyncio = pytest.importorskip("asyncio")
+    pytest.importorskip("aiohttp")
+    from gflow.AsyncGalaxyCMDWorkflow import AsyncGalaxyCMDWorkflow
+    flow = AsyncGalaxyCMDWorkflow(fake_gflow(fake_galaxy, tmpdir, library_name="Test Library",
+                                             library_imported_only=True, max_parallel_library_copies=1))
+    copies = {'running': 0, 'most': 0, 'done': 0}
+    request = flow.request
+
+    async def tracked_request(method, path, payload=None, data=None):
+        if not (payload or {}).get('from_hda_id'):
+            return await request(method, path, payload, data)
+        copies['running'] += 1
+        copies['most'] = max(copies['most'], copies['running'])
+        try:
+            await asyncio.sleep(0.01)
+            return await request(method, path, payload, data)
+        finally:
+            copies['running'] -= 1
+            copies['done'] += 1
+    flow.request = tracked_request
+    manifest_file = str(tmpdir.join("manifest.json"))
+    results = asyncio.new_event_loop().run_until_complete(flow.run(output_file=manifest_file))
+    assert len(results['outputs']) == 5 and copies['done'] == 2 and copies['most'] == 1
+    library = list(fake_galaxy.libraries.values())[0]
+    assert library['name'] == "Test Library" and len(library['contents']) == 2
+    manifest = json.loads(open(manifest_file).read())
+    assert manifest['status'] == 'invoked' and manifest['invocation_id'] in fake_galaxy.invocations
+    assert manifest['metrics']['api_calls'] == fake_galaxy.request_count()
+
+def test_async_failed_import_purges_history_and_temp_workflow(fake_galaxy, tmpdir):
+    asyncio = pytest.importorskip("asyncio")
+    pytest.importorskip("aiohttp")
+    from gflow.AsyncGalaxyCMDWorkflow import AsyncGalaxyCMDWorkflow
+    flow = AsyncGalaxyCMDWorkflow(fake_gflow(fake_galaxy, tmpdir, datasets={
+        0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+        1: {'source': 'library', 'library_id': 'nolib', 'dataset_id': 'nods', 'input_label': 'Features'}}))
+    with pytest.raises(ConnectionError):
+        asyncio.new_event_loop().run_until_complete(flow.run(temp_wf=True))
+    assert [history['purged'] for history in fake_galaxy.histories.values()] == [True]
+    assert [workflow['deleted'] for workflow in fake_galaxy.workflows.values()] == [True]
+
+def test_failed_import_purges_history_and_temp_workflow(fake_galaxy, tmpdir):
+    gflow = fake_gflow(fake_galaxy, tmpdir, datasets={
+        0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+        1: {'source': 'library', 'library_id': 'nolib', 'dataset_id': 'nods', 'input_label': 'Features'}})
+    with pytest.raises(ConnectionError):
+        gflow.run(temp_wf=True)
+    assert [history['purged'] for history in fake_galaxy.histories.values()] == [True]
+    assert [workflow['deleted'] for workflow in fake_galaxy.workflows.values()] == [True]
+
+def test_fake_galaxy_bandwidth_is_shared_by_concurrent_requests():
+    fake_galaxy_module = pytest.importorskip("fake_galaxy")
+    galaxy = fake_galaxy_module.FakeGalaxy(bandwidth=1000)
+    delays = parallel_map(lambda i: galaxy.transfer_delay(100), range(0, 4), 4)
+    assert sorted(round(delay, 1) for delay in delays) == [0.1, 0.2, 0.3, 0.4]
+
+def test_second_run_on_one_instance_copies_only_its_own_datasets(fake_galaxy, tmpdir):
+    gflow = fake_gflow(fake_galaxy, tmpdir, library_name="Test Library")
+    gflow.library_imported_only = True
+    gflow.run()
+    gflow.run()
+    assert [len(library['contents']) for library in fake_galaxy.libraries.values()] == [2, 2]
+
+def test_fake_galaxy_second_run_reuses_uploads_and_workflow(fake_galaxy, tmpdir):
+    fake_gflow(fake_galaxy, tmpdir).run()
+    uploads = fake_galaxy.request_count('POST', '/api/tools')
+    fake_gflow(fake_galaxy, tmpdir).run()
+    assert fake_galaxy.request_count('POST', '/api/tools') == uploads
+    assert fake_galaxy.request_count('POST', '/api/workflows/upload') == 1
+    assert fake_galaxy.request_count('POST', '/api/histories/\\w+/contents') == 2
+
+def test_run_metrics_count_stages_calls_and_bytes(fake_galaxy, tmpdir):
+    gflow = fake_gflow(fake_galaxy, tmpdir)
+    gflow.run(wait=True)
+    metrics = gflow.metrics.as_dict()
+    assert set(['preflight', 'import_workflow', 'import_datasets', 'invoke_workflow', 'wait', 'run']) \
+        <= set(metrics['stages'])
+    assert metrics['api_calls'] == fake_galaxy.request_count()
+    assert metrics['bytes_uploaded'] == 2 * os.path.getsize('data/exons.bed')
+    assert metrics['datasets_imported'] == 2 and metrics['datasets_from_cache'] == 0
+    gflow = fake_gflow(fake_galaxy, tmpdir)
+    gflow.run()
+    gflow.metrics.write(str(tmpdir.join("metrics.json")))
+    metrics = json.loads(tmpdir.join("metrics.json").read())
+    assert metrics['bytes_uploaded'] == 0 and metrics['datasets_from_cache'] == 2
+    assert metrics['upload_retries'] == 0
+
+def test_upload_progress_reports_concurrent_uploads(caplog):
+    caplog.set_level(logging.INFO, logger='gflow.UploadProgress')
+    metrics = RunMetrics()
+    progress = UploadProgress(metrics, interval=0)
+    first = progress.start('reads_1.fq', 4000000)
+    second = progress.start('reads_2.fq', 1000000, sent=500000)
+    progress.advance(first, 1000000)
+    assert "Uploading 2 file(s)" in caplog.text and "reads_1.fq 25%, reads_2.fq 50%" in caplog.text
+    progress.finish(second, complete=False)
+    progress.finish(first)
+    assert progress.sent == 4000000 and metrics.counters['bytes_uploaded'] == 4000000
+    assert "Uploaded 'reads_1.fq': 4.0 MB" in caplog.text
+    assert [(upload['name'], upload['complete']) for upload in metrics.uploads] == \
+        [('reads_2.fq', False), ('reads_1.fq', True)]
+    assert metrics.as_dict()['upload_mb_per_second'] > 0
+
+def test_fake_galaxy_takes_chunked_uploads(fake_galaxy, tmpdir):
+    reads = tmpdir.join("reads.bed")
+    reads.write("chr1\t1\t2\n" * 20000)
+    gflow = fake_gflow(fake_galaxy, tmpdir, chunked_upload_threshold=1, upload_chunk_size=64 * 1024,
+                       datasets={0: {'source': 'local', 'dataset_file': str(reads), 'input_label': 'Exons'},
+                                 1: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Features'}})
+    gflow.run()
+    sizes = [reads.size(), os.path.getsize('data/exons.bed')]
+    assert gflow.metrics.counters['bytes_uploaded'] == sum(sizes)
+    assert fake_galaxy.request_count('POST', '/api/upload') == sum(-(-size // (64 * 1024)) for size in sizes)
+    assert sorted(dataset['file_size'] for dataset in fake_galaxy.datasets.values())[-2:] == sorted(sizes)
+
+def test_concurrent_runs_count_only_their_own_api_calls(fake_galaxy, tmpdir):
+    runs = [fake_gflow(fake_galaxy, tmpdir.mkdir("run%d" % i)) for i in range(0, 2)]
+    parallel_map(lambda gflow: gflow.run(), runs, 2)
+    calls = [gflow.metrics.as_dict()['api_calls'] for gflow in runs]
+    assert all(calls) and sum(calls) == fake_galaxy.request_count()
+
+def test_concurrent_runs_use_the_pool_of_their_own_settings(fake_galaxy, tmpdir):
+    runs = [fake_gflow(fake_galaxy, tmpdir.mkdir("run%d" % size), http_pool_size=size) for size in (3, 4)]
+    parallel_map(lambda gflow: gflow.run(), runs, 2)
+    assert runs[0].connection_pool is not runs[1].connection_pool
+    for gflow in runs:
+        assert gflow.connection_pool.stats()['requests'] == gflow.metrics.as_dict()['api_calls']
+
+def test_parallel_map_keeps_order():
+    assert parallel_map(lambda x: x * 2, range(0, 20), 4) == [x * 2 for x in range(0, 20)]
+
+def test_parallel_map_reraises_first_error():
+    def fail_on_three(x):
+        if x == 3:
+            raise IOError("failed on %d" % x)
+        return x
+    with pytest.raises(IOError) as excinfo:
+        parallel_map(fail_on_three, range(0, 10), 4)
+    assert "failed on 3" in str(excinfo.value)
+
+def test_json_stores_sharing_a_file_keep_each_others_changes(tmpdir):
+    filename = str(tmpdir.join("uploads.json"))
+    first, second = JsonStore(filename), JsonStore(filename)
+    first.set('x', 1)
+    second.set('y', 2)
+    first.delete('missing')
+    assert JsonStore(filename).entries == {'x': 1, 'y': 2}
+    second.delete('x')
+    assert first.get('x') == 1 and JsonStore(filename).entries == {'y': 2}
+
+def test_batch_samples_share_cache_stores(tmpdir):
+    config = {'galaxy_url': 'http://galaxy', 'galaxy_key': 'key', 'history_name': 'Batch', 'workflow_source': 'id',
+              'workflow': 'wf', 'cache_dir': str(tmpdir)}
+    runner = BatchRunner(config, [{'sample': 's1'}, {'sample': 's2'}], ['sample'])
+    first, second = [GalaxyCMDWorkflow(runner.sample_config(sample)) for sample in runner.samples]
+    assert first.fingerprinter.store is second.fingerprinter.store
+    assert first.dataset_cache.store is second.dataset_cache.store
+    assert first.chunked_uploader.journal is second.chunked_uploader.journal
+
+def test_batch_parses_the_workflow_once_and_survives_unexpected_errors(fake_galaxy, tmpdir, monkeypatch):
+    config = {'galaxy_url': fake_galaxy.url, 'galaxy_key': fake_galaxy.api_key, 'history_name': 'Batch',
+              'workflow_source': 'local', 'workflow': 'workflows/galaxy101.ga', 'cache_dir': str(tmpdir),
+              'datasets': {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+                           1: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Features'}},
+              'runtime_params': {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}}}
+    parsed = []
+    from_file = LocalWorkflow.from_file
+    monkeypatch.setattr(LocalWorkflow, 'from_file', lambda filename: parsed.append(filename) or from_file(filename))
+    run_stages = GalaxyCMDWorkflow.run_stages
+
+    def fail_s1(gflow, *args):
+        if gflow.history_name == 'Batch s1':
+            raise TypeError("unexpected")
+        return run_stages(gflow, *args)
+    monkeypatch.setattr(GalaxyCMDWorkflow, 'run_stages', fail_s1)
+    report = BatchRunner(config, [{'sample': 's1'}, {'sample': 's2'}, {'sample': 's3'}], ['sample']).run()
+    assert report == [('s1', 'unexpected'), ('s2', None), ('s3', None)]
+    assert parsed == ['workflows/galaxy101.ga']
+
+def test_chunked_upload_resumes_from_journal(tmpdir, monkeypatch):
+    data = tmpdir.join("reads.fastq")
+    data.write("ACGT" * 10)
+    received = []
+    dropped = []
+
+    class Response(object):
+        status_code = 200
+        text = '{"message": "Successful."}'
+
+    def fake_post(url, params, data, files):
+        if data['session_start'] == 16 and not dropped:
+            dropped.append(16)
+            raise requests.exceptions.ConnectionError("connection dropped")
+        received.append(data['session_start'])
+        return Response()
+
+    class FakeGalaxy(object):
+        class gi(object):
+            class tools(object):
+                @staticmethod
+                def run_tool(history_id, tool_id, inputs):
+                    return {'outputs': [{'id': 'dataset_id'}]}
+
+    journal = JsonStore(str(tmpdir.join("uploads.json")))
+    uploader = ChunkedUploader('http://galaxy', 'key', chunk_size=8, retries=0, journal=journal)
+    monkeypatch.setattr('gflow.ChunkedUploader.requests.post', fake_post)
+    with pytest.raises(IOError):
+        uploader.upload(str(data), FakeGalaxy, 'history_id')
+    assert journal.get(ChunkedUploader.journal_key(str(data)))['offset'] == 16
+    assert uploader.upload(str(data), FakeGalaxy, 'history_id') == 'dataset_id'
+    assert received == [0, 8, 16, 24, 32]
+    assert journal.entries == {}
+
+def test_chunked_upload_fails_if_the_file_shrinks(tmpdir, monkeypatch):
+    data = tmpdir.join("reads.fastq")
+    data.write("ACGT" * 10)
+
+    class Response(object):
+        status_code = 200
+        text = '{"message": "Successful."}'
+
+    uploader = ChunkedUploader('http://galaxy', 'key', chunk_size=8, retries=0,
+                               journal=JsonStore(str(tmpdir.join("uploads.json"))))
+    monkeypatch.setattr('gflow.ChunkedUploader.requests.post', lambda url, params, data, files: Response())
+    # The size taken before the upload, the file has lost 8 bytes since
+    monkeypatch.setattr('gflow.ChunkedUploader.os.path.getsize', lambda path: 48)
+    with pytest.raises(IOError) as excinfo:
+        uploader.upload(str(data), None, 'history_id')
+    assert "shrank to 40 bytes while being uploaded, expected 48" in str(excinfo.value)
+
+def test_dataset_cache_forgets_purged_datasets(tmpdir):
+    class FakeGalaxy(object):
+        class gi(object):
+            class datasets(object):
+                @staticmethod
+                def show_dataset(dataset_id):
+                    return {'id': dataset_id, 'deleted': dataset_id == 'purged', 'purged': dataset_id == 'purged'}
+
+    cache = DatasetCache('http://galaxy', JsonStore(str(tmpdir.join("datasets.json"))))
+    digest = Fingerprinter.hash_file('data/exons.bed')
+    cache.remember(digest, 'hda', 'available')
+    assert cache.lookup(FakeGalaxy, digest)['id'] == 'available'
+    cache.remember(digest, 'hda', 'purged')
+    assert cache.lookup(FakeGalaxy, digest) is None
+    assert cache.store.entries == {}
+
+def test_dataset_cache_keeps_entries_on_server_errors(tmpdir):
+    class FakeGalaxy(object):
+        class gi(object):
+            class datasets(object):
+                @staticmethod
+                def show_dataset(dataset_id):
+                    raise ConnectionError("GET: error %s: 'reply', 0 attempts left" % dataset_id)
+
+    cache = DatasetCache('http://galaxy', JsonStore(str(tmpdir.join("datasets.json"))))
+    digest = Fingerprinter.hash_file('data/exons.bed')
+    cache.remember(digest, 'hda', '502')
+    assert cache.lookup(FakeGalaxy, digest)['id'] == '502'
+    assert cache.lookup(FakeGalaxy, digest)['id'] == '502'
+    cache.remember(digest, 'hda', '404')
+    assert cache.lookup(FakeGalaxy, digest) is None
+    assert cache.store.entries == {}
+
+def test_fingerprint_matches_sha1_and_is_remembered(tmpdir, monkeypatch):
+    data = tmpdir.join("reads.fastq")
+    data.write("ACGT" * 1000)
+    fingerprinter = Fingerprinter(JsonStore(str(tmpdir.join("fingerprints.json"))), block_size=64)
+    digest = fingerprinter.digest(str(data))
+    assert digest == hashlib.sha1(b"ACGT" * 1000).hexdigest()
+    monkeypatch.setattr(Fingerprinter, 'hash_file', None)
+    reloaded = Fingerprinter(JsonStore(str(tmpdir.join("fingerprints.json"))))
+    assert reloaded.digest_all([str(data), str(data)]) == {str(data): digest}
+
+def test_import_dataset_twice_reuses_cached_dataset(gflow, gi, tmpdir):
+    gflow.cache_dir = str(tmpdir)
+    history = gi.histories.create(gflow.history_name)
+    gflow.datasets = {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'}}
+    first = gflow.import_datasets('datasets', gi, history)[0]
+    second = gflow.import_datasets('datasets', gi, history)[0]
+    assert second.id != first.id
+    assert second.name == 'exons.bed'
+    assert len(gflow.dataset_cache.store.entries) == 1
+    history.delete(purge=True)
+
 def test_import_dataset_from_incorrect_source(gflow, gi):
     history = gi.histories.create(gflow.history_name)
     gflow.datasets = {0: {'source': 'wrong', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'}}
     with pytest.raises(ValueError) as excinfo:
         gflow.import_datasets('datasets', gi, history)
-    assert "Dataset source must be either 'local' or 'library'" in str(excinfo.value)
+    assert "Dataset source must be 'local', 'library', 'url' or 'server_path'" in str(excinfo.value)
     history.delete(purge=True)
 
 def test_import_dataset_wrong_data_group_type(gflow, gi):
@@ -179,7 +939,7 @@ def test_create_dataset_collection_wrong_type(gflow, gi):
     }
     with pytest.raises(ValueError) as excinfo:
         gflow.create_dataset_collection(gi, history, 'DatasetList')
-    assert "Dataset collection type must be 'list' or 'list:paired'" in excinfo.value
+    assert "Dataset collection type must be 'list', 'list:paired' or 'list:list'" in str(excinfo.value)
     history.delete(purge=True)
 
 # def test_verify_runtime_parameters(gflow, gi):
@@ -188,6 +948,206 @@ def test_create_dataset_collection_wrong_type(gflow, gi):
 #     assert missing_param == ['lineNum']
 #     workflow.delete()
 
+def fake_select_sort_workflow():
+    # What Galaxy reports for workflows/select_sort.ga, which has no labels or UUIDs
+    def tool_step(step_id, tool_id, tool_inputs):
+        return {'id': step_id, 'type': 'tool', 'tool_id': tool_id, 'tool_version': '1.0.0',
+                'tool_inputs': dict((k, json.dumps(v)) for k, v in tool_inputs.items()),
+                'input_steps': {'input': {'source_step': step_id - 1, 'step_output': 'output'}}}
+    return wrappers.Workflow({
+        'id': 'workflow_id', 'name': 'select_sort', 'deleted': False, 'published': False, 'tags': [],
+        'inputs': {'10': {'label': 'dataset1', 'value': ''}},
+        'steps': {'10': {'id': 10, 'type': 'data_input', 'tool_id': None, 'tool_inputs': {'name': 'Input Dataset'},
+                         'input_steps': {}},
+                  '11': tool_step(11, 'Show beginning1', {'input': None, 'lineNum': {'__class__': 'RuntimeValue'}}),
+                  '12': tool_step(12, 'sort1', {'input': None, 'column': '2', 'order': 'DESC'})}})
+
+def test_runtime_params_bind_to_steps_by_name_or_explicit_step(tmpdir):
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/select_sort.ga", cache_dir=str(tmpdir))
+    workflow = fake_select_sort_workflow()
+    gflow.runtime_params = {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}}
+    assert gflow.set_runtime_params(workflow) == {'11': {'lineNum': '10'}}
+    gflow.runtime_params = {'tool_0': {'param_0': {'name': 'wrong_name', 'value': '10'}}}
+    assert gflow.set_runtime_params(workflow) == {}
+    gflow.runtime_params = {'tool_0': {'param_0': {'name': 'input', 'value': 'x'}}}
+    assert sorted(gflow.set_runtime_params(workflow)) == ['11', '12']
+    # The UUID of the sort1 step in the .ga file
+    gflow.runtime_params['tool_0']['step'] = '88bb73c2-ffa5-4335-805b-926175381d31'
+    assert gflow.set_runtime_params(workflow) == {'12': {'input': 'x'}}
+    gflow.runtime_params['tool_0']['step'] = 'Show beginning1'
+    assert gflow.set_runtime_params(workflow) == {'11': {'input': 'x'}}
+    gflow.runtime_params['tool_0']['step'] = 'no such step'
+    with pytest.raises(ValueError) as excinfo:
+        gflow.set_runtime_params(workflow)
+    assert "No step matches 'no such step'" in str(excinfo.value)
+
+def test_nested_runtime_params_are_checked_and_bound_alike(tmpdir):
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "id", "workflow_id",
+                                               cache_dir=str(tmpdir))
+    tool_inputs = {'input': None, 'cond': {'__current_case__': 0, 'value': {'__class__': 'RuntimeValue'}},
+                   'rep': [{'__index__': 0, 'x': {'__class__': 'RuntimeValue'}}]}
+    workflow = wrappers.Workflow({
+        'id': 'workflow_id', 'name': 'nested', 'deleted': False, 'published': False, 'tags': [],
+        'inputs': {'10': {'label': 'dataset1', 'value': ''}},
+        'steps': {'10': {'id': 10, 'type': 'data_input', 'tool_id': None, 'tool_inputs': {'name': 'Input Dataset'},
+                         'input_steps': {}},
+                  '11': {'id': 11, 'type': 'tool', 'tool_id': 'nested1', 'tool_version': '1.0.0',
+                         'tool_inputs': dict((k, json.dumps(v)) for k, v in tool_inputs.items()),
+                         'input_steps': {'input': {'source_step': 10, 'step_output': 'output'}}}}})
+    gflow.runtime_params = {'tool_0': {'param_0': {'name': 'cond|value', 'value': '1'},
+                                       'param_1': {'name': 'rep_0|x', 'value': '2'}}}
+    assert unset_runtime_values(workflow, gflow.runtime_params) == []
+    assert gflow.set_runtime_params(workflow) == {'11': {'cond|value': '1', 'rep_0|x': '2'}}
+    gflow.runtime_params = {'tool_0': {'param_0': {'name': 'cond', 'value': '1'}},
+                            'tool_1': {'param_0': {'name': 'rep_0|y', 'value': '2'}}}
+    assert unset_runtime_values(workflow, gflow.runtime_params) == [('11', 'nested1', 'rep_0|x')]
+    assert gflow.set_runtime_params(workflow) == {'11': {'cond': '1'}}
+
+def test_local_workflow_parses_step_graph():
+    workflow = LocalWorkflow.from_file('workflows/galaxy101.ga')
+    assert workflow.sorted_step_ids() == ['0', '1', '2', '3', '4', '5', '6']
+    assert workflow.input_labels_to_ids == {'Exons': set(['0']), 'Features': set(['1'])}
+    assert workflow.inv_dag['6'] == set(['0', '5'])
+    assert workflow.steps['5'].input_steps == {'input': [('4', 'out_file1')]}
+    assert workflow.steps['3'].tool_state['groupcol'] == {'__class__': 'UnvalidatedValue', 'value': '4'}
+    assert 'sort1' in workflow.tool_ids
+    assert workflow.runtime_values() == [('5', 'Select first', 'lineNum')]
+    with pytest.raises(AttributeError):
+        workflow.steps['5'].extra = True
+
+def test_local_workflow_records_every_source_of_a_multiple_input():
+    with open('workflows/galaxy101.ga') as json_file:
+        workflow = json.load(json_file)
+    workflow['steps']['6']['input_connections']['input1'] = [{'id': 0, 'output_name': 'output'},
+                                                             {'id': 4, 'output_name': 'out_file1'}]
+    workflow = LocalWorkflow(workflow)
+    assert workflow.steps['6'].input_steps['input1'] == [('0', 'output'), ('4', 'out_file1')]
+    assert set(['0', '4']) <= workflow.inv_dag['6']
+
+def test_local_workflow_rejects_cycles_and_dangling_inputs():
+    with open('workflows/select_sort.ga') as json_file:
+        workflow = json.load(json_file)
+    workflow['steps']['1']['input_connections']['input']['id'] = 7
+    with pytest.raises(ValueError) as excinfo:
+        LocalWorkflow(workflow)
+    assert "Step 1 takes input from step 7, which does not exist" in str(excinfo.value)
+    workflow['steps']['1']['input_connections']['input']['id'] = 2
+    with pytest.raises(ValueError) as excinfo:
+        LocalWorkflow(workflow).sorted_step_ids()
+    assert "has a cycle" in str(excinfo.value)
+
+def test_preflight_rejects_bad_configs_before_connecting(tmpdir):
+    def preflight_error(**changes):
+        gflow = GalaxyCMDWorkflow.init_from_params(
+            'http://galaxy', 'key', "Test History", "local", "workflows/galaxy101.ga", cache_dir=str(tmpdir),
+            datasets={0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exons'},
+                      1: {'source': 'library', 'library_id': 'lib', 'dataset_id': 'ds', 'input_label': 'Features'}},
+            runtime_params={'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}}})
+        for key, value in changes.items():
+            setattr(gflow, key, value)
+        try:
+            gflow.preflight()
+        except (ValueError, KeyError, IOError, RuntimeError) as e:
+            return str(e)
+
+    assert preflight_error() is None
+    empty = tmpdir.join("empty.bed")
+    empty.write("")
+    assert "is empty" in preflight_error(datasets={0: {'source': 'local', 'dataset_file': str(empty),
+                                                      'input_label': 'Exons'}})
+    assert "Missing value for 'dataset_id' in library dataset entry" in preflight_error(
+        datasets={0: {'source': 'library', 'library_id': 'lib', 'input_label': 'Exons'}})
+    assert "Input label(s) ['Exon'] not found in the workflow" in preflight_error(
+        datasets={0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Exon'}})
+    assert "needs an even number of datasets, not 1" in preflight_error(
+        dataset_collection={'input_label': 'Exons', 'type': 'list:paired',
+                            'datasets': {0: {'source': 'local', 'dataset_file': 'data/exons.bed'}}})
+    assert "step 5 (Select first): lineNum" in preflight_error(runtime_params=None)
+
+def fake_staging_galaxy(runnable=True):
+    # Importing the workflow only finishes once an upload has started, so run() must overlap them
+    uploading = threading.Event()
+    purged = []
+
+    class Dataset(object):
+        def __init__(self, name):
+            self.id = 'hda_' + name
+            self.name = name
+
+    class History(object):
+        id = 'history_id'
+
+        def upload_dataset(self, path):
+            uploading.set()
+            return Dataset(os.path.basename(path))
+
+        def delete(self, purge=False):
+            purged.append(purge)
+
+    class Workflow(object):
+        is_runnable = runnable
+
+        def run(self, input_map, history, params=None):
+            return [input_map['Input Dataset']], history
+
+    class FakeGalaxy(object):
+        class workflows(object):
+            @staticmethod
+            def import_new(workflow):
+                assert uploading.wait(10)
+                return Workflow()
+
+        class histories(object):
+            @staticmethod
+            def create(name):
+                return History()
+
+    return FakeGalaxy, purged
+
+def test_run_overlaps_workflow_import_with_uploads(tmpdir):
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/select_sort.ga", cache_dir=str(tmpdir),
+                                               use_dataset_cache=False, use_workflow_cache=False)
+    gflow.datasets = {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Input Dataset'}}
+    gi, purged = fake_staging_galaxy()
+    outputs, history = gflow.run(gi=gi)
+    assert outputs[0].name == 'exons.bed'
+    gi, purged = fake_staging_galaxy(runnable=False)
+    with pytest.raises(RuntimeError) as excinfo:
+        gflow.run(gi=gi)
+    assert "Workflow not runnable" in str(excinfo.value)
+    assert purged == [True]
+
+def test_runtime_values_are_all_found_in_one_pass():
+    with open('workflows/galaxy101.ga') as json_file:
+        workflow = json.load(json_file)
+    assert find_runtime_values(workflow) == [('5', 'Select first', 'lineNum')]
+    state = json.loads(workflow['steps']['3']['tool_state'])
+    state['operations'] = json.dumps([{'__index__': 0, 'opcol': {'__class__': 'RuntimeValue'}}])
+    state['cond'] = json.dumps({'value': {'__class__': 'RuntimeValue'}, '__current_case__': 0})
+    workflow['steps']['3']['tool_state'] = json.dumps(state)
+    assert find_runtime_values(workflow) == [('3', 'Group', 'cond|value'), ('3', 'Group', 'operations_0|opcol'),
+                                             ('5', 'Select first', 'lineNum')]
+    runtime_params = {'tool_0': {'param_0': {'name': 'lineNum', 'value': '10'}},
+                      'tool_1': {'step': 'Grouping1', 'param_0': {'name': 'cond', 'value': '1'}}}
+    assert unset_runtime_values(workflow, runtime_params) == [('3', 'Group', 'operations_0|opcol')]
+    runtime_params['tool_0']['step'] = 'sort1'
+    assert [entry[2] for entry in unset_runtime_values(workflow, runtime_params)] == ['operations_0|opcol',
+                                                                                     'lineNum']
+    runtime_params['tool_0']['step'] = 'Selekt first'
+    with pytest.raises(ValueError) as excinfo:
+        unset_runtime_values(workflow, runtime_params)
+    assert "No step matches 'Selekt first'" in str(excinfo.value)
+
+def test_missing_runtime_params_fail_before_connecting(tmpdir, monkeypatch):
+    gflow = GalaxyCMDWorkflow.init_from_params('http://galaxy', 'key', "Test History", "local",
+                                               "workflows/galaxy101.ga", cache_dir=str(tmpdir))
+    monkeypatch.setattr(gflow, 'connect', None)
+    with pytest.raises(RuntimeError) as excinfo:
+        gflow.run()
+    assert "step 5 (Select first): lineNum" in str(excinfo.value)
+
 def test_verify_no_runtime_params(gflow, gi):
     gflow.workflow = "workflows/select_sort.ga"
     workflow = gflow.import_workflow(gi)
@@ -275,6 +1235,22 @@ def test_verify_no_runtime_params(gflow, gi):
 #     history = gi.histories.list(gflow.history_name)[0]
 #     history.delete(purge=True)
 
+def test_async_workflows_share_one_session(gflow):
+    asyncio = pytest.importorskip("asyncio")
+    pytest.importorskip("aiohttp")
+    from gflow.AsyncGalaxyCMDWorkflow import AsyncGalaxyCMDWorkflow, run_all
+    flows = []
+    for i in range(0, 3):
+        flow = AsyncGalaxyCMDWorkflow.init_from_params(gflow.galaxy_url, gflow.galaxy_key, 'history_%d' % i, 'local',
+                                                       'workflows/select_sort.ga')
+        flow.gflow.datasets = {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Input Dataset'}}
+        flows.append(flow)
+    results = asyncio.get_event_loop().run_until_complete(run_all(flows, temp_wf=True))
+    assert all(len(result['outputs']) == 2 for result in results)
+    gi = galaxy_instance.GalaxyInstance(gflow.galaxy_url, gflow.galaxy_key)
+    for result in results:
+        gi.histories.get(result['history']).delete(purge=True)
+
 def test_successful_workflow_no_runtime_params(gflow):
     gflow.datasets = {0: {'source': 'local', 'dataset_file': 'data/exons.bed', 'input_label': 'Input Dataset'}}
     gflow.workflow = 'workflows/select_sort.ga'